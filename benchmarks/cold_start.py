@@ -0,0 +1,115 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+from jsonschema import validate
+
+root = Path(__file__).resolve().parents[1]
+schema_path = root / "_docs" / "schemas" / "chaos-machine-input.json"
+input_path = root / "examples" / "inputs" / "PetSiteAZDisruption-split.json"
+
+handlers = [
+    "steady_state",
+    "start_experiment",
+    "monitor_experiment",
+    "continue_execution",
+    "evaluate_hypothesis",
+]
+
+# Imports a handler in a fresh interpreter, then creates every client it and the
+# chaos_machine modules it imports declare, which is what the handlers used to do
+# at import time.
+import_script = """
+import json, sys, time
+from chaos_machine.clients import LazyClient, get_client
+start = time.perf_counter()
+module = __import__(sys.argv[1])
+imported = time.perf_counter()
+modules = [module] + [
+    value for name, value in sys.modules.items() if name.startswith("chaos_machine.")
+]
+services = {
+    value.service_name
+    for module in modules
+    for value in vars(module).values()
+    if isinstance(value, LazyClient)
+}
+for service in services:
+    get_client(service)
+created = time.perf_counter()
+print(json.dumps({"import": imported - start, "clients": created - imported}))
+"""
+
+
+def measure_import(handler, env):
+    response = subprocess.run(
+        [sys.executable, "-c", import_script, handler],
+        env=env,
+        check=True,
+        capture_output=True,
+        text=True,
+    )
+    return json.loads(response.stdout)
+
+
+def measure_validation(event, iterations):
+    import steady_state
+
+    start = time.perf_counter()
+    for _ in range(iterations):
+        with open(schema_path, "r") as f:
+            schema = json.load(f)
+        validate(instance=event, schema=schema)
+    uncached = (time.perf_counter() - start) / iterations
+
+    steady_state.get_validator.cache_clear()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        error = steady_state.best_match(steady_state.get_validator().iter_errors(event))
+        assert error is None
+    cached = (time.perf_counter() - start) / iterations
+    return uncached, cached
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare eager and lazy client creation and schema validation."
+    )
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--iterations", type=int, default=200)
+    args = parser.parse_args()
+
+    paths = [str(root / "lambda"), str(root / "lambda" / "layer")]
+    sys.path[:0] = paths
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join(paths),
+        SCHEMA_PATH=str(schema_path),
+        LOG_LEVEL="WARNING",
+        AWS_DEFAULT_REGION=os.getenv("AWS_DEFAULT_REGION", "us-east-1"),
+    )
+    os.environ.update(env)
+
+    print(f"{'handler':<22}{'lazy init ms':>14}{'eager init ms':>15}{'gain ms':>10}")
+    for handler in handlers:
+        samples = [measure_import(handler, env) for _ in range(args.runs)]
+        lazy = min(sample["import"] for sample in samples) * 1000
+        eager = min(sample["import"] + sample["clients"] for sample in samples) * 1000
+        print(f"{handler:<22}{lazy:>14.1f}{eager:>15.1f}{eager - lazy:>10.1f}")
+
+    with open(input_path, "r") as f:
+        event = json.load(f)
+    uncached, cached = measure_validation(event, args.iterations)
+    print()
+    print(f"{'validation':<22}{'per call ms':>14}")
+    print(f"{'load and validate':<22}{uncached * 1000:>14.3f}")
+    print(f"{'cached validator':<22}{cached * 1000:>14.3f}")
+    print(f"{'gain':<22}{(uncached - cached) * 1000:>14.3f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+import argparse
+import gc
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+root = Path(__file__).resolve().parents[1]
+
+# GetMetricData returns at most 100,800 datapoints per response.
+CW_MAX_DATAPOINTS = 100800
+HISTORY_PAGE_SIZE = 100
+PERIOD = 60
+END_TIME = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+# Each phase runs against stubbed CloudWatch and Prometheus responses for every
+# combination of the workload dimensions it depends on.
+PHASES = {
+    "cloudwatch_fetch": ["queries", "points"],
+    "cloudwatch_evaluate": ["queries", "points"],
+    "prometheus_fetch": ["queries", "series", "points"],
+    "prometheus_evaluate": ["queries", "series", "points"],
+    "alarms": ["alarms"],
+    "alarm_history": ["alarms", "history"],
+}
+
+
+def series_values(id, points):
+    # Expressions are true (1) so every datapoint is evaluated, metrics are noise.
+    if id.startswith("e"):
+        return [1.0] * points
+    generator = random.Random(id)
+    return [generator.random() for _ in range(points)]
+
+
+class StubCloudWatch:
+    # Responses are built once per request and copied on every call, since the
+    # fetch engine extends the lists of the first page with the following pages.
+    def __init__(self, alarms=0, history=0):
+        self.pages = {}
+        self.alarm_names = [f"alarm-{index}" for index in range(alarms)]
+        self.history = history
+        self.history_items = {}
+
+    def build_pages(self, queries, start_time, end_time):
+        points = int((end_time - start_time).total_seconds() // PERIOD)
+        timestamps = [
+            end_time - timedelta(seconds=PERIOD * (index + 1))
+            for index in range(points)
+        ]
+        segments = []
+        for query in queries:
+            values = series_values(query["Id"], points)
+            for start in range(0, max(points, 1), CW_MAX_DATAPOINTS):
+                end = start + CW_MAX_DATAPOINTS
+                segments.append(
+                    {
+                        "Id": query["Id"],
+                        "Label": query["Id"],
+                        "Timestamps": timestamps[start:end],
+                        "Values": values[start:end],
+                        "StatusCode": "Complete",
+                    }
+                )
+        pages = [[]]
+        size = 0
+        for segment in segments:
+            if size + len(segment["Values"]) > CW_MAX_DATAPOINTS and pages[-1]:
+                pages.append([])
+                size = 0
+            pages[-1].append(segment)
+            size += len(segment["Values"])
+        return pages
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, NextToken=None):
+        key = (tuple(query["Id"] for query in MetricDataQueries), StartTime, EndTime)
+        if key not in self.pages:
+            self.pages[key] = self.build_pages(MetricDataQueries, StartTime, EndTime)
+        pages = self.pages[key]
+        index = int(NextToken or 0)
+        response = {
+            "MetricDataResults": [
+                dict(
+                    result,
+                    Timestamps=list(result["Timestamps"]),
+                    Values=list(result["Values"]),
+                )
+                for result in pages[index]
+            ],
+            "Messages": [],
+        }
+        if index + 1 < len(pages):
+            response["NextToken"] = str(index + 1)
+        return response
+
+    def describe_alarms(self, AlarmTypes, MaxRecords, AlarmNames=None, NextToken=None):
+        names = AlarmNames or self.alarm_names
+        start = int(NextToken or 0)
+        end = start + MaxRecords
+        response = {
+            "MetricAlarms": [
+                {"AlarmName": name, "StateValue": "OK"} for name in names[start:end]
+            ],
+            "CompositeAlarms": [],
+        }
+        if end < len(names):
+            response["NextToken"] = str(end)
+        return response
+
+    def build_history(self, alarm):
+        items = []
+        for index in range(self.history):
+            old_state, new_state = ("OK", "INSUFFICIENT_DATA")[:: 1 - 2 * (index % 2)]
+            items.append(
+                {
+                    "AlarmName": alarm,
+                    "AlarmType": "MetricAlarm",
+                    "Timestamp": END_TIME - timedelta(seconds=index),
+                    "HistoryItemType": "StateUpdate",
+                    "HistorySummary": f"Alarm updated from {old_state} to {new_state}",
+                    "HistoryData": json.dumps(
+                        {
+                            "version": "1.0",
+                            "oldState": {"stateValue": old_state},
+                            "newState": {"stateValue": new_state},
+                        }
+                    ),
+                }
+            )
+        return items
+
+    def describe_alarm_history(self, AlarmName=None, NextToken=None, **kwargs):
+        if AlarmName not in self.history_items:
+            self.history_items[AlarmName] = self.build_history(AlarmName)
+        items = self.history_items[AlarmName]
+        start = int(NextToken or 0)
+        end = start + HISTORY_PAGE_SIZE
+        response = {"AlarmHistoryItems": [dict(item) for item in items[start:end]]}
+        if end < len(items):
+            response["NextToken"] = str(end)
+        return response
+
+
+class StubResponse:
+    def __init__(self, data):
+        self.data = data
+
+    def stream(self, amt):
+        for start in range(0, len(self.data), amt):
+            end = start + amt
+            yield self.data[start:end]
+
+    def release_conn(self):
+        pass
+
+
+class StubPrometheus:
+    # Replaces the urllib3 pool manager with encoded query_range responses.
+    def __init__(self, series):
+        self.series = series
+        self.responses = {}
+
+    def build_response(self, fields):
+        from chaos_machine.prometheus import parse_prom_duration
+
+        start = datetime.fromisoformat(fields["start"].replace("Z", "+00:00"))
+        end = datetime.fromisoformat(fields["end"].replace("Z", "+00:00"))
+        step = parse_prom_duration(fields["step"])
+        count = int((end - start).total_seconds() // step) + 1
+        timestamps = [start.timestamp() + step * index for index in range(count)]
+        result = []
+        for index in range(self.series):
+            values = series_values(f"{fields['query']}{index}", count)
+            result.append(
+                {
+                    "metric": {"instance": f"instance-{index}"},
+                    "values": [
+                        [timestamp, repr(value)]
+                        for timestamp, value in zip(timestamps, values)
+                    ],
+                }
+            )
+        body = {"status": "success", "data": {"resultType": "matrix", "result": result}}
+        return json.dumps(body).encode("utf-8")
+
+    def request(self, method, url, fields=None, timeout=None, **kwargs):
+        key = tuple(sorted(fields.items()))
+        if key not in self.responses:
+            self.responses[key] = self.build_response(fields)
+        return StubResponse(self.responses[key])
+
+
+def cw_definitions(queries):
+    definitions = []
+    for index in range(queries):
+        definitions.append(
+            {
+                "Id": f"m{index}",
+                "MetricStat": {
+                    "Metric": {
+                        "Namespace": "Benchmark",
+                        "MetricName": f"Metric{index}",
+                    },
+                    "Period": PERIOD,
+                    "Stat": "Average",
+                },
+                "ReturnData": True,
+            }
+        )
+        definitions.append(
+            {
+                "Id": f"e{index}",
+                "Expression": f"IF(m{index} > 2, 0, 1)",
+                "ReturnData": True,
+            }
+        )
+    return definitions
+
+
+def prom_definitions(queries):
+    return [
+        {"Id": f"e{index}", "query": f"e{index}", "step": f"{PERIOD}s"}
+        for index in range(queries)
+    ]
+
+
+def workload_phases(workload):
+    from chaos_machine import clients, prometheus
+    from chaos_machine.cloudwatch import (
+        alarms_entering_state,
+        alarms_in_state,
+        get_alarm_state_histories,
+        get_alarms,
+        get_cw_metrics,
+    )
+    from chaos_machine.metrics import evaluate_metrics, get_definitions
+    from chaos_machine.prometheus import get_prom_metrics
+
+    cloudwatch = StubCloudWatch(workload.get("alarms", 0), workload.get("history", 0))
+    clients.set_client("cloudwatch", cloudwatch)
+    prometheus.http = StubPrometheus(workload.get("series", 1))
+
+    start_time = END_TIME - timedelta(seconds=PERIOD * workload.get("points", 0))
+    queries = workload.get("queries", 0)
+    cw_metrics = cw_definitions(queries)
+    prom_metrics = prom_definitions(queries)
+    alarm_names = cloudwatch.alarm_names
+    results = {}
+
+    def cloudwatch_fetch():
+        results["cloudwatch"] = dict(
+            get_cw_metrics(cw_metrics, start_time, END_TIME, "benchmark"),
+            PrometheusDataResults=[],
+        )
+
+    def cloudwatch_evaluate():
+        evaluate_metrics(results["cloudwatch"], get_definitions(cw_metrics))
+
+    def prometheus_fetch():
+        results["prometheus"] = dict(
+            get_prom_metrics(
+                prom_metrics, start_time, END_TIME, "http://prometheus", "benchmark"
+            ),
+            MetricDataResults=[],
+        )
+
+    def prometheus_evaluate():
+        evaluate_metrics(results["prometheus"], get_definitions(prom_metrics))
+
+    def alarms():
+        alarms_in_state(get_alarms(alarm_names, "benchmark"), ["ALARM"])
+
+    def alarm_history():
+        alarms_entering_state(
+            get_alarm_state_histories(alarm_names, start_time, END_TIME, "benchmark"),
+            "ALARM",
+        )
+
+    return {
+        "cloudwatch_fetch": cloudwatch_fetch,
+        "cloudwatch_evaluate": cloudwatch_evaluate,
+        "prometheus_fetch": prometheus_fetch,
+        "prometheus_evaluate": prometheus_evaluate,
+        "alarms": alarms,
+        "alarm_history": alarm_history,
+    }
+
+
+def measure(function, repeat):
+    # Latency is measured without tracing, then one traced run reports the peak
+    # memory above the starting point and the memory blocks still allocated.
+    function()
+    samples = []
+    for _ in range(repeat):
+        gc.collect()
+        start = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    differences = after.compare_to(before, "filename")
+    return {
+        "latencyMs": {
+            "min": min(samples) * 1000,
+            "median": statistics.median(samples) * 1000,
+            "mean": statistics.fmean(samples) * 1000,
+        },
+        "peakKiB": (peak - current) / 1024,
+        "allocatedBlocks": sum(difference.count_diff for difference in differences),
+        "allocatedKiB": sum(difference.size_diff for difference in differences) / 1024,
+    }
+
+
+def workloads(phase, dimensions, max_samples):
+    names = PHASES[phase]
+    for values in itertools.product(*(dimensions[name] for name in names)):
+        workload = dict(zip(names, values))
+        samples = 1
+        for name in ("queries", "series", "points"):
+            samples *= workload.get(name, 1)
+        samples *= workload.get("alarms", 1) * workload.get("history", 1)
+        yield workload, samples <= max_samples
+
+
+def result_key(result):
+    return (result["phase"],) + tuple(
+        (name, result["workload"][name]) for name in sorted(result["workload"])
+    )
+
+
+def compare(results, baseline_path, tolerance):
+    with open(baseline_path, "r") as f:
+        baseline = {result_key(result): result for result in json.load(f)["results"]}
+    regressions = []
+    print()
+    print(f"{'phase':<22}{'workload':<40}{'median ms':>11}{'change':>9}{'peak':>9}")
+    for result in results:
+        previous = baseline.get(result_key(result))
+        if previous is None:
+            continue
+        latency = result["latencyMs"]["median"] / max(
+            previous["latencyMs"]["median"], 1e-9
+        )
+        peak = result["peakKiB"] / max(previous["peakKiB"], 1e-9)
+        print(
+            f"{result['phase']:<22}{format_workload(result['workload']):<40}"
+            f"{result['latencyMs']['median']:>11.2f}{latency - 1:>+9.0%}{peak - 1:>+9.0%}"
+        )
+        if latency > 1 + tolerance or peak > 1 + tolerance:
+            regressions.append(result)
+    return regressions
+
+
+def format_workload(workload):
+    return " ".join(f"{name}={value}" for name, value in workload.items())
+
+
+def integers(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure the fetch and evaluation hot paths against stubbed responses."
+    )
+    parser.add_argument("--phases", default=",".join(PHASES))
+    parser.add_argument("--queries", type=integers, default=[10, 100, 1000])
+    parser.add_argument("--series", type=integers, default=[1, 10])
+    parser.add_argument("--points", type=integers, default=[60, 1440])
+    parser.add_argument("--alarms", type=integers, default=[10, 100, 1000])
+    parser.add_argument("--history", type=integers, default=[10, 100])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument(
+        "--max-samples",
+        type=int,
+        default=2000000,
+        help="Skip workloads with more datapoints or history items than this.",
+    )
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--compare", help="Compare with the results in this JSON file.")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.2,
+        help="Relative increase in median latency or peak memory reported as a regression.",
+    )
+    args = parser.parse_args()
+
+    sys.path[:0] = [str(root / "lambda" / "layer")]
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    logging.getLogger().setLevel(logging.WARNING)
+
+    dimensions = {
+        "queries": args.queries,
+        "series": args.series,
+        "points": args.points,
+        "alarms": args.alarms,
+        "history": args.history,
+    }
+    results = []
+    print(
+        f"{'phase':<22}{'workload':<40}{'median ms':>11}{'min ms':>10}"
+        f"{'peak KiB':>11}{'blocks':>9}"
+    )
+    for phase in args.phases.split(","):
+        for workload, included in workloads(phase, dimensions, args.max_samples):
+            if not included:
+                print(f"{phase:<22}{format_workload(workload):<40}{'skipped':>11}")
+                continue
+            result = {"phase": phase, "workload": workload}
+            result.update(measure_phase(phase, workload, args.repeat))
+            results.append(result)
+            print(
+                f"{phase:<22}{format_workload(workload):<40}"
+                f"{result['latencyMs']['median']:>11.2f}{result['latencyMs']['min']:>10.2f}"
+                f"{result['peakKiB']:>11.0f}{result['allocatedBlocks']:>9}"
+            )
+
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(
+                {
+                    "python": platform.python_version(),
+                    "platform": platform.platform(),
+                    "timestamp": datetime.now(timezone.utc).isoformat(),
+                    "repeat": args.repeat,
+                    "results": results,
+                },
+                f,
+                indent=2,
+            )
+
+    if args.compare:
+        regressions = compare(results, args.compare, args.tolerance)
+        if regressions:
+            print(f"\n{len(regressions)} regressions above {args.tolerance:.0%}.")
+            sys.exit(1)
+
+
+def measure_phase(phase, workload, repeat):
+    phases = workload_phases(workload)
+    # The evaluation phases evaluate the results of the fetch phase.
+    if phase == "cloudwatch_evaluate":
+        phases["cloudwatch_fetch"]()
+    if phase == "prometheus_evaluate":
+        phases["prometheus_fetch"]()
+    return measure(phases[phase], repeat)
+
+
+if __name__ == "__main__":
+    main()
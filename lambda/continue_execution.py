@@ -3,85 +3,237 @@ import logging
 import os
 import sys
 import traceback
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import boto3
+from botocore.exceptions import ClientError
+from chaos_machine.clients import LazyClient
+from chaos_machine.dynamodb import batch_write
+from chaos_machine.experiments import (
+    event_times,
+    get_experiment_times,
+    parse_event_time,
+)
+from chaos_machine.instrumentation import instrumented
+from chaos_machine.log import Payload
 
 logger = logging.getLogger()
 logger.setLevel(os.getenv("LOG_LEVEL"))
 
-sfn = boto3.client("stepfunctions")
-ddb = boto3.client("dynamodb")
+sfn = LazyClient("stepfunctions")
+ddb = LazyClient("dynamodb")
 
 experiments_table = os.getenv("EXPERIMENTS_TABLE")
 
+FIS_FAILED_STATUSES = ["stopped", "failed"]
+FIS_COMPLETED_STATUSES = ["completed"]
+SSM_FAILED_STATUSES = ["Cancelled", "Failed", "TimedOut"]
+SSM_COMPLETED_STATUSES = ["Success"]
 
-def datetime_handler(x):
-    if isinstance(x, datetime):
-        return x.isoformat()
-    raise TypeError("Unknown type")
+# Returned for a task token whose task is already closed, e.g. after a guardrail
+# stopped the experiment and failed the execution, or for a duplicate event.
+STALE_TOKEN_ERRORS = ["TaskTimedOut", "InvalidToken", "TaskDoesNotExist"]
 
+MAX_WORKERS = int(os.getenv("CONTINUE_EXECUTION_MAX_WORKERS", "10"))
 
-def lambda_handler(event, context):
-    logger.info(
-        f"Event received: {json.dumps(event, default=datetime_handler, indent=4)}"
-    )
-    logger.info(f"boto3 version: {boto3.__version__}")
 
-    try:
-        if event["source"] == "aws.fis":
-            experiment_id = event["detail"]["experiment-id"]
-            experiment_type = "FIS"
-            status = event["detail"]["new-state"]["status"]
-            failed_statuses = ["stopped", "failed"]
-            completed_statuses = ["completed"]
-        elif event["source"] == "aws.ssm":
-            experiment_id = event["detail"]["ExecutionId"]
-            experiment_type = "SSM"
-            status = event["detail"]["Status"]
-            failed_statuses = ["Cancelled", "Failed", "TimedOut"]
-            completed_statuses = ["Success"]
-
-        item = ddb.query(
-            TableName=experiments_table,
-            IndexName=f"{experiments_table}-experimentId",
-            KeyConditionExpression="experimentId = :experimentId",
-            ExpressionAttributeValues={":experimentId": {"S": experiment_id}},
+def parse_event(event):
+    if event["source"] == "aws.fis":
+        status = event["detail"]["new-state"]["status"]
+        experiment = {
+            "experimentId": event["detail"]["experiment-id"],
+            "experimentType": "FIS",
+            "status": status,
+            "failed": status in FIS_FAILED_STATUSES,
+            "completed": status in FIS_COMPLETED_STATUSES,
+        }
+    elif event["source"] == "aws.ssm":
+        status = event["detail"]["Status"]
+        experiment = {
+            "experimentId": event["detail"]["ExecutionId"],
+            "experimentType": "SSM",
+            "status": status,
+            "failed": status in SSM_FAILED_STATUSES,
+            "completed": status in SSM_COMPLETED_STATUSES,
+        }
+    else:
+        raise ValueError(f"Unsupported event source: {event['source']}")
+    experiment["startTime"], experiment["endTime"] = event_times(event)
+    return experiment
+
+
+def experiment_times(experiment, item):
+    # The times come from the event, and the start time of FIS experiments from
+    # the test item. The API is only called for events or items without them,
+    # since completion events arrive in bursts and the lookup throttles.
+    start_time = experiment["startTime"]
+    if start_time is None and "startTime" in item:
+        start_time = parse_event_time(item["startTime"]["S"])
+    end_time = experiment["endTime"]
+    if start_time is None or end_time is None:
+        logger.info(f"Looking up the times of experiment {experiment['experimentId']}")
+        return get_experiment_times(
+            experiment["experimentType"], experiment["experimentId"]
         )
-        logger.info(f"item: {json.dumps(item, default=datetime_handler, indent=4)}")
+    return start_time, end_time
 
-        test_id = item["Items"][0]["testId"]["S"]
-        task_token = item["Items"][0]["taskToken"]["S"]
 
-        if status in failed_statuses:
-            deleted_item = ddb.delete_item(
-                TableName=experiments_table,
-                Key={
-                    "testId": {"S": test_id},
-                    "experimentId": {"S": experiment_id},
-                },
-                ReturnValues="ALL_OLD",
-            )
-            logger.info(
-                f"Deleted item from tests table: {json.dumps(deleted_item['Attributes'], default=datetime_handler, indent=4)}"
-            )
+def get_test(experiment_id):
+    response = ddb.query(
+        TableName=experiments_table,
+        IndexName=f"{experiments_table}-experimentId",
+        KeyConditionExpression="experimentId = :experimentId",
+        ExpressionAttributeValues={":experimentId": {"S": experiment_id}},
+    )
+    logger.info("item: %s", Payload(response))
+    if not response["Items"]:
+        return None
+    return response["Items"][0]
+
+
+def send_task_result(experiment, item):
+    experiment_id = experiment["experimentId"]
+    task_token = item["taskToken"]["S"]
+    try:
+        if experiment["failed"]:
             sfn.send_task_failure(
                 taskToken=task_token,
                 error="ExperimentStoppedOrFailed",
                 cause=json.dumps(
                     {
-                        "errorMessage": f"{experiment_type} experiment {experiment_id} status is {status}.",
+                        "errorMessage": f"{experiment['experimentType']} experiment {experiment_id} status is {experiment['status']}.",
                         "errorType": "ExperimentStoppedOrFailed",
                     }
                 ),
             )
             logger.info(f"Sent task failure for {experiment_id} to Step Functions")
-        elif status in completed_statuses:
+        elif experiment["completed"]:
+            # The timing is passed to the hypothesis evaluation, which can run
+            # several times while metrics are published.
+            start_time, end_time = experiment_times(experiment, item)
             sfn.send_task_success(
                 taskToken=task_token,
-                output=json.dumps({"experimentId": experiment_id}),
+                output=json.dumps(
+                    {
+                        "experimentId": experiment_id,
+                        "experimentType": experiment["experimentType"],
+                        "status": experiment["status"],
+                        "startTime": start_time.isoformat(),
+                        "endTime": end_time.isoformat(),
+                    }
+                ),
             )
             logger.info(f"Sent task success for {experiment_id} to Step Functions")
+    except ClientError as e:
+        code = e.response["Error"]["Code"]
+        if code not in STALE_TOKEN_ERRORS:
+            raise e
+        logger.warning(f"The task for {experiment_id} is already closed: {code}")
+
+
+def notify(experiment):
+    # Returns the test item of the experiment, or None if the experiment was not
+    # started by the chaos machine or its test was already deleted.
+    item = get_test(experiment["experimentId"])
+    if item is None:
+        logger.warning(
+            f"No test found for experiment {experiment['experimentId']}, it was not started by the chaos machine or it was already handled."
+        )
+        return None
+    # The task is notified before the test is deleted, so a retried event is not
+    # lost if the deletion fails.
+    send_task_result(experiment, item)
+    return item
+
+
+def delete_tests(items):
+    # Returns the experiment Ids whose tests could not be deleted.
+    requests = [
+        {
+            "DeleteRequest": {
+                "Key": {"testId": item["testId"], "experimentId": item["experimentId"]}
+            }
+        }
+        for item in items
+    ]
+    unprocessed = batch_write(ddb, experiments_table, requests)
+    logger.info(f"Deleted {len(requests) - len(unprocessed)} items from tests table.")
+    return [
+        request["DeleteRequest"]["Key"]["experimentId"]["S"] for request in unprocessed
+    ]
+
+
+def process_records(records):
+    # Completion events buffered in SQS. Duplicate events are processed once, and
+    # the messages of the experiments that could not be processed are reported so
+    # that only they are retried.
+    failures = set()
+    experiments = {}
+    for record in records:
+        try:
+            experiment = parse_event(json.loads(record["body"]))
+        except Exception as e:
+            logger.error(f"Could not parse message {record['messageId']}: {e}")
+            failures.add(record["messageId"])
+            continue
+        key = (experiment["experimentId"], experiment["status"])
+        experiments.setdefault(key, (experiment, []))[1].append(record["messageId"])
+
+    items = {}
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(len(experiments), MAX_WORKERS))
+    ) as executor:
+        futures = {
+            key: executor.submit(notify, experiment)
+            for key, (experiment, _) in experiments.items()
+        }
+        for key, future in futures.items():
+            try:
+                items[key] = future.result()
+            except Exception as e:
+                logger.error(f"Could not process experiment {key[0]}: {e}")
+                failures.update(experiments[key][1])
+
+    deleted = [
+        item
+        for key, item in items.items()
+        if item is not None and experiments[key][0]["failed"]
+    ]
+    not_deleted = delete_tests(deleted) if deleted else []
+    for key, (_, message_ids) in experiments.items():
+        if key[0] in not_deleted:
+            failures.update(message_ids)
+
+    logger.info(
+        f"Processed {len(records)} messages for {len(experiments)} experiments, {len(failures)} failed."
+    )
+    return {"batchItemFailures": [{"itemIdentifier": id} for id in sorted(failures)]}
+
+
+@instrumented("continue-execution")
+def lambda_handler(event, context):
+    logger.info("Event received: %s", Payload(event))
+    logger.info(f"boto3 version: {boto3.__version__}")
+
+    try:
+        if "Records" in event:
+            return process_records(event["Records"])
+
+        experiment = parse_event(event)
+        item = notify(experiment)
+        if item is not None and experiment["failed"]:
+            deleted_item = ddb.delete_item(
+                TableName=experiments_table,
+                Key={
+                    "testId": item["testId"],
+                    "experimentId": item["experimentId"],
+                },
+                ReturnValues="ALL_OLD",
+            )
+            logger.info(
+                "Deleted item from tests table: %s",
+                Payload(deleted_item.get("Attributes")),
+            )
 
     except Exception as e:
         (
@@ -0,0 +1,344 @@
+import logging
+import math
+import os
+from array import array
+from collections import Counter
+
+from botocore.exceptions import ClientError
+from chaos_machine.clients import LazyClient
+from chaos_machine.dynamodb import batch_get
+from chaos_machine.evaluation import format_labels, to_series
+from chaos_machine.log import Payload
+from chaos_machine.metrics import expressions
+
+logger = logging.getLogger(__name__)
+
+# Baselines learned from the steady state windows of earlier runs of a test, by
+# expression or Prometheus series. Each baseline keeps exponentially weighted
+# moments and a quantile sketch in fixed size arrays, so a new window is merged
+# into it without fetching the windows of earlier runs again.
+BASELINES_TABLE = os.getenv("BASELINES_TABLE")
+
+DEFAULT_BASELINE = {"minRuns": 3, "decay": 0.9, "tolerance": 0}
+
+# Relative accuracy of the quantile sketch, and the number of buckets it keeps for
+# positive and for negative values. Lower buckets are collapsed beyond that.
+SKETCH_ACCURACY = 0.01
+SKETCH_MAX_BUCKETS = 2048
+# Values closer to 0 are counted as 0.
+SKETCH_MIN_VALUE = 1e-9
+
+GAMMA = (1 + SKETCH_ACCURACY) / (1 - SKETCH_ACCURACY)
+LOG_GAMMA = math.log(GAMMA)
+
+ddb = LazyClient("dynamodb")
+
+
+def bucket_key(value):
+    return math.ceil(math.log(value) / LOG_GAMMA)
+
+
+def bucket_value(key):
+    return 2 * GAMMA**key / (GAMMA + 1)
+
+
+class Store:
+    # Counts of the buckets offset to offset + len(counts) - 1.
+    def __init__(self, offset=0, counts=None):
+        self.offset = offset
+        self.counts = counts if counts is not None else array("d")
+
+    def total(self):
+        return math.fsum(self.counts)
+
+    def add(self, key_counts):
+        if not key_counts:
+            return
+        low = min(key_counts)
+        high = max(key_counts)
+        if self.counts:
+            low = min(low, self.offset)
+            high = max(high, self.offset + len(self.counts) - 1)
+        counts = array("d", [0.0]) * (high - low + 1)
+        start = self.offset - low
+        end = start + len(self.counts)
+        counts[start:end] = self.counts
+        for key, count in key_counts.items():
+            counts[key - low] += count
+        if len(counts) > SKETCH_MAX_BUCKETS:
+            collapsed = len(counts) - SKETCH_MAX_BUCKETS
+            head = math.fsum(counts[: collapsed + 1])
+            counts = counts[collapsed:]
+            counts[0] = head
+            low += collapsed
+        self.offset = low
+        self.counts = counts
+
+    def decay(self, factor):
+        self.counts = array("d", (count * factor for count in self.counts))
+
+
+class Sketch:
+    def __init__(self, positive=None, negative=None, zeros=0.0):
+        self.positive = positive or Store()
+        self.negative = negative or Store()
+        self.zeros = zeros
+
+    def count(self):
+        return self.positive.total() + self.negative.total() + self.zeros
+
+    def add(self, values):
+        positive = Counter()
+        negative = Counter()
+        for value in values:
+            if value > SKETCH_MIN_VALUE:
+                positive[bucket_key(value)] += 1
+            elif value < -SKETCH_MIN_VALUE:
+                negative[bucket_key(-value)] += 1
+            else:
+                self.zeros += 1
+        self.positive.add(positive)
+        self.negative.add(negative)
+
+    def decay(self, factor):
+        self.positive.decay(factor)
+        self.negative.decay(factor)
+        self.zeros *= factor
+
+    def quantile(self, q):
+        # Buckets are walked from the lowest value, most negative first.
+        rank = q * (self.count() - 1)
+        seen = 0.0
+        negative = self.negative
+        for index in range(len(negative.counts) - 1, -1, -1):
+            seen += negative.counts[index]
+            if seen > rank:
+                return -bucket_value(negative.offset + index)
+        seen += self.zeros
+        if seen > rank:
+            return 0.0
+        positive = self.positive
+        for index, count in enumerate(positive.counts):
+            seen += count
+            if seen > rank:
+                return bucket_value(positive.offset + index)
+        if positive.counts:
+            return bucket_value(positive.offset + len(positive.counts) - 1)
+        return 0.0
+
+
+class Baseline:
+    def __init__(self, runs=0, count=0.0, mean=0.0, m2=0.0, last=0.0, sketch=None):
+        self.runs = runs
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        # Timestamp of the last datapoint merged, so overlapping windows of
+        # consecutive runs are merged once.
+        self.last = last
+        self.sketch = sketch or Sketch()
+        self.version = 0
+
+    def update(self, values, timestamps, decay):
+        values, timestamps = to_series(values, timestamps)
+        new = [
+            value
+            for value, timestamp in zip(values, timestamps)
+            if timestamp > self.last and value == value
+        ]
+        if not new:
+            return False
+
+        # Older runs weigh less with every update.
+        self.count *= decay
+        self.m2 *= decay
+        self.sketch.decay(decay)
+
+        # The moments of the window are combined with the baseline moments.
+        count = len(new)
+        mean = math.fsum(new) / count
+        m2 = math.fsum((value - mean) ** 2 for value in new)
+        total = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + delta**2 * self.count * count / total
+        self.mean += delta * count / total
+        self.count = total
+        self.sketch.add(new)
+
+        self.runs += 1
+        self.last = max(timestamps)
+        return True
+
+    def stddev(self):
+        return math.sqrt(self.m2 / self.count) if self.count else 0.0
+
+    def bounds(self, settings):
+        # Returns the range of values in the baseline, or None while it has learned
+        # fewer than minRuns windows.
+        if self.runs < settings["minRuns"] or not self.count:
+            return None
+        if "upperQuantile" in settings or "lowerQuantile" in settings:
+            lower = -math.inf
+            upper = math.inf
+            # Quantiles are widened by the accuracy of the sketch, so the values it
+            # has learned are within the bounds.
+            if "lowerQuantile" in settings:
+                lower = self.sketch.quantile(settings["lowerQuantile"] / 100)
+                lower = widen(lower, -2 * SKETCH_ACCURACY)
+            if "upperQuantile" in settings:
+                upper = self.sketch.quantile(settings["upperQuantile"] / 100)
+                upper = widen(upper, 2 * SKETCH_ACCURACY)
+        else:
+            deviation = settings.get("zScore", 3) * self.stddev()
+            lower = self.mean - deviation
+            upper = self.mean + deviation
+        return widen(lower, -settings["tolerance"]), widen(upper, settings["tolerance"])
+
+    @classmethod
+    def from_item(cls, item):
+        baseline = cls(
+            int(item["runs"]["N"]),
+            float(item["count"]["N"]),
+            float(item["mean"]["N"]),
+            float(item["m2"]["N"]),
+            float(item["last"]["N"]),
+            Sketch(
+                Store(int(item["positiveOffset"]["N"]), unpack(item["positive"]["B"])),
+                Store(int(item["negativeOffset"]["N"]), unpack(item["negative"]["B"])),
+                float(item["zeros"]["N"]),
+            ),
+        )
+        baseline.version = int(item["version"]["N"])
+        return baseline
+
+    def to_item(self, test_id, metric_id):
+        return {
+            "testId": {"S": test_id},
+            "metricId": {"S": metric_id},
+            "runs": {"N": str(self.runs)},
+            "count": {"N": repr(self.count)},
+            "mean": {"N": repr(self.mean)},
+            "m2": {"N": repr(self.m2)},
+            "last": {"N": repr(self.last)},
+            "positiveOffset": {"N": str(self.sketch.positive.offset)},
+            "positive": {"B": pack(self.sketch.positive.counts)},
+            "negativeOffset": {"N": str(self.sketch.negative.offset)},
+            "negative": {"B": pack(self.sketch.negative.counts)},
+            "zeros": {"N": repr(self.sketch.zeros)},
+            "version": {"N": str(self.version + 1)},
+        }
+
+    def summary(self):
+        return {
+            "runs": self.runs,
+            "mean": self.mean,
+            "stddev": self.stddev(),
+            "p50": self.sketch.quantile(0.5),
+            "p99": self.sketch.quantile(0.99),
+        }
+
+
+def widen(bound, tolerance):
+    if math.isinf(bound):
+        return bound
+    return bound + tolerance * abs(bound)
+
+
+def pack(counts):
+    # Counts are stored as 32-bit floats.
+    return array("f", counts).tobytes()
+
+
+def unpack(data):
+    counts = array("f")
+    counts.frombytes(bytes(data))
+    return array("d", counts)
+
+
+def baseline_settings(definition):
+    settings = (definition.get("evaluation") or {}).get("baseline")
+    if settings is None:
+        return None
+    return dict(DEFAULT_BASELINE, **settings)
+
+
+def baseline_series(results, definitions):
+    # (key, settings, values, timestamps) of each expression series whose
+    # evaluation has a baseline. Prometheus series are keyed by their labels.
+    series = []
+    for result in expressions(results["MetricDataResults"]):
+        settings = baseline_settings(definitions.get(result["Id"], {}))
+        if settings is not None:
+            series.append(
+                (result["Id"], settings, result["Values"], result["Timestamps"])
+            )
+    for result in expressions(results["PrometheusDataResults"]):
+        settings = baseline_settings(definitions.get(result["Id"], {}))
+        if settings is None:
+            continue
+        for item in result["Series"]:
+            key = f"{result['Id']}{format_labels(item['Labels'])}"
+            series.append((key, settings, item["Values"], item["Timestamps"]))
+    return series
+
+
+def get_baselines(test_id, keys):
+    items = batch_get(
+        ddb,
+        BASELINES_TABLE,
+        [
+            {"testId": {"S": test_id}, "metricId": {"S": key}}
+            for key in sorted(set(keys))
+        ],
+    )
+    return {item["metricId"]["S"]: Baseline.from_item(item) for item in items}
+
+
+def get_bounds(test_id, results, definitions):
+    # Returns the baselines of the series, and the bounds of the baselines that
+    # are used to evaluate them.
+    series = baseline_series(results, definitions)
+    if not series or not BASELINES_TABLE:
+        return {}, {}
+    baselines = get_baselines(test_id, [key for key, *_ in series])
+    bounds = {}
+    for key, settings, _, _ in series:
+        if key in baselines:
+            baseline_bounds = baselines[key].bounds(settings)
+            # The summary walks the quantiles, so it is only built when logged.
+            if logger.isEnabledFor(logging.INFO):
+                logger.info(
+                    "Baseline of %s: %s, bounds: %s",
+                    key,
+                    Payload(baselines[key].summary()),
+                    baseline_bounds,
+                )
+            if baseline_bounds is not None:
+                bounds[key] = baseline_bounds
+    return baselines, bounds
+
+
+def update_baselines(test_id, results, definitions, baselines):
+    # Merges the datapoints of a steady state window into the baselines. A window
+    # whose baseline was updated by another execution at the same time is left out.
+    if not BASELINES_TABLE:
+        return
+    for key, settings, values, timestamps in baseline_series(results, definitions):
+        baseline = baselines.get(key) or Baseline()
+        if not baseline.update(values, timestamps, settings["decay"]):
+            continue
+        try:
+            ddb.put_item(
+                TableName=BASELINES_TABLE,
+                Item=baseline.to_item(test_id, key),
+                ConditionExpression="attribute_not_exists(testId) OR #version = :version",
+                ExpressionAttributeNames={"#version": "version"},
+                ExpressionAttributeValues={":version": {"N": str(baseline.version)}},
+            )
+            logger.info(f"Updated baseline of {key} after {baseline.runs} runs.")
+        except ClientError as e:
+            # The steady state does not fail because a baseline was not updated.
+            if e.response["Error"]["Code"] == "ConditionalCheckFailedException":
+                logger.warning(f"Baseline of {key} was updated by another execution.")
+            else:
+                logger.warning(f"Baseline of {key} could not be updated: {e}")
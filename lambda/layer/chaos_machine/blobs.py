@@ -0,0 +1,35 @@
+from pathlib import Path
+from urllib.parse import urlparse
+
+from chaos_machine.clients import LazyClient
+
+# Objects are stored under a local directory, a file:// URI or an
+# s3://bucket/prefix URI.
+
+s3 = LazyClient("s3")
+
+
+def write_blob(uri, key, body, content_type, content_encoding="gzip"):
+    parsed = urlparse(uri)
+    if parsed.scheme == "s3":
+        object_key = "/".join(part for part in (parsed.path.strip("/"), key) if part)
+        s3.put_object(
+            Bucket=parsed.netloc,
+            Key=object_key,
+            Body=body,
+            ContentType=content_type,
+            ContentEncoding=content_encoding,
+        )
+        return f"s3://{parsed.netloc}/{object_key}"
+    path = Path(parsed.path if parsed.scheme == "file" else uri) / key
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(body)
+    return str(path)
+
+
+def read_blob(uri):
+    parsed = urlparse(uri)
+    if parsed.scheme == "s3":
+        response = s3.get_object(Bucket=parsed.netloc, Key=parsed.path.lstrip("/"))
+        return response["Body"].read()
+    return Path(parsed.path if parsed.scheme == "file" else uri).read_bytes()
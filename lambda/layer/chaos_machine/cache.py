@@ -0,0 +1,174 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import zlib
+
+from chaos_machine import instrumentation
+from chaos_machine.clients import LazyClient
+from chaos_machine.dynamodb import batch_get, batch_write
+from chaos_machine.timing import now
+
+logger = logging.getLogger(__name__)
+
+# Datapoints are cached by query definition and time bucket, so the steady state,
+# guardrail and hypothesis evaluations, their retries, and other tests with the
+# same queries only fetch the buckets that are not cached. Buckets are aligned to
+# the epoch and a multiple of the period or step, and a bucket is cached once it
+# ended QUERY_CACHE_SETTLE seconds ago, when its datapoints are published. Nothing
+# is cached when QUERY_CACHE_TABLE is not set.
+QUERY_CACHE_TABLE = os.getenv("QUERY_CACHE_TABLE")
+QUERY_CACHE_BUCKET = int(os.getenv("QUERY_CACHE_BUCKET", "60"))
+QUERY_CACHE_SETTLE = int(os.getenv("QUERY_CACHE_SETTLE", "180"))
+QUERY_CACHE_TTL = int(os.getenv("QUERY_CACHE_TTL", "86400"))
+
+ddb = LazyClient("dynamodb")
+
+
+def enabled():
+    return bool(QUERY_CACHE_TABLE)
+
+
+def settings():
+    # The settings that decide which buckets are read from the cache, recorded
+    # with a snapshot so that it is replayed with the same requests.
+    return {
+        "table": QUERY_CACHE_TABLE,
+        "bucket": QUERY_CACHE_BUCKET,
+        "settle": QUERY_CACHE_SETTLE,
+    }
+
+
+def configure(settings):
+    global QUERY_CACHE_TABLE, QUERY_CACHE_BUCKET, QUERY_CACHE_SETTLE
+    QUERY_CACHE_TABLE = settings.get("table")
+    QUERY_CACHE_BUCKET = settings.get("bucket", QUERY_CACHE_BUCKET)
+    QUERY_CACHE_SETTLE = settings.get("settle", QUERY_CACHE_SETTLE)
+
+
+def query_id(definition):
+    return hashlib.sha256(
+        json.dumps(definition, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def bucket_key(bucket):
+    # Buckets are numbers, formatted the same way whatever their type.
+    return {"N": repr(float(bucket))}
+
+
+def encode(data):
+    return zlib.compress(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+
+
+def decode(data):
+    return json.loads(zlib.decompress(bytes(data)).decode("utf-8"))
+
+
+class Plan:
+    # The buckets of a window that can be cached, and the ranges to fetch. Times
+    # are epoch seconds, and ranges and buckets are [start, end).
+    def __init__(self, definition, resolution, start, end):
+        self.key = query_id(definition)
+        self.resolution = resolution
+        self.start = start
+        self.end = end
+        self.size = resolution * max(1, math.ceil(QUERY_CACHE_BUCKET / resolution))
+        closed = now().timestamp() - QUERY_CACHE_SETTLE
+        first = math.ceil(start / self.size) * self.size
+        last = min(end, closed)
+        self.buckets = []
+        bucket = first
+        while bucket + self.size <= last:
+            self.buckets.append(bucket)
+            bucket += self.size
+        self.cached = {}
+        self.fetched = {}
+        # Cleared when a response of the plan is not complete, e.g. a partial
+        # CloudWatch result, so none of its buckets are cached.
+        self.complete = True
+
+    def missing(self):
+        # Returns the range to fetch, or none when the window is cached. Cached
+        # buckets between two missing ranges are fetched again, so a window never
+        # costs more than one request.
+        ranges = []
+        cursor = self.start
+        for bucket in self.buckets:
+            if bucket in self.cached:
+                if bucket > cursor:
+                    ranges.append((cursor, bucket))
+                cursor = bucket + self.size
+        if cursor < self.end:
+            ranges.append((cursor, self.end))
+        if len(ranges) > 1:
+            ranges = [(ranges[0][0], ranges[-1][1])]
+        return ranges
+
+    def uncached(self):
+        return [bucket for bucket in self.buckets if bucket not in self.cached]
+
+    def bucket_points(self):
+        # The datapoints or samples of a series in a complete bucket.
+        return max(1, round(self.size / self.resolution))
+
+
+def load(plans):
+    keys = sorted(
+        {(plan.key, bucket) for plan in plans for bucket in plan.buckets},
+    )
+    items = {
+        (item["queryId"]["S"], float(item["bucket"]["N"])): decode(item["data"]["B"])
+        for item in batch_get(
+            ddb,
+            QUERY_CACHE_TABLE,
+            [
+                {"queryId": {"S": key}, "bucket": bucket_key(bucket)}
+                for key, bucket in keys
+            ],
+        )
+    }
+    for plan in plans:
+        for bucket in plan.buckets:
+            if (plan.key, bucket) in items:
+                plan.cached[bucket] = items[(plan.key, bucket)]
+    instrumentation.count("QueryCacheHits", len(items))
+    instrumentation.count("QueryCacheMisses", len(keys) - len(items))
+    logger.info(
+        f"Query cache: {len(items)} of {len(keys)} buckets cached for {len(plans)} queries."
+    )
+
+
+def store(plans, bucket_data):
+    # bucket_data returns the data of a fetched bucket of a plan, or None when a
+    # series of the bucket is missing datapoints, which may still be published
+    # late. Such buckets, and those of incomplete responses, are not cached, so
+    # they are fetched again next time, like the buckets of failed writes.
+    expires_at = str(int(now().timestamp()) + QUERY_CACHE_TTL)
+    requests = []
+    for plan in plans:
+        if not plan.complete:
+            continue
+        for bucket in plan.uncached():
+            data = bucket_data(plan, bucket)
+            if data is None:
+                continue
+            requests.append(
+                {
+                    "PutRequest": {
+                        "Item": {
+                            "queryId": {"S": plan.key},
+                            "bucket": bucket_key(bucket),
+                            "data": {"B": encode(data)},
+                            "expiresAt": {"N": expires_at},
+                        }
+                    }
+                }
+            )
+    try:
+        unprocessed = batch_write(ddb, QUERY_CACHE_TABLE, requests)
+    except Exception as e:
+        logger.warning(f"Query cache could not be written: {e}")
+        return
+    logger.info(f"Query cache: {len(requests) - len(unprocessed)} buckets written.")
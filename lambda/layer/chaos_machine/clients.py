@@ -0,0 +1,127 @@
+import os
+from threading import Lock
+
+import boto3
+import botocore.session
+from botocore.config import Config
+from botocore.credentials import CredentialProvider, DeferredRefreshableCredentials
+from chaos_machine import instrumentation
+
+# AWS_MAX_ATTEMPTS is still honored by botocore when it is set.
+CONFIG = Config(
+    connect_timeout=float(os.getenv("AWS_CONNECT_TIMEOUT", "3")),
+    read_timeout=float(os.getenv("AWS_READ_TIMEOUT", "20")),
+    retries={"mode": os.getenv("AWS_RETRY_MODE", "standard")},
+    max_pool_connections=int(os.getenv("AWS_MAX_POOL_CONNECTIONS", "10")),
+)
+
+# Metrics and alarms can be read from other regions and accounts. A target is a
+# region, a role to assume, or both, and has its own session, whose credentials
+# are refreshed before the role session expires.
+ROLE_SESSION_NAME = os.getenv("ROLE_SESSION_NAME", "chaos-machine")
+
+# Clients are created on first use from one session per target and container, and
+# reused across warm invocations.
+sessions = {}
+clients = {}
+lock = Lock()
+# Stand-in clients also replace the clients of every target.
+stand_ins = {}
+# Records the responses of read operations while a snapshot is taken.
+recorder = None
+
+
+def target_key(target):
+    if not target:
+        return None
+    return (target.get("region"), target.get("roleArn"))
+
+
+def assume_role(role_arn):
+    def refresh():
+        credentials = get_client("sts").assume_role(
+            RoleArn=role_arn, RoleSessionName=ROLE_SESSION_NAME
+        )["Credentials"]
+        return {
+            "access_key": credentials["AccessKeyId"],
+            "secret_key": credentials["SecretAccessKey"],
+            "token": credentials["SessionToken"],
+            "expiry_time": credentials["Expiration"].isoformat(),
+        }
+
+    return refresh
+
+
+class AssumeRoleProvider(CredentialProvider):
+    # Credentials of a role, assumed on the first call of a client of the target
+    # and refreshed before the role session expires.
+    METHOD = "chaos-machine-assume-role"
+
+    def __init__(self, role_arn):
+        super().__init__()
+        self.role_arn = role_arn
+
+    def load(self):
+        return DeferredRefreshableCredentials(assume_role(self.role_arn), self.METHOD)
+
+
+def create_session(target):
+    if not target:
+        return boto3.session.Session()
+    botocore_session = botocore.session.get_session()
+    if target.get("roleArn"):
+        # The provider is resolved before the credentials of the environment.
+        botocore_session.get_component("credential_provider").insert_before(
+            "env", AssumeRoleProvider(target["roleArn"])
+        )
+    return boto3.session.Session(
+        botocore_session=botocore_session, region_name=target.get("region")
+    )
+
+
+def get_client(service_name, target=None):
+    key = target_key(target)
+    client_key = service_name if key is None else (service_name, key)
+    client = clients.get(client_key)
+    if client is None:
+        # Sessions and client creation are not thread safe.
+        with lock:
+            client = clients.get(client_key)
+            if client is None:
+                stand_in = stand_ins.get(service_name)
+                if stand_in is not None and clients.get(service_name) is stand_in:
+                    client = stand_in
+                    if hasattr(stand_in, "for_target"):
+                        client = stand_in.for_target(target)
+                else:
+                    if key not in sessions:
+                        sessions[key] = create_session(target)
+                    client = sessions[key].client(service_name, config=CONFIG)
+                clients[client_key] = client
+    return client
+
+
+def set_client(service_name, client):
+    # Used to run the handlers against stand-in backends, e.g. locally.
+    with lock:
+        clients[service_name] = client
+        stand_ins[service_name] = client
+
+
+def set_recorder(snapshot_recorder):
+    global recorder
+    recorder = snapshot_recorder
+
+
+class LazyClient:
+    def __init__(self, service_name, target=None):
+        self.service_name = service_name
+        self.target = target or None
+
+    def __getattr__(self, name):
+        attribute = getattr(get_client(self.service_name, self.target), name)
+        if recorder is not None:
+            attribute = recorder.wrap(self.service_name, name, attribute, self.target)
+        if instrumentation.current is not None:
+            attribute = instrumentation.wrap(self.service_name, name, attribute)
+        return attribute
@@ -0,0 +1,480 @@
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from chaos_machine import cache, instrumentation
+from chaos_machine.clients import LazyClient, target_key
+from chaos_machine.evaluation import metric_period
+from chaos_machine.log import Payload
+from chaos_machine.timing import to_datetime, to_timestamp
+
+logger = logging.getLogger(__name__)
+
+cw = LazyClient("cloudwatch")
+
+# GetMetricData accepts at most 500 queries per request.
+CW_MAX_QUERIES = 500
+# DescribeAlarms accepts at most 100 alarm names per request.
+CW_MAX_ALARM_NAMES = 100
+CW_MAX_WORKERS = int(os.getenv("CLOUDWATCH_MAX_WORKERS", "5"))
+# Metric math functions whose datapoint at a time only depends on the datapoints
+# of the same time, so that an expression using them can be cached by bucket.
+# Functions over the window, e.g. RATE, DIFF, RUNNING_SUM or FILL, give other
+# values at the edges of a bucket than at the same time in a wider window.
+CW_CACHEABLE_FUNCTIONS = {
+    "ABS",
+    "AND",
+    "CEIL",
+    "FLOOR",
+    "IF",
+    "LOG",
+    "LOG10",
+    "NOT",
+    "OR",
+    "PERIOD",
+}
+CW_FUNCTION = re.compile(r"([A-Za-z_][A-Za-z0-9_]*)\s*\(")
+
+
+def group_cw_metrics(metrics):
+    # Expressions must be sent in the same request as the metrics they reference,
+    # so queries are grouped by reference.
+    ids = [metric["Id"] for metric in metrics]
+    groups = {id: {id} for id in ids}
+    for metric in metrics:
+        expression = metric.get("Expression")
+        if not expression:
+            continue
+        if "METRICS(" in expression.upper():
+            referenced = set(ids)
+        else:
+            referenced = set(re.findall(r"\b[a-z][a-zA-Z0-9_]*\b", expression)) & set(
+                ids
+            )
+        for reference in referenced:
+            merged = groups[metric["Id"]] | groups[reference]
+            for id in merged:
+                groups[id] = merged
+
+    unique = []
+    seen = set()
+    for id in ids:
+        if id not in seen:
+            seen |= groups[id]
+            unique.append(groups[id])
+    return unique
+
+
+def cacheable(definition):
+    # Whether the datapoints of a group of queries can be cached by bucket.
+    return all(
+        function.upper() in CW_CACHEABLE_FUNCTIONS
+        for metric in definition
+        for function in CW_FUNCTION.findall(metric.get("Expression", ""))
+    )
+
+
+def target_name(target):
+    # The account and region of a target, e.g. 111122223333/us-west-2.
+    if not target:
+        return None
+    parts = []
+    if target.get("roleArn"):
+        parts.append(target["roleArn"].split(":")[4])
+    if target.get("region"):
+        parts.append(target["region"])
+    return "/".join(parts)
+
+
+def cw_client(target):
+    # One client per target, created on first use and reused.
+    if not target:
+        return cw
+    return LazyClient("cloudwatch", target)
+
+
+def cw_targets(metrics):
+    # The target of each query, by Id. An expression is sent with the metrics it
+    # references, so a group of queries has at most one target, which is also the
+    # target of the expressions that do not set one.
+    targets = {}
+    for group in group_cw_metrics(metrics):
+        group_targets = {
+            target_key(metric.get("target")): metric.get("target") or None
+            for metric in metrics
+            if metric["Id"] in group and ("target" in metric or "MetricStat" in metric)
+        }
+        if len(group_targets) > 1:
+            raise ValueError(
+                f"Queries {sorted(group)} are sent together but have different targets."
+            )
+        target = next(iter(group_targets.values()), None)
+        targets.update(dict.fromkeys(group, target))
+    return targets
+
+
+def chunk_cw_metrics(metrics):
+    # The groups of queries are packed into API-legal chunks.
+    chunks = []
+    for group in group_cw_metrics(metrics):
+        if len(group) > CW_MAX_QUERIES:
+            raise ValueError(
+                f"Metric {min(group)} and the expressions that reference it exceed {CW_MAX_QUERIES} queries."
+            )
+        for chunk in chunks:
+            if len(chunk) + len(group) <= CW_MAX_QUERIES:
+                chunk |= group
+                break
+        else:
+            chunks.append(set(group))
+
+    return [[metric for metric in metrics if metric["Id"] in chunk] for chunk in chunks]
+
+
+def fetch_cw_metrics(metrics, start_time, end_time, target=None):
+    client = cw_client(target)
+    merged_results = {}
+    messages = []
+    for chunk in chunk_cw_metrics(metrics):
+        kwargs = {
+            "MetricDataQueries": chunk,
+            "StartTime": start_time,
+            "EndTime": end_time,
+        }
+        while True:
+            response = client.get_metric_data(**kwargs)
+            messages.extend(response.get("Messages", []))
+            for result in response["MetricDataResults"]:
+                instrumentation.count("CloudWatchDatapoints", len(result["Values"]))
+                merged_result = merged_results.get(result["Id"])
+                if merged_result is None:
+                    merged_results[result["Id"]] = result
+                    continue
+                merged_result["Timestamps"].extend(result["Timestamps"])
+                merged_result["Values"].extend(result["Values"])
+                merged_result["StatusCode"] = result["StatusCode"]
+                merged_result.setdefault("Messages", []).extend(
+                    result.get("Messages", [])
+                )
+            if "NextToken" not in response:
+                break
+            kwargs["NextToken"] = response["NextToken"]
+
+    return {
+        "MetricDataResults": [
+            merged_results[metric["Id"]]
+            for metric in metrics
+            if metric["Id"] in merged_results
+        ],
+        "Messages": messages,
+    }
+
+
+def cw_bucket_data(plan, bucket):
+    # A bucket is only cached once every query has its datapoints.
+    end = bucket + plan.size
+    data = {
+        id: [
+            [timestamp, value]
+            for timestamp, value in points
+            if bucket <= timestamp < end
+        ]
+        for id, points in plan.points.items()
+    }
+    if any(len(points) < plan.bucket_points() for points in data.values()):
+        return None
+    return data
+
+
+def get_cached_cw_metrics(metrics, start_time, end_time, target=None):
+    # Each group of queries is cached by its definition and target. Groups
+    # missing the same ranges are fetched together. Groups with an expression
+    # that depends on the window are fetched whole, without the cache.
+    plans = []
+    uncached = []
+    for group in group_cw_metrics(metrics):
+        definition = [metric for metric in metrics if metric["Id"] in group]
+        if not cacheable(definition):
+            uncached.extend(definition)
+            continue
+        resolution = max(metric_period(metric) or 60 for metric in definition)
+        plan = cache.Plan(
+            {"target": target, "queries": definition} if target else definition,
+            resolution,
+            start_time.timestamp(),
+            end_time.timestamp(),
+        )
+        plan.definition = definition
+        plan.points = {metric["Id"]: [] for metric in definition}
+        plans.append(plan)
+    cache.load(plans)
+
+    ranges = {}
+    for plan in plans:
+        for bucket, data in plan.cached.items():
+            for id, points in data.items():
+                plan.points[id].extend(points)
+        for missing in plan.missing():
+            ranges.setdefault(missing, []).append(plan)
+
+    labels = {}
+    status_codes = {}
+    messages = []
+    for (start, end), range_plans in ranges.items():
+        response = fetch_cw_metrics(
+            [metric for plan in range_plans for metric in plan.definition],
+            to_datetime(start),
+            to_datetime(end),
+            target,
+        )
+        messages.extend(response["Messages"])
+        for result in response["MetricDataResults"]:
+            labels[result["Id"]] = result.get("Label")
+            if result["StatusCode"] != "Complete":
+                status_codes[result["Id"]] = result["StatusCode"]
+                for plan in range_plans:
+                    if result["Id"] in plan.points:
+                        plan.complete = False
+            for plan in range_plans:
+                if result["Id"] in plan.points:
+                    plan.points[result["Id"]].extend(
+                        zip(
+                            map(to_timestamp, result["Timestamps"]),
+                            result["Values"],
+                        )
+                    )
+    cache.store(plans, cw_bucket_data)
+
+    # Results are returned newest first, like GetMetricData.
+    results = []
+    if uncached:
+        response = fetch_cw_metrics(uncached, start_time, end_time, target)
+        messages.extend(response["Messages"])
+        results.extend(response["MetricDataResults"])
+    for plan in plans:
+        for id, points in plan.points.items():
+            # A datapoint at the boundary of a cached bucket is kept once.
+            values = dict(points)
+            timestamps = sorted(values, reverse=True)
+            results.append(
+                {
+                    "Id": id,
+                    "Label": labels.get(id, id),
+                    "Timestamps": [to_datetime(timestamp) for timestamp in timestamps],
+                    "Values": [values[timestamp] for timestamp in timestamps],
+                    "StatusCode": status_codes.get(id, "Complete"),
+                }
+            )
+    order = {metric["Id"]: index for index, metric in enumerate(metrics)}
+    results.sort(key=lambda result: order[result["Id"]])
+    return {"MetricDataResults": results, "Messages": messages}
+
+
+def get_cw_metrics(metrics, start_time, end_time, type, windows=None):
+    # windows are the aligned windows of the queries, by Id. Queries with the
+    # same target and window are fetched together, and the targets and windows
+    # concurrently.
+    windows = windows or {}
+    targets = cw_targets(metrics)
+    # The evaluation settings and target are not part of the GetMetricData query.
+    metrics = [
+        {
+            key: value
+            for key, value in metric.items()
+            if key not in ("evaluation", "target")
+        }
+        for metric in metrics
+    ]
+    requests = {}
+    for metric in metrics:
+        target = targets[metric["Id"]]
+        window = windows.get(metric["Id"], (start_time, end_time))
+        requests.setdefault((target_key(target), window), (target, window, []))[
+            2
+        ].append(metric)
+
+    def fetch(request):
+        target, (window_start, window_end), request_metrics = request
+        logger.info(
+            f"Retrieving metrics from {target_name(target) or 'this account'} from {window_start} to {window_end}."
+        )
+        if cache.enabled():
+            return get_cached_cw_metrics(
+                request_metrics, window_start, window_end, target
+            )
+        return fetch_cw_metrics(request_metrics, window_start, window_end, target)
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(len(requests), CW_MAX_WORKERS))
+    ) as executor:
+        responses = list(executor.map(fetch, requests.values()))
+    results = {
+        result["Id"]: result
+        for response in responses
+        for result in response["MetricDataResults"]
+    }
+    response = {
+        "MetricDataResults": [
+            results[metric["Id"]] for metric in metrics if metric["Id"] in results
+        ],
+        "Messages": [
+            message for response in responses for message in response["Messages"]
+        ],
+    }
+    logger.info("%s CloudWatch metrics: %s", type, Payload(response))
+    return response
+
+
+def group_alarms(alarms):
+    # Alarm names by target. An alarm is a name, or an object with an optional
+    # alarmName and a target. A target without names returns all its alarms.
+    groups = {}
+    for alarm in alarms:
+        if isinstance(alarm, str):
+            alarm = {"alarmName": alarm}
+        target = alarm.get("target") or None
+        names = groups.setdefault(target_key(target), (target, []))[1]
+        if alarm.get("alarmName"):
+            names.append(alarm["alarmName"])
+    return list(groups.values()) or [(None, [])]
+
+
+def alarm_label(alarm_name, name):
+    # Alarms of other targets are named with their account and region.
+    if not name:
+        return alarm_name
+    return f"{alarm_name} ({name})"
+
+
+def describe_alarms(alarm_names, target=None):
+    client = cw_client(target)
+    kwargs = {"AlarmTypes": ["MetricAlarm", "CompositeAlarm"], "MaxRecords": 100}
+    if alarm_names:
+        kwargs["AlarmNames"] = alarm_names
+    response = {"MetricAlarms": [], "CompositeAlarms": []}
+    while True:
+        page = client.describe_alarms(**kwargs)
+        response["MetricAlarms"].extend(page.get("MetricAlarms", []))
+        response["CompositeAlarms"].extend(page.get("CompositeAlarms", []))
+        if "NextToken" not in page:
+            return response
+        kwargs["NextToken"] = page["NextToken"]
+
+
+def get_alarms(alarms, type):
+    # DescribeAlarms accepts at most 100 alarm names per request. An empty list
+    # returns all alarms in the account. The alarms of other targets are tagged
+    # with the account and region of the target.
+    chunks = []
+    for target, names in group_alarms(alarms):
+        for start in range(0, len(names), CW_MAX_ALARM_NAMES):
+            end = start + CW_MAX_ALARM_NAMES
+            chunks.append((target, names[start:end]))
+        if not names:
+            chunks.append((target, []))
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(len(chunks), CW_MAX_WORKERS))
+    ) as executor:
+        pages = list(
+            executor.map(lambda chunk: describe_alarms(chunk[1], chunk[0]), chunks)
+        )
+    response = {"MetricAlarms": [], "CompositeAlarms": []}
+    for (target, _), page in zip(chunks, pages):
+        for key in ("MetricAlarms", "CompositeAlarms"):
+            for alarm in page[key]:
+                if target:
+                    alarm["Target"] = target_name(target)
+                response[key].append(alarm)
+    logger.info("%s alarms: %s", type, Payload(response))
+    return response
+
+
+def get_alarm_state_history(alarm, start_time, end_time, type, target=None):
+    client = cw_client(target)
+    logger.info(f"Retrieving alarm history from {start_time} to {end_time}.")
+    kwargs = {
+        "AlarmTypes": ["MetricAlarm", "CompositeAlarm"],
+        "HistoryItemType": "StateUpdate",
+        "StartDate": start_time,
+        "EndDate": end_time,
+    }
+    # Without an alarm name, the history of every alarm in the account is returned.
+    if alarm:
+        kwargs["AlarmName"] = alarm
+    response = {"AlarmHistoryItems": []}
+    while True:
+        page = client.describe_alarm_history(**kwargs)
+        response["AlarmHistoryItems"].extend(page["AlarmHistoryItems"])
+        if "NextToken" not in page:
+            break
+        kwargs["NextToken"] = page["NextToken"]
+    logger.info(
+        "%s alarm %s history: %s",
+        type,
+        alarm_label(alarm or "*", target_name(target)),
+        Payload(response),
+    )
+    return response
+
+
+def alarm_state_transition(alarm_history_item):
+    history_data = json.loads(alarm_history_item.get("HistoryData") or "{}")
+    return (
+        history_data.get("oldState", {}).get("stateValue"),
+        history_data.get("newState", {}).get("stateValue"),
+    )
+
+
+def get_alarm_state_histories(alarms, start_time, end_time, type):
+    # Returns the history items of each alarm. A target without alarm names, or
+    # an empty list, returns the history of every alarm of the target with a
+    # single paginated query. Targets are queried concurrently.
+    requests = []
+    for target, names in group_alarms(alarms):
+        requests += [(target, name) for name in names] or [(target, None)]
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(len(requests), CW_MAX_WORKERS))
+    ) as executor:
+        alarm_histories = executor.map(
+            lambda request: get_alarm_state_history(
+                request[1], start_time, end_time, type, request[0]
+            ),
+            requests,
+        )
+        alarm_history_items = {}
+        for (target, alarm), alarm_history in zip(requests, alarm_histories):
+            name = target_name(target)
+            if alarm:
+                alarm_history_items[alarm_label(alarm, name)] = alarm_history[
+                    "AlarmHistoryItems"
+                ]
+                continue
+            for alarm_history_item in alarm_history["AlarmHistoryItems"]:
+                alarm_history_items.setdefault(
+                    alarm_label(alarm_history_item["AlarmName"], name), []
+                ).append(alarm_history_item)
+        return alarm_history_items
+
+
+def alarms_in_state(alarms, states):
+    return [
+        alarm_label(alarm["AlarmName"], alarm.get("Target"))
+        for alarm in alarms["CompositeAlarms"] + alarms["MetricAlarms"]
+        if alarm["StateValue"] in states
+    ]
+
+
+def alarms_entering_state(alarm_history_items, state):
+    # Alarms that transitioned into the state from any other state.
+    entering = []
+    for alarm, items in alarm_history_items.items():
+        for alarm_history_item in items:
+            old_state, new_state = alarm_state_transition(alarm_history_item)
+            if new_state == state and old_state != state:
+                logger.info(f"Alarm {alarm} was updated from {old_state} to {state}.")
+                entering.append(alarm)
+                break
+    return entering
@@ -0,0 +1,60 @@
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+# BatchGetItem accepts at most 100 keys, and BatchWriteItem 25 requests.
+DDB_MAX_BATCH_GET = 100
+DDB_MAX_BATCH_WRITE = 25
+# Unprocessed keys and requests are sent again, with backoff, up to this many
+# attempts in total.
+DDB_BATCH_ATTEMPTS = 5
+
+
+def backoff(attempt):
+    if attempt < DDB_BATCH_ATTEMPTS - 1:
+        time.sleep(0.05 * 2**attempt)
+
+
+def batch_get(client, table, keys):
+    # Returns the items of the keys that exist. Keys still unprocessed after the
+    # last attempt are logged and left out, like keys without an item.
+    items = []
+    unprocessed = []
+    for start in range(0, len(keys), DDB_MAX_BATCH_GET):
+        end = start + DDB_MAX_BATCH_GET
+        pending = {table: {"Keys": keys[start:end]}}
+        for attempt in range(DDB_BATCH_ATTEMPTS):
+            response = client.batch_get_item(RequestItems=pending)
+            items += response["Responses"].get(table, [])
+            pending = response.get("UnprocessedKeys", {})
+            if not pending:
+                break
+            backoff(attempt)
+        unprocessed += pending.get(table, {}).get("Keys", [])
+    if unprocessed:
+        logger.warning(
+            f"{len(unprocessed)} of {len(keys)} keys of {table} were not read after {DDB_BATCH_ATTEMPTS} attempts."
+        )
+    return items
+
+
+def batch_write(client, table, requests):
+    # Returns the requests still unprocessed after the last attempt, which are
+    # logged.
+    unprocessed = []
+    for start in range(0, len(requests), DDB_MAX_BATCH_WRITE):
+        end = start + DDB_MAX_BATCH_WRITE
+        pending = {table: requests[start:end]}
+        for attempt in range(DDB_BATCH_ATTEMPTS):
+            response = client.batch_write_item(RequestItems=pending)
+            pending = response.get("UnprocessedItems", {})
+            if not pending:
+                break
+            backoff(attempt)
+        unprocessed += pending.get(table, [])
+    if unprocessed:
+        logger.warning(
+            f"{len(unprocessed)} of {len(requests)} requests to {table} were not processed after {DDB_BATCH_ATTEMPTS} attempts."
+        )
+    return unprocessed
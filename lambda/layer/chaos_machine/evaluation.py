@@ -0,0 +1,258 @@
+import math
+import operator
+import re
+from array import array
+from datetime import datetime
+from itertools import compress, repeat
+
+COMPARISON_OPERATORS = {
+    "EqualToThreshold": operator.eq,
+    "GreaterThanOrEqualToThreshold": operator.ge,
+    "GreaterThanThreshold": operator.gt,
+    "LessThanThreshold": operator.lt,
+    "LessThanOrEqualToThreshold": operator.le,
+}
+
+# An expression series breaches when a datapoint is false (0), and any breach
+# fails the series, unless the metric definition specifies an evaluation. An
+# evaluation without a predicate also fails the series on any breach.
+DEFAULT_EVALUATION = {"breachRatio": 0}
+
+PREDICATES = {}
+
+BREACH = b"\x01"
+NOT_BREACH = b"\x00"
+BREACH_RUN = re.compile(b"\x01+")
+
+
+def predicate(name):
+    def register(function):
+        PREDICATES[name] = function
+        return function
+
+    return register
+
+
+def to_array(values):
+    if isinstance(values, array):
+        return values
+    return array("d", values)
+
+
+def to_epoch_array(timestamps):
+    if isinstance(timestamps, array):
+        return timestamps
+    timestamps = list(timestamps)
+    if timestamps and isinstance(timestamps[0], datetime):
+        return array("d", map(datetime.timestamp, timestamps))
+    return array("d", timestamps)
+
+
+def to_series(values, timestamps=None):
+    values = to_array(values)
+    timestamps = to_epoch_array(timestamps) if timestamps is not None else None
+    # CloudWatch returns datapoints newest first by default.
+    if timestamps and len(timestamps) > 1 and timestamps[0] > timestamps[-1]:
+        values = array("d", reversed(values))
+        timestamps = array("d", reversed(timestamps))
+    return values, timestamps
+
+
+def gap_lengths(timestamps, period):
+    # Number of datapoints missing after each index, for gaps wider than a period.
+    if not period or not timestamps or len(timestamps) < 2:
+        return {}
+    deltas = map(operator.sub, timestamps[1:], timestamps[:-1])
+    return {
+        index: round(delta / period) - 1
+        for index, delta in enumerate(deltas)
+        if delta > period * 1.5
+    }
+
+
+def breach_mask(values, timestamps, evaluation, period, bounds=None):
+    missing_data = evaluation.get("missingData", "ignore")
+
+    # NaN is the only value that is not equal to itself.
+    missing = bytes(map(operator.ne, values, values))
+    if bounds is not None:
+        # Datapoints outside the bounds of the baseline breach.
+        lower, upper = bounds
+        mask = bytes(
+            map(
+                operator.or_,
+                map(operator.lt, values, repeat(lower)),
+                map(operator.gt, values, repeat(upper)),
+            )
+        )
+    else:
+        comparison = COMPARISON_OPERATORS[
+            evaluation.get("comparisonOperator", "EqualToThreshold")
+        ]
+        threshold = evaluation.get("threshold", 0)
+        mask = bytes(map(comparison, values, repeat(threshold)))
+    # NaN datapoints only count through the missing data policy, the values
+    # returned, e.g. for the percentile, never include them.
+    missing_count = missing.count(1)
+    if missing_count:
+        present = bytes(map(operator.not_, missing))
+        if missing_data == "breaching":
+            mask = bytes(map(operator.or_, mask, missing))
+        elif missing_data == "ignore":
+            mask = bytes(compress(mask, present))
+        values = array("d", compress(values, present))
+
+    gaps = gap_lengths(timestamps, period)
+    if gaps and missing_data != "ignore":
+        fill = BREACH if missing_data == "breaching" else NOT_BREACH
+        segments = []
+        start = 0
+        for index, length in sorted(gaps.items()):
+            end = index + 1
+            segments.append(mask[start:end])
+            segments.append(fill * length)
+            start = end
+        segments.append(mask[start:])
+        mask = b"".join(segments)
+    missing_count += sum(gaps.values())
+
+    return values, mask, missing_count
+
+
+@predicate("breachRatio")
+def breach_ratio(values, mask, parameter, verdict):
+    ratio = verdict["Breaches"] / len(mask) if mask else 0
+    verdict["BreachRatio"] = ratio
+    return ratio > parameter
+
+
+@predicate("consecutiveBreaches")
+def consecutive_breaches(values, mask, parameter, verdict):
+    verdict["MaxConsecutiveBreaches"] = max(
+        map(len, BREACH_RUN.findall(mask)), default=0
+    )
+    return BREACH * parameter in mask
+
+
+@predicate("percentile")
+def percentile(values, mask, parameter, verdict):
+    if not values:
+        return False
+    ordered = sorted(values)
+    rank = max(0, math.ceil(parameter["percentile"] / 100 * len(ordered)) - 1)
+    value = ordered[rank]
+    verdict["Percentile"] = {"percentile": parameter["percentile"], "value": value}
+    comparison = COMPARISON_OPERATORS[parameter["comparisonOperator"]]
+    return comparison(value, parameter["threshold"])
+
+
+def no_data_status(evaluation):
+    # A series without datapoints fails unless missing data is not breaching.
+    if evaluation and evaluation.get("missingData") == "notBreaching":
+        return "Ok"
+    return "NoData"
+
+
+def evaluate_series(
+    id, values, timestamps=None, evaluation=None, period=None, bounds=None
+):
+    evaluation = evaluation or DEFAULT_EVALUATION
+    values, timestamps = to_series(values, timestamps)
+    verdict = {"Id": id, "Points": len(values)}
+    if not values:
+        verdict["Status"] = no_data_status(evaluation)
+        return verdict
+
+    if bounds is not None:
+        verdict["Baseline"] = {"Lower": bounds[0], "Upper": bounds[1]}
+    # An evaluation or baseline without a predicate fails the series on any breach.
+    if not any(name in evaluation for name in PREDICATES):
+        evaluation = dict(evaluation, **DEFAULT_EVALUATION)
+
+    values, mask, missing_count = breach_mask(
+        values, timestamps, evaluation, period, bounds
+    )
+    verdict["Missing"] = missing_count
+    verdict["Breaches"] = mask.count(1)
+    if values:
+        verdict["Min"] = min(values)
+        verdict["Max"] = max(values)
+
+    verdict["FailedPredicates"] = [
+        name
+        for name, function in PREDICATES.items()
+        if name in evaluation and function(values, mask, evaluation[name], verdict)
+    ]
+    verdict["Status"] = "Breaching" if verdict["FailedPredicates"] else "Ok"
+    return verdict
+
+
+def metric_period(metric):
+    if "MetricStat" in metric:
+        return metric["MetricStat"].get("Period")
+    return metric.get("Period")
+
+
+def evaluate_cw_results(results, definitions, bounds=None, resolutions=None):
+    # resolutions are the periods of the queries by Id, since an expression
+    # usually has no Period of its own and takes those of its metrics.
+    bounds = bounds or {}
+    resolutions = resolutions or {}
+    verdicts = []
+    for result in results:
+        definition = definitions.get(result["Id"], {})
+        verdicts.append(
+            evaluate_series(
+                result["Id"],
+                result["Values"],
+                result["Timestamps"],
+                definition.get("evaluation"),
+                resolutions.get(result["Id"]) or metric_period(definition),
+                bounds.get(result["Id"]),
+            )
+        )
+    return verdicts
+
+
+def evaluate_prom_results(results, definitions, parse_step, bounds=None):
+    bounds = bounds or {}
+    verdicts = []
+    for result in results:
+        definition = definitions.get(result["Id"], {})
+        step = definition.get("step")
+        if not result["Series"]:
+            verdicts.append(
+                {
+                    "Id": result["Id"],
+                    "Points": 0,
+                    "Status": no_data_status(definition.get("evaluation")),
+                }
+            )
+        for series in result["Series"]:
+            verdict = evaluate_series(
+                result["Id"],
+                series["Values"],
+                series["Timestamps"],
+                definition.get("evaluation"),
+                parse_step(step) if step is not None else None,
+                bounds.get(f"{result['Id']}{format_labels(series['Labels'])}"),
+            )
+            verdict["Labels"] = series["Labels"]
+            verdicts.append(verdict)
+    return verdicts
+
+
+def format_labels(labels):
+    return "{" + ", ".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+
+def verdict_name(verdict):
+    if "Labels" in verdict:
+        return f"{verdict['Id']}{format_labels(verdict['Labels'])}"
+    return verdict["Id"]
+
+
+def failed_verdicts(verdicts, statuses=("Breaching", "NoData")):
+    return [
+        verdict_name(verdict) for verdict in verdicts if verdict["Status"] in statuses
+    ]
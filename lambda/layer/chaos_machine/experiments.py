@@ -0,0 +1,56 @@
+import logging
+from datetime import datetime, timezone
+
+from chaos_machine.clients import LazyClient
+
+logger = logging.getLogger(__name__)
+
+fis = LazyClient("fis")
+ssm = LazyClient("ssm")
+
+# SSM automation status change events format their times like "Nov 29, 2016
+# 2:06:48 AM", in UTC.
+SSM_EVENT_TIME_FORMAT = "%b %d, %Y %I:%M:%S %p"
+
+
+def get_experiment_times(experiment_type, experiment_id):
+    # Returns the start and end time of a FIS experiment or SSM automation.
+    if experiment_type == "FIS":
+        response = fis.get_experiment(id=experiment_id)
+        return response["experiment"]["startTime"], response["experiment"]["endTime"]
+
+    response = ssm.describe_automation_executions(
+        Filters=[{"Key": "ExecutionId", "Values": [experiment_id]}]
+    )
+    execution = response["AutomationExecutionMetadataList"][0]
+    return execution["ExecutionStartTime"], execution["ExecutionEndTime"]
+
+
+def parse_event_time(value):
+    # Returns None for a missing or unknown time, so the caller can fall back to
+    # the API.
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(value, SSM_EVENT_TIME_FORMAT).replace(
+            tzinfo=timezone.utc
+        )
+    except ValueError:
+        logger.warning(f"Unknown event time format: {value}")
+        return None
+
+
+def event_times(event):
+    # The start and end time of the experiment in a FIS or SSM state change event,
+    # or None where the event does not have them. FIS events have no start time,
+    # and the end time of FIS experiments is the time of the event.
+    if event["source"] == "aws.fis":
+        return None, parse_event_time(event.get("time"))
+    return (
+        parse_event_time(event["detail"].get("StartTime")),
+        parse_event_time(event["detail"].get("EndTime")),
+    )
@@ -0,0 +1,190 @@
+import json
+import logging
+import os
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from functools import wraps
+from threading import Lock
+
+from chaos_machine.timing import now
+
+logger = logging.getLogger(__name__)
+
+# Each invocation of a Lambda function emits the time spent in its calls and
+# evaluations, the number of datapoints and series it processed, and its peak
+# memory, as one CloudWatch Embedded Metric Format (EMF) log line. INSTRUMENTATION
+# selects the sink: "emf" writes the lines to stdout, "memory" keeps them, e.g.
+# for local runs, and nothing is measured when it is not set.
+INSTRUMENTATION = os.getenv("INSTRUMENTATION")
+INSTRUMENTATION_NAMESPACE = os.getenv("INSTRUMENTATION_NAMESPACE", "ChaosMachine")
+
+# Metric name prefixes of the AWS services whose calls are timed.
+SERVICE_NAMES = {
+    "cloudwatch": "CloudWatch",
+    "dynamodb": "DynamoDB",
+    "fis": "FIS",
+    "s3": "S3",
+    "ssm": "SSM",
+    "stepfunctions": "StepFunctions",
+}
+
+# EMF documents accept at most 100 metrics.
+EMF_MAX_METRICS = 100
+
+
+class EMFSink:
+    def emit(self, document):
+        sys.stdout.write(json.dumps(document, separators=(",", ":")) + "\n")
+        sys.stdout.flush()
+
+
+class MemorySink:
+    def __init__(self):
+        self.documents = []
+
+    def emit(self, document):
+        self.documents.append(document)
+
+
+def create_sink(name):
+    if name == "emf":
+        return EMFSink()
+    if name == "memory":
+        return MemorySink()
+    return None
+
+
+sink = create_sink(INSTRUMENTATION)
+# The measurements of the running invocation, shared with the threads it starts.
+current = None
+
+
+def set_sink(instrumentation_sink):
+    global sink
+    sink = instrumentation_sink
+
+
+class Invocation:
+    def __init__(self, function_name):
+        self.function_name = function_name
+        self.lock = Lock()
+        self.values = {}
+        self.units = {}
+        self.properties = {}
+
+    def add(self, name, value, unit):
+        with self.lock:
+            self.values[name] = self.values.get(name, 0) + value
+            self.units[name] = unit
+
+    def document(self):
+        names = sorted(self.values)[:EMF_MAX_METRICS]
+        return dict(
+            self.properties,
+            _aws={
+                "Timestamp": int(now().timestamp() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": INSTRUMENTATION_NAMESPACE,
+                        "Dimensions": [["Function"]],
+                        "Metrics": [
+                            {"Name": name, "Unit": self.units[name]} for name in names
+                        ],
+                    }
+                ],
+            },
+            Function=self.function_name,
+            **{name: self.values[name] for name in names},
+        )
+
+
+def count(name, value):
+    if current is not None:
+        current.add(name, value, "Count")
+
+
+@contextmanager
+def timer(name):
+    # Adds the time spent in the block to {name}Time, and counts the calls of the
+    # block in {name}Calls. Blocks running in threads add up.
+    if current is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        current.add(
+            f"{name}Time", (time.perf_counter() - started) * 1000, "Milliseconds"
+        )
+        current.add(f"{name}Calls", 1, "Count")
+
+
+def wrap(service_name, operation, function):
+    name = SERVICE_NAMES.get(service_name)
+    if name is None or current is None or not callable(function):
+        return function
+
+    @wraps(function)
+    def timed(*args, **kwargs):
+        with timer(name):
+            return function(*args, **kwargs)
+
+    return timed
+
+
+def peak_memory():
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def test_id_of(event):
+    # The test Id is a property of the log line, to find the invocations of a test.
+    if not isinstance(event, dict):
+        return None
+    test_input = event.get("Input") if isinstance(event.get("Input"), dict) else event
+    if "testId" not in test_input:
+        return None
+    return str(test_input["testId"])
+
+
+def instrumented(handler):
+    # Measures an invocation of a Lambda handler and emits the measurements when
+    # it returns or raises.
+    def decorator(function):
+        @wraps(function)
+        def wrapper(event, context):
+            global current
+            if sink is None:
+                return function(event, context)
+            invocation = Invocation(os.getenv("AWS_LAMBDA_FUNCTION_NAME", handler))
+            test_id = test_id_of(event)
+            if test_id is not None:
+                invocation.properties["TestId"] = test_id
+            previous = current
+            current = invocation
+            started = time.perf_counter()
+            try:
+                return function(event, context)
+            finally:
+                current = previous
+                invocation.add(
+                    "Duration", (time.perf_counter() - started) * 1000, "Milliseconds"
+                )
+                invocation.add("MaxMemoryUsed", peak_memory(), "Megabytes")
+                if hasattr(context, "get_remaining_time_in_millis"):
+                    invocation.add(
+                        "RemainingTime",
+                        context.get_remaining_time_in_millis(),
+                        "Milliseconds",
+                    )
+                try:
+                    sink.emit(invocation.document())
+                except Exception as e:
+                    logger.warning(f"Measurements could not be emitted: {e}")
+
+        return wrapper
+
+    return decorator
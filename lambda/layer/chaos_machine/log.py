@@ -0,0 +1,71 @@
+import json
+import os
+from array import array
+from datetime import datetime, timezone
+
+# Series with more datapoints than this are logged as a summary, unless
+# LOG_FULL_PAYLOADS is set to true.
+LOG_MAX_POINTS = int(os.getenv("LOG_MAX_POINTS", "20"))
+LOG_FULL_PAYLOADS = os.getenv("LOG_FULL_PAYLOADS", "false").lower() == "true"
+
+
+def default(x):
+    if isinstance(x, datetime):
+        return x.isoformat()
+    if isinstance(x, array):
+        return x.tolist()
+    raise TypeError("Unknown type")
+
+
+def to_isoformat(timestamp):
+    if isinstance(timestamp, datetime):
+        return timestamp.isoformat()
+    return datetime.fromtimestamp(timestamp, timezone.utc).isoformat()
+
+
+def summarize_series(values, timestamps):
+    summary = {"Count": len(values)}
+    # NaN is the only value that is not equal to itself.
+    present = [value for value in values if value == value]
+    if present:
+        summary["Min"] = min(present)
+        summary["Max"] = max(present)
+    if timestamps:
+        # CloudWatch returns datapoints newest first by default.
+        first, last = sorted((timestamps[0], timestamps[-1]))
+        summary["FirstTimestamp"] = to_isoformat(first)
+        summary["LastTimestamp"] = to_isoformat(last)
+    return summary
+
+
+def summarize(value):
+    if isinstance(value, dict):
+        values = value.get("Values")
+        if isinstance(values, (list, array)) and len(values) > LOG_MAX_POINTS:
+            summary = {
+                key: summarize(item)
+                for key, item in value.items()
+                if key not in ("Values", "Timestamps")
+            }
+            summary["Summary"] = summarize_series(values, value.get("Timestamps"))
+            return summary
+        return {key: summarize(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [summarize(item) for item in value]
+    return value
+
+
+def dumps(value):
+    if not LOG_FULL_PAYLOADS:
+        value = summarize(value)
+    return json.dumps(value, default=default, separators=(",", ":"))
+
+
+class Payload:
+    # Serialized only when the record is emitted, e.g.
+    # logger.info("Event received: %s", Payload(event))
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return dumps(self.value)
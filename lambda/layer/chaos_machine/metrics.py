@@ -0,0 +1,260 @@
+import logging
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from chaos_machine import instrumentation
+from chaos_machine.cloudwatch import get_cw_metrics, group_cw_metrics
+from chaos_machine.evaluation import (
+    evaluate_cw_results,
+    evaluate_prom_results,
+    format_labels,
+    metric_period,
+)
+from chaos_machine.log import Payload
+from chaos_machine.prometheus import get_prom_metrics, parse_prom_duration
+from chaos_machine.timing import aligned_window, time_floor, to_datetime
+
+logger = logging.getLogger(__name__)
+
+
+def filter_metrics(metrics, metric_format, type):
+    # The definitions in the event are left unchanged.
+    filtered_metrics = [
+        dict(metric)
+        for metric in metrics
+        if metric.get("metricFormat", "CloudWatch") == metric_format
+    ]
+    for metric in filtered_metrics:
+        metric.pop("metricFormat", None)
+        if metric_format == "CloudWatch":
+            metric["ReturnData"] = True
+    logger.info(
+        "%s metrics specified in %s: %s", metric_format, type, Payload(filtered_metrics)
+    )
+    return filtered_metrics
+
+
+def query_resolutions(metrics):
+    # Seconds per datapoint of each query, by Id. CloudWatch queries sent in the
+    # same request, an expression and the metrics it references, share the
+    # longest period among them.
+    cw_metrics = [
+        metric
+        for metric in metrics
+        if metric.get("metricFormat", "CloudWatch") == "CloudWatch"
+    ]
+    resolutions = {}
+    for group in group_cw_metrics(cw_metrics):
+        resolution = max(
+            metric_period(metric) or 60
+            for metric in cw_metrics
+            if metric["Id"] in group
+        )
+        resolutions.update(dict.fromkeys(group, resolution))
+    for metric in metrics:
+        if metric.get("metricFormat") == "Prometheus":
+            resolutions[metric["Id"]] = parse_prom_duration(metric.get("step"))
+    return resolutions
+
+
+def plan_windows(metrics, start_time, end_time, trailing=False):
+    # The fetch window of each query, by Id, aligned to its period or step. The
+    # buckets only partly in the window are left out, so that an evaluation does
+    # not fetch datapoints outside of it, or wait for a bucket that is still
+    # filling. Guardrails keep the CloudWatch bucket that contains the end of the
+    # window, with trailing. Prometheus samples are instants, so a sample is never
+    # partial and the window ends at the last step before end_time.
+    resolutions = query_resolutions(metrics)
+    return {
+        metric["Id"]: aligned_window(
+            start_time,
+            end_time,
+            resolutions[metric["Id"]],
+            trailing and metric.get("metricFormat") != "Prometheus",
+        )
+        for metric in metrics
+    }
+
+
+def get_metrics(metrics, start_time, end_time, prometheus_url, type, trailing=False):
+    # CloudWatch and Prometheus are queried concurrently. A format without any
+    # metrics returns an empty list of results.
+    windows = plan_windows(metrics, start_time, end_time, trailing)
+    cw_metrics = filter_metrics(metrics, "CloudWatch", type)
+    prom_metrics = filter_metrics(metrics, "Prometheus", type)
+    results = {"MetricDataResults": [], "Messages": [], "PrometheusDataResults": []}
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        futures = []
+        if cw_metrics:
+            futures.append(
+                executor.submit(
+                    get_cw_metrics, cw_metrics, start_time, end_time, type, windows
+                )
+            )
+        if prom_metrics:
+            futures.append(
+                executor.submit(
+                    get_prom_metrics,
+                    prom_metrics,
+                    start_time,
+                    end_time,
+                    prometheus_url,
+                    type,
+                    windows,
+                )
+            )
+        for future in futures:
+            results.update(future.result())
+    return results
+
+
+def refetch_time(results, start_time):
+    # The oldest of the newest datapoints of the queries and series. The buckets
+    # after it may have been published since, so a window that slides forward is
+    # fetched again from there. A query without datapoints is fetched again whole.
+    newest = []
+    for result in results["MetricDataResults"]:
+        if not result["Timestamps"]:
+            return start_time
+        newest.append(max(result["Timestamps"]))
+    for result in results["PrometheusDataResults"]:
+        if not result["Series"]:
+            return start_time
+        for series in result["Series"]:
+            if not series["Timestamps"]:
+                return start_time
+            newest.append(to_datetime(series["Timestamps"][-1]))
+    return max(start_time, min(newest, default=start_time))
+
+
+def slide_results(previous, results, windows):
+    # Merges the datapoints fetched since the previous window into its results,
+    # and drops the datapoints that left the window, by the aligned window of
+    # each query. Datapoints fetched again replace the previous ones.
+    previous_cw = {result["Id"]: result for result in previous["MetricDataResults"]}
+    previous_prom = {
+        result["Id"]: result for result in previous["PrometheusDataResults"]
+    }
+    merged = dict(results, MetricDataResults=[], PrometheusDataResults=[])
+    for result in results["MetricDataResults"]:
+        start = windows[result["Id"]][0]
+        points = {}
+        if result["Id"] in previous_cw:
+            points.update(
+                zip(
+                    previous_cw[result["Id"]]["Timestamps"],
+                    previous_cw[result["Id"]]["Values"],
+                )
+            )
+        points.update(zip(result["Timestamps"], result["Values"]))
+        # Newest first, like GetMetricData.
+        timestamps = sorted((time for time in points if time >= start), reverse=True)
+        merged["MetricDataResults"].append(
+            dict(
+                result,
+                Timestamps=timestamps,
+                Values=[points[time] for time in timestamps],
+            )
+        )
+
+    for result in results["PrometheusDataResults"]:
+        start = windows[result["Id"]][0].timestamp()
+        series_by_labels = {
+            tuple(sorted(series["Labels"].items())): series
+            for series in previous_prom.get(result["Id"], {}).get("Series", [])
+        }
+        for series in result["Series"]:
+            key = tuple(sorted(series["Labels"].items()))
+            kept = series_by_labels.get(key)
+            if kept is not None and series["Timestamps"]:
+                cut = bisect_left(kept["Timestamps"], series["Timestamps"][0])
+                series = dict(
+                    series,
+                    Timestamps=kept["Timestamps"][:cut] + series["Timestamps"],
+                    Values=kept["Values"][:cut] + series["Values"],
+                )
+            elif kept is not None:
+                series = kept
+            series_by_labels[key] = series
+        slid = []
+        for series in series_by_labels.values():
+            first = bisect_left(series["Timestamps"], start)
+            if first < len(series["Timestamps"]):
+                slid.append(
+                    dict(
+                        series,
+                        Timestamps=series["Timestamps"][first:],
+                        Values=series["Values"][first:],
+                    )
+                )
+        merged["PrometheusDataResults"].append(dict(result, Series=slid))
+    return merged
+
+
+def get_definitions(metrics):
+    return {metric["Id"]: metric for metric in metrics}
+
+
+def expressions(results):
+    # Only expressions, whose Ids start with "e", are evaluated.
+    return [result for result in results if result["Id"].startswith("e")]
+
+
+def missing_expressions(results):
+    # Each metric format that is queried needs at least one expression.
+    return [
+        key
+        for key in ("MetricDataResults", "PrometheusDataResults")
+        if results[key] and not expressions(results[key])
+    ]
+
+
+def evaluate_metrics(results, definitions, bounds=None):
+    # bounds are the ranges of the baselines of the series that have one.
+    with instrumentation.timer("Evaluation"):
+        verdicts = evaluate_cw_results(
+            expressions(results["MetricDataResults"]),
+            definitions,
+            bounds,
+            query_resolutions(list(definitions.values())),
+        )
+        verdicts += evaluate_prom_results(
+            expressions(results["PrometheusDataResults"]),
+            definitions,
+            parse_prom_duration,
+            bounds,
+        )
+    for verdict in verdicts:
+        logger.info("Evaluating expression: %s", Payload(verdict))
+    return verdicts
+
+
+def waits_for_data(definition):
+    # A series whose evaluation sets a missingData policy, e.g. a sparse metric,
+    # is evaluated with the datapoints that are published, so it is not waited for.
+    return "missingData" not in (definition.get("evaluation") or {})
+
+
+def metrics_not_ready(results, definitions, end_time):
+    # An evaluated series is ready once it has a datapoint for the last CloudWatch
+    # period or Prometheus step of the aligned window that ends by end_time.
+    resolutions = query_resolutions(list(definitions.values()))
+    not_ready = []
+    for result in expressions(results["MetricDataResults"]):
+        if not waits_for_data(definitions.get(result["Id"], {})):
+            continue
+        period = timedelta(seconds=resolutions.get(result["Id"], 60))
+        last_period = time_floor(end_time, period) - period
+        if not result["Timestamps"] or max(result["Timestamps"]) < last_period:
+            not_ready.append(result["Id"])
+
+    for result in expressions(results["PrometheusDataResults"]):
+        if not waits_for_data(definitions.get(result["Id"], {})):
+            continue
+        step = timedelta(seconds=resolutions[result["Id"]])
+        last_step = time_floor(end_time, step).timestamp()
+        for series in result["Series"]:
+            if not series["Timestamps"] or series["Timestamps"][-1] < last_step:
+                not_ready.append(f"{result['Id']}{format_labels(series['Labels'])}")
+    return not_ready
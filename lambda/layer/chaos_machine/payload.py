@@ -0,0 +1,122 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+
+from chaos_machine.blobs import read_blob, write_blob
+from chaos_machine.snapshot import record
+
+logger = logging.getLogger(__name__)
+
+# Claim check mode: values of the execution state larger than PAYLOAD_MAX_BYTES
+# are written to a local directory, a file:// URI or an s3://bucket/prefix URI,
+# and replaced by a reference, {"payloadRef": uri}, so the state stays small. It
+# is off when PAYLOAD_URI is not set.
+PAYLOAD_URI = os.getenv("PAYLOAD_URI")
+PAYLOAD_MAX_BYTES = int(os.getenv("PAYLOAD_MAX_BYTES", "8192"))
+
+# Keys of the execution input that can be replaced by a reference.
+OFFLOADED_INPUT_KEYS = ["steadyState", "hypothesis", "guardrail"]
+
+# Error messages kept in the state, e.g. of an offloaded error, are truncated to
+# this many characters.
+ERROR_MESSAGE_MAX_CHARS = 1024
+
+# Payloads are content addressed, so a payload read once is kept for the life of
+# the container, up to this many payloads.
+PAYLOAD_CACHE_SIZE = 64
+
+loaded = {}
+
+
+def dumps(value):
+    return json.dumps(value, separators=(",", ":"), sort_keys=True)
+
+
+def is_reference(value):
+    return isinstance(value, dict) and list(value) == ["payloadRef"]
+
+
+def write_payload(prefix, value):
+    body = dumps(value).encode("utf-8")
+    key = f"{prefix}/{hashlib.sha256(body).hexdigest()}.json.gz"
+    uri = write_blob(PAYLOAD_URI, key, gzip.compress(body), "application/json")
+    logger.info(f"Payload of {len(body)} bytes written to {uri}")
+    return {"payloadRef": uri}
+
+
+def read_payload(uri):
+    if uri not in loaded:
+        if len(loaded) >= PAYLOAD_CACHE_SIZE:
+            loaded.clear()
+        loaded[uri] = read_blob(uri)
+    # Snapshots keep the payloads they read, so they are replayed without the store.
+    record({"type": "payload", "uri": uri, "body": loaded[uri]})
+    return json.loads(gzip.decompress(loaded[uri]).decode("utf-8"))
+
+
+def offload(value, prefix):
+    # Returns a reference to the value when it is too large for the state.
+    if not PAYLOAD_URI or not isinstance(value, (dict, list)) or is_reference(value):
+        return value
+    if len(dumps(value)) <= PAYLOAD_MAX_BYTES:
+        return value
+    return write_payload(prefix, value)
+
+
+def resolve(value):
+    # Replaces the references in a value with the payloads they reference.
+    if is_reference(value):
+        return resolve(read_payload(value["payloadRef"]))
+    if isinstance(value, dict):
+        return {key: resolve(item) for key, item in value.items()}
+    if isinstance(value, list):
+        return [resolve(item) for item in value]
+    return value
+
+
+def offload_input(event):
+    # The execution input, with the large test definitions replaced by references.
+    # The keys the state machine chooses on stay in the state.
+    prefix = str(event.get("testId", "test"))
+    return {
+        key: offload(value, prefix) if key in OFFLOADED_INPUT_KEYS else value
+        for key, value in event.items()
+    }
+
+
+def truncate(message, limit=ERROR_MESSAGE_MAX_CHARS):
+    if len(message) <= limit:
+        return message
+    return f"{message[:limit]}..."
+
+
+def offloaded_exception(e, uri):
+    # A copy of the exception, of the same type, whose message is truncated and
+    # references the full error. The copy is created without calling __init__,
+    # whose arguments differ between exception types, e.g. ClientError.
+    message = f"{truncate(str(e))} (full error in {uri})"
+    copied = type(e).__new__(type(e))
+    copied.__dict__.update(e.__dict__)
+    copied.args = (message,)
+    if "message" in copied.__dict__:
+        copied.message = message
+    copied.__suppress_context__ = True
+    return copied
+
+
+def offload_error(e, error, prefix):
+    # A formatted error larger than the state allows is written to the store, and
+    # a copy of the exception with a truncated message that references it is
+    # raised instead, without the traceback, so the Cause of the error in the
+    # state only keeps its type, message and the frame that raised it.
+    if not PAYLOAD_URI or len(error) <= PAYLOAD_MAX_BYTES:
+        return e
+    try:
+        reference = write_payload(f"{prefix}/errors", json.loads(error))
+        logger.error(f"Error written to {reference['payloadRef']}")
+    except Exception as write_error:
+        logger.warning(f"Error could not be written: {write_error}")
+        return e
+    return offloaded_exception(e, reference["payloadRef"])
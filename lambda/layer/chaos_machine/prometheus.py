@@ -0,0 +1,443 @@
+import codecs
+import json
+import logging
+import math
+import os
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta, timezone
+
+import urllib3
+from chaos_machine import cache, instrumentation
+from chaos_machine.log import Payload
+from chaos_machine.snapshot import record, recording
+from chaos_machine.timing import to_datetime
+
+logger = logging.getLogger(__name__)
+
+PROM_MAX_WORKERS = int(os.getenv("PROMETHEUS_MAX_WORKERS", "10"))
+PROM_CONNECT_TIMEOUT = float(os.getenv("PROMETHEUS_CONNECT_TIMEOUT", "3"))
+PROM_READ_TIMEOUT = float(os.getenv("PROMETHEUS_READ_TIMEOUT", "20"))
+# Responses are read and parsed in chunks of this many bytes.
+PROM_CHUNK_SIZE = int(os.getenv("PROMETHEUS_CHUNK_SIZE", "65536"))
+
+# Prometheus rejects range queries that return more than 11,000 points per series.
+PROM_MAX_POINTS = 11000
+PROM_DURATION_UNITS = {
+    "ms": 0.001,
+    "s": 1,
+    "m": 60,
+    "h": 3600,
+    "d": 86400,
+    "w": 604800,
+    "y": 31536000,
+}
+
+# Reused across warm invocations so connections to Prometheus are kept alive.
+http = urllib3.PoolManager(maxsize=PROM_MAX_WORKERS)
+
+
+def parse_prom_duration(duration):
+    # Accepts a positive number of seconds or a Prometheus duration string, e.g.
+    # "1m30s". A step of 0 would never advance the window.
+    try:
+        seconds = float(duration)
+    except ValueError:
+        matches = re.findall(r"(\d+(?:\.\d+)?)(ms|s|m|h|d|w|y)", str(duration))
+        if not matches or "".join(f"{n}{u}" for n, u in matches) != str(duration):
+            raise ValueError(f"Invalid Prometheus duration: {duration}")
+        seconds = sum(float(n) * PROM_DURATION_UNITS[u] for n, u in matches)
+    if not seconds > 0:
+        raise ValueError(
+            f"Invalid Prometheus duration: {duration}, it must be positive."
+        )
+    return seconds
+
+
+def split_prom_window(start_time, end_time, step):
+    # Each sub-window starts on the step grid of the whole window and returns at
+    # most PROM_MAX_POINTS points, so the stitched series match a single request.
+    span = timedelta(seconds=step * (PROM_MAX_POINTS - 1))
+    windows = []
+    window_start = start_time
+    while window_start <= end_time:
+        window_end = min(window_start + span, end_time)
+        windows.append((window_start, window_end))
+        window_start = window_end + timedelta(seconds=step)
+    return windows
+
+
+WHITESPACE = re.compile(r"\s*")
+# Sample values are quoted numbers, so the first "]]" closes the values of a series.
+VALUES_END = re.compile(r"\]\s*\]")
+DECODER = json.JSONDecoder()
+
+
+class ResponseParser:
+    # Parses a query_range response from the chunks of its body, without holding
+    # the body. The samples of each series are decoded a buffer at a time into
+    # typed arrays, so the memory used is the buffer and the arrays of the series.
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.text = ""
+        self.pos = 0
+        self.done = False
+
+    def read(self):
+        # Appends the next chunk to the buffer, or returns False at the end.
+        if self.done:
+            return False
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            self.done = True
+            self.text += self.decoder.decode(b"", final=True)
+            return False
+        if self.pos >= PROM_CHUNK_SIZE:
+            start = self.pos
+            self.text = self.text[start:]
+            self.pos = 0
+        self.text += self.decoder.decode(chunk)
+        return True
+
+    def char(self):
+        # The next character that is not whitespace, or "" at the end.
+        while True:
+            self.pos = WHITESPACE.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.read():
+                return ""
+
+    def expect(self, chars):
+        char = self.char()
+        if not char or char not in chars:
+            raise ValueError(
+                f"Expected one of {chars!r} in the Prometheus response, found {char!r}."
+            )
+        self.pos += 1
+        return char
+
+    def value(self):
+        # Decodes the next JSON value, reading until it is complete. A number at
+        # the end of the buffer may continue in the next chunk.
+        self.char()
+        while True:
+            try:
+                value, end = DECODER.raw_decode(self.text, self.pos)
+            except json.JSONDecodeError:
+                if not self.read():
+                    raise
+                continue
+            if end == len(self.text) and self.read():
+                continue
+            self.pos = end
+            return value
+
+    def parse(self):
+        # Returns the response, with the series of data.result in typed arrays.
+        return self.object(())
+
+    def object(self, path):
+        self.expect("{")
+        result = {}
+        if self.char() == "}":
+            self.pos += 1
+            return result
+        while True:
+            key = self.value()
+            self.expect(":")
+            if path + (key,) == ("data",):
+                result[key] = self.object(("data",))
+            elif path == ("data",) and key == "result" and self.char() == "[":
+                result[key] = self.series_list()
+            else:
+                result[key] = self.value()
+            if self.expect(",}") == "}":
+                return result
+
+    def series_list(self):
+        self.expect("[")
+        series_list = []
+        if self.char() == "]":
+            self.pos += 1
+            return series_list
+        while True:
+            series_list.append(self.series())
+            if self.expect(",]") == "]":
+                return series_list
+
+    def series(self):
+        self.expect("{")
+        series = {"Labels": {}, "Timestamps": array("d"), "Values": array("d")}
+        if self.char() == "}":
+            self.pos += 1
+        else:
+            while True:
+                key = self.value()
+                self.expect(":")
+                if key == "metric":
+                    series["Labels"] = self.value()
+                elif key == "values":
+                    self.samples(series["Timestamps"], series["Values"])
+                else:
+                    self.value()
+                if self.expect(",}") == "}":
+                    break
+        return series
+
+    def samples(self, timestamps, values):
+        # Decodes the complete [timestamp, "value"] pairs in the buffer at once.
+        self.expect("[")
+        while True:
+            char = self.char()
+            if char == "]":
+                self.pos += 1
+                return
+            if char == ",":
+                self.pos += 1
+                continue
+            if not char:
+                raise ValueError("The Prometheus response ended in the samples.")
+            end = VALUES_END.search(self.text, self.pos)
+            if end:
+                stop = end.start() + 1
+            else:
+                stop = self.text.rfind("]", self.pos) + 1
+            if stop <= self.pos:
+                if not self.read():
+                    raise ValueError("The Prometheus response ended in the samples.")
+                continue
+            start = self.pos
+            pairs = json.loads("[" + self.text[start:stop] + "]")
+            timestamps.extend(float(pair[0]) for pair in pairs)
+            values.extend(float(pair[1]) for pair in pairs)
+            self.pos = stop
+
+
+def read_prom_chunks(response, body=None):
+    # Keeps the chunks in body when the invocation is recorded.
+    for chunk in response.stream(PROM_CHUNK_SIZE):
+        if body is not None:
+            body.append(chunk)
+        yield chunk
+
+
+def format_prom_time(time):
+    # RFC 3339 with the milliseconds Prometheus timestamps are stored with.
+    return (
+        time.astimezone(timezone.utc)
+        .isoformat(timespec="milliseconds")
+        .replace("+00:00", "Z")
+    )
+
+
+def query_prom_range(metric, start_time, end_time, prometheus_url):
+    fields = {
+        "query": str(metric.get("query")),
+        "start": format_prom_time(start_time),
+        "end": format_prom_time(end_time),
+        "step": str(metric.get("step")),
+    }
+    body = [] if recording() else None
+    with instrumentation.timer("Prometheus"):
+        response = http.request(
+            "GET",
+            f"{prometheus_url}/api/v1/query_range",
+            fields=fields,
+            timeout=urllib3.Timeout(
+                connect=PROM_CONNECT_TIMEOUT, read=PROM_READ_TIMEOUT
+            ),
+            preload_content=False,
+        )
+        try:
+            # Each series keeps its label set and stores its samples in typed arrays.
+            response_decoded = ResponseParser(read_prom_chunks(response, body)).parse()
+        finally:
+            response.release_conn()
+    if body is not None:
+        record(
+            {
+                "type": "prometheus",
+                "request": fields,
+                "response": b"".join(body).decode("utf-8"),
+            }
+        )
+
+    if response_decoded.get("status") != "success":
+        raise ValueError(
+            f"Prometheus query {metric.get('Id')} failed: {response_decoded.get('error')}"
+        )
+
+    series_list = response_decoded["data"]["result"]
+    instrumentation.count("PrometheusSeries", len(series_list))
+    instrumentation.count(
+        "PrometheusSamples", sum(len(series["Values"]) for series in series_list)
+    )
+    return series_list
+
+
+def stitch_prom_series(windows):
+    # Concatenate the samples of each series across sub-windows, dropping any
+    # sample repeated at a boundary.
+    series_by_labels = {}
+    for window in windows:
+        for series in window:
+            key = tuple(sorted(series["Labels"].items()))
+            stitched = series_by_labels.get(key)
+            if stitched is None:
+                series_by_labels[key] = series
+                continue
+            first = bisect_right(series["Timestamps"], stitched["Timestamps"][-1])
+            stitched["Timestamps"].extend(series["Timestamps"][first:])
+            stitched["Values"].extend(series["Values"][first:])
+    return list(series_by_labels.values())
+
+
+def prom_bucket_data(plan, bucket):
+    # A bucket is only cached once it has a series, and every series in it has a
+    # sample for each step of the bucket. Series without samples in the bucket,
+    # e.g. of a label set that appeared later, are left out.
+    end = bucket + plan.size
+    data = []
+    for series in plan.series:
+        start = bisect_left(series["Timestamps"], bucket)
+        stop = bisect_left(series["Timestamps"], end)
+        if 0 < stop - start < plan.bucket_points():
+            return None
+        if stop > start:
+            data.append(
+                {
+                    "Labels": series["Labels"],
+                    "Timestamps": list(series["Timestamps"][start:stop]),
+                    "Values": list(series["Values"][start:stop]),
+                }
+            )
+    return data or None
+
+
+def get_cached_prom_metrics(metrics, metric_windows, prometheus_url):
+    # Each query is cached by its definition. The samples are on the step grid
+    # aligned to the epoch, so that cached buckets line up with new windows.
+    plans = []
+    requests = []
+    for metric, (window_start, window_end) in zip(metrics, metric_windows):
+        step = parse_prom_duration(metric.get("step"))
+        definition = {
+            "prometheusUrl": prometheus_url,
+            "query": str(metric.get("query")),
+            "step": step,
+        }
+        plan = cache.Plan(
+            definition, step, window_start.timestamp(), window_end.timestamp()
+        )
+        plans.append(plan)
+    cache.load(plans)
+
+    for metric, plan in zip(metrics, plans):
+        step = parse_prom_duration(metric.get("step"))
+        for range_start, range_end in plan.missing():
+            first = math.ceil(range_start / step) * step
+            last = math.floor(range_end / step) * step
+            # Ranges end before the next cached bucket, the window end is included.
+            if range_end < plan.end and last == range_end:
+                last -= step
+            if last < first:
+                continue
+            for window in split_prom_window(
+                to_datetime(first), to_datetime(last), step
+            ):
+                requests.append((plan, metric, window))
+
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(len(requests), PROM_MAX_WORKERS))
+    ) as executor:
+        futures = [
+            executor.submit(
+                query_prom_range, metric, window_start, window_end, prometheus_url
+            )
+            for _, metric, (window_start, window_end) in requests
+        ]
+        windows = {id(plan): [] for plan in plans}
+        for (plan, _, (window_start, _)), future in zip(requests, futures):
+            windows[id(plan)].append((window_start.timestamp(), future.result()))
+
+    results = []
+    for metric, plan in zip(metrics, plans):
+        plan_windows = windows[id(plan)]
+        for bucket, data in plan.cached.items():
+            plan_windows.append(
+                (
+                    bucket,
+                    [
+                        {
+                            "Labels": series["Labels"],
+                            "Timestamps": array("d", series["Timestamps"]),
+                            "Values": array("d", series["Values"]),
+                        }
+                        for series in data
+                    ],
+                )
+            )
+        plan_windows.sort(key=lambda window: window[0])
+        plan.series = stitch_prom_series([window for _, window in plan_windows])
+        results.append({"Id": str(metric.get("Id")), "Series": plan.series})
+    cache.store(plans, prom_bucket_data)
+    return {"PrometheusDataResults": results}
+
+
+def get_prom_metrics(metrics, start_time, end_time, prometheus_url, type, windows=None):
+    # windows are the aligned windows of the queries, by Id.
+    metric_windows = [
+        (windows or {}).get(metric.get("Id"), (start_time, end_time))
+        for metric in metrics
+    ]
+    for metric, (window_start, window_end) in zip(metrics, metric_windows):
+        logger.info(
+            f"Retrieving metric {metric.get('Id')} from {window_start} to {window_end}."
+        )
+    if cache.enabled():
+        prometheus_data_results = get_cached_prom_metrics(
+            metrics, metric_windows, prometheus_url
+        )
+        logger.info("%s Prometheus metrics: %s", type, Payload(prometheus_data_results))
+        return prometheus_data_results
+
+    windows = [
+        split_prom_window(
+            window_start, window_end, parse_prom_duration(metric.get("step"))
+        )
+        for metric, (window_start, window_end) in zip(metrics, metric_windows)
+    ]
+    with ThreadPoolExecutor(
+        max_workers=max(1, min(sum(map(len, windows)), PROM_MAX_WORKERS))
+    ) as executor:
+        futures = [
+            [
+                executor.submit(
+                    query_prom_range,
+                    metric,
+                    window_start,
+                    window_end,
+                    prometheus_url,
+                )
+                for window_start, window_end in metric_windows
+            ]
+            for metric, metric_windows in zip(metrics, windows)
+        ]
+        # Results are collected in the order of the metrics definition.
+        prometheus_data_results = {
+            "PrometheusDataResults": [
+                {
+                    "Id": str(metric.get("Id")),
+                    "Series": stitch_prom_series(
+                        [future.result() for future in metric_futures]
+                    ),
+                }
+                for metric, metric_futures in zip(metrics, futures)
+            ]
+        }
+    logger.info("%s Prometheus metrics: %s", type, Payload(prometheus_data_results))
+    return prometheus_data_results
@@ -0,0 +1,168 @@
+import base64
+import gzip
+import json
+import logging
+import os
+from array import array
+from datetime import datetime
+from functools import wraps
+from threading import Lock
+
+from chaos_machine import cache, clients
+from chaos_machine.blobs import read_blob, write_blob
+from chaos_machine.timing import now
+
+logger = logging.getLogger(__name__)
+
+# A local directory, a file:// URI or an s3://bucket/prefix URI. Nothing is
+# recorded when it is not set.
+SNAPSHOT_URI = os.getenv("SNAPSHOT_URI")
+
+# Read operations whose requests and responses are recorded, by service.
+RECORDED_OPERATIONS = {
+    "cloudwatch": ["get_metric_data", "describe_alarms", "describe_alarm_history"],
+    "fis": ["get_experiment"],
+    "ssm": ["describe_automation_executions", "get_automation_execution"],
+    "dynamodb": ["batch_get_item"],
+}
+
+
+def default(value):
+    # Datetimes and binary values are tagged so they are restored when a snapshot
+    # is read.
+    if isinstance(value, datetime):
+        return {"$datetime": value.isoformat()}
+    if isinstance(value, array):
+        return list(value)
+    if isinstance(value, bytes):
+        return {"$bytes": base64.b64encode(value).decode("ascii")}
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def object_hook(value):
+    if len(value) == 1 and "$datetime" in value:
+        return datetime.fromisoformat(value["$datetime"])
+    if len(value) == 1 and "$bytes" in value:
+        return base64.b64decode(value["$bytes"])
+    return value
+
+
+def dumps(value):
+    return json.dumps(value, default=default, separators=(",", ":"), sort_keys=True)
+
+
+def loads(value):
+    return json.loads(value, object_hook=object_hook)
+
+
+class Recorder:
+    def __init__(self, handler, event):
+        self.lock = Lock()
+        self.invocation = {
+            "type": "invocation",
+            "handler": handler,
+            "time": now(),
+            "event": event,
+            "cache": cache.settings(),
+        }
+        self.records = [dumps(self.invocation)]
+
+    def record(self, record):
+        # Records are serialized right away, so later changes to the responses,
+        # e.g. pages merged by the fetch engines, are not recorded.
+        line = dumps(record)
+        with self.lock:
+            self.records.append(line)
+
+    def wrap(self, service_name, operation, function, target=None):
+        if operation not in RECORDED_OPERATIONS.get(service_name, []):
+            return function
+
+        @wraps(function)
+        def recorded(**kwargs):
+            response = function(**kwargs)
+            call = {
+                "type": "call",
+                "service": service_name,
+                "operation": operation,
+                "request": kwargs,
+                "response": {
+                    key: value
+                    for key, value in response.items()
+                    if key != "ResponseMetadata"
+                },
+            }
+            if target:
+                call["target"] = target
+            self.record(call)
+            return response
+
+        return recorded
+
+
+def recording():
+    return clients.recorder is not None
+
+
+def record(record):
+    if clients.recorder is not None:
+        clients.recorder.record(record)
+
+
+def snapshot_key(invocation):
+    event = invocation["event"]
+    parts = [str(event.get("testId", "test"))]
+    experiment_id = event.get("continueExecutionOutput", {}).get("experimentId")
+    if experiment_id:
+        parts.append(experiment_id)
+    parts.append(
+        f"{invocation['handler']}-{invocation['time']:%Y%m%dT%H%M%S%fZ}.jsonl.gz"
+    )
+    return "/".join(parts)
+
+
+def write_snapshot(uri, key, lines):
+    body = gzip.compress("".join(f"{line}\n" for line in lines).encode("utf-8"))
+    return write_blob(uri, key, body, "application/x-ndjson")
+
+
+def read_snapshot(uri):
+    body = read_blob(uri)
+    return [loads(line) for line in gzip.decompress(body).decode("utf-8").splitlines()]
+
+
+def recorded(handler):
+    # Records the responses fetched by a Lambda handler, the time it was invoked,
+    # and its result, to a gzip compressed JSON lines snapshot.
+    def decorator(function):
+        @wraps(function)
+        def wrapper(event, context):
+            if not SNAPSHOT_URI:
+                return function(event, context)
+            recorder = Recorder(handler, event)
+            clients.set_recorder(recorder)
+            outcome = {"type": "result"}
+            try:
+                result = function(event, context)
+                outcome["result"] = result
+                return result
+            except Exception as e:
+                outcome["errorType"] = type(e).__name__
+                outcome["errorMessage"] = str(e)
+                raise e
+            finally:
+                clients.set_recorder(None)
+                recorder.record(outcome)
+                try:
+                    uri = write_snapshot(
+                        SNAPSHOT_URI,
+                        snapshot_key(recorder.invocation),
+                        recorder.records,
+                    )
+                    logger.info(f"Snapshot written to {uri}")
+                except Exception as e:
+                    logger.warning(f"Snapshot could not be written: {e}")
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta, timezone
+
+# Replaced with a simulated clock when the state machine runs locally.
+clock = None
+
+
+def set_clock(function):
+    global clock
+    clock = function
+
+
+def now():
+    if clock is not None:
+        return clock()
+    return datetime.now(timezone.utc)
+
+
+def time_ceil(time, delta):
+    epoch = datetime(1970, 1, 1, tzinfo=time.tzinfo)
+    mod = (time - epoch) % delta
+    if mod:
+        return time + (delta - mod)
+    return time
+
+
+def time_floor(time, delta):
+    epoch = datetime(1970, 1, 1, tzinfo=time.tzinfo)
+    return time - (time - epoch) % delta
+
+
+def aligned_window(start_time, end_time, resolution, trailing=False):
+    # The buckets of resolution seconds, aligned to the epoch, that are entirely
+    # between start_time and end_time, so no bucket at the edges is only partly
+    # in the window. With trailing, the bucket that contains end_time is kept. A
+    # window shorter than a bucket is widened to the last bucket.
+    delta = timedelta(seconds=resolution)
+    start = time_ceil(start_time, delta)
+    end = time_ceil(end_time, delta) if trailing else time_floor(end_time, delta)
+    if end - start < delta:
+        start = end - delta
+    return start, end
+
+
+def to_datetime(timestamp):
+    if isinstance(timestamp, datetime):
+        return timestamp
+    return datetime.fromtimestamp(timestamp, timezone.utc)
+
+
+def to_timestamp(time):
+    if isinstance(time, datetime):
+        return time.timestamp()
+    return time
+
+
+def lookback_window(event, end_time):
+    return end_time - timedelta(seconds=event.get("lookback", 300)), end_time
+
+
+def hypothesis_window(event, start_time, end_time):
+    # With a recovery delay and duration, the hypothesis is evaluated for the
+    # recovery after the experiment instead of the experiment itself.
+    recovery_delay = event.get("recoveryDelay")
+    recovery_duration = event.get("recoveryDuration")
+    if recovery_delay is not None and recovery_duration is not None:
+        start_time = end_time + timedelta(seconds=recovery_delay)
+        end_time = start_time + timedelta(seconds=recovery_duration)
+    return start_time, end_time
@@ -0,0 +1,7 @@
+import sys
+from pathlib import Path
+
+# The layer package is imported like in the Lambda runtime, from the layer root.
+layer = Path(__file__).resolve().parent.parent
+if str(layer) not in sys.path:
+    sys.path.insert(0, str(layer))
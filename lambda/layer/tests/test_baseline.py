@@ -0,0 +1,158 @@
+import math
+import random
+
+import pytest
+from chaos_machine import baseline, clients
+from chaos_machine.baseline import SKETCH_ACCURACY, Baseline, Sketch
+
+
+def exact_quantile(values, q):
+    # The same rank as Sketch.quantile: the smallest value with more than
+    # q * (count - 1) values at or below it.
+    ordered = sorted(values)
+    return ordered[math.floor(q * (len(ordered) - 1))]
+
+
+@pytest.mark.parametrize(
+    "values",
+    [
+        [random.Random(1).lognormvariate(0, 2) for _ in range(10000)],
+        [random.Random(2).gauss(0, 100) for _ in range(10000)],
+        [0.0] * 100 + [random.Random(3).uniform(1, 1000) for _ in range(900)],
+    ],
+    ids=["lognormal", "signed", "zeros"],
+)
+@pytest.mark.parametrize("q", [0, 0.01, 0.25, 0.5, 0.75, 0.99, 1])
+def test_quantile_relative_accuracy(values, q):
+    sketch = Sketch()
+    sketch.add(values)
+    expected = exact_quantile(values, q)
+    assert sketch.quantile(q) == pytest.approx(
+        expected, rel=SKETCH_ACCURACY, abs=baseline.SKETCH_MIN_VALUE
+    )
+
+
+def test_quantile_of_merged_windows():
+    generator = random.Random(4)
+    windows = [[generator.expovariate(0.1) for _ in range(500)] for _ in range(5)]
+    sketch = Sketch()
+    for window in windows:
+        sketch.add(window)
+    values = [value for window in windows for value in window]
+    for q in (0.1, 0.5, 0.9):
+        assert sketch.quantile(q) == pytest.approx(
+            exact_quantile(values, q), rel=SKETCH_ACCURACY
+        )
+
+
+def test_collapsed_buckets_keep_the_count(monkeypatch):
+    monkeypatch.setattr(baseline, "SKETCH_MAX_BUCKETS", 16)
+    sketch = Sketch()
+    values = [10**exponent for exponent in range(-5, 6)] * 10
+    sketch.add(values)
+    assert len(sketch.positive.counts) == 16
+    assert sketch.count() == len(values)
+    # The highest buckets are kept, so the upper quantiles are still accurate.
+    assert sketch.quantile(1) == pytest.approx(10**5, rel=SKETCH_ACCURACY)
+
+
+def test_update_merges_decayed_moments():
+    generator = random.Random(5)
+    decay = 0.8
+    windows = [
+        [generator.gauss(mean, 2) for _ in range(60)] for mean in (10, 12, 9, 15)
+    ]
+    learned = Baseline()
+    start = 1
+    for window in windows:
+        timestamps = list(range(start, start + len(window)))
+        assert learned.update(window, timestamps, decay)
+        start += len(window)
+
+    # Each window weighs decay times less than the next one.
+    weights = [decay ** (len(windows) - 1 - index) for index in range(len(windows))]
+    total = math.fsum(weight * len(window) for weight, window in zip(weights, windows))
+    weighted = math.fsum(
+        weight * value for weight, window in zip(weights, windows) for value in window
+    )
+    mean = weighted / total
+    m2 = math.fsum(
+        weight * (value - mean) ** 2
+        for weight, window in zip(weights, windows)
+        for value in window
+    )
+    assert learned.runs == len(windows)
+    assert learned.count == pytest.approx(total)
+    assert learned.mean == pytest.approx(mean)
+    assert learned.m2 == pytest.approx(m2)
+    assert learned.stddev() == pytest.approx(math.sqrt(m2 / total))
+    assert learned.sketch.count() == pytest.approx(total)
+
+
+def test_update_skips_merged_datapoints():
+    learned = Baseline()
+    assert learned.update([1, 2, 3], [60, 120, 180], 0.9)
+    # Overlapping windows of consecutive runs only merge the newer datapoints.
+    assert learned.update([3, 4], [180, 240], 1)
+    assert learned.count == 4
+    assert learned.mean == pytest.approx(2.5)
+    assert not learned.update([4, float("nan")], [240, 300], 1)
+    assert learned.runs == 2
+
+
+def test_bounds():
+    learned = Baseline()
+    values = [float(value) for value in range(1, 101)]
+    for run in range(2):
+        learned.update(values, [run * 100 + index for index in range(1, 101)], 1)
+    settings = dict(baseline.DEFAULT_BASELINE)
+    assert learned.bounds(settings) is None
+
+    learned.update(values, [200 + index for index in range(1, 101)], 1)
+    lower, upper = learned.bounds(dict(settings, zScore=2))
+    deviation = 2 * learned.stddev()
+    assert (lower, upper) == pytest.approx((50.5 - deviation, 50.5 + deviation))
+
+    lower, upper = learned.bounds(dict(settings, lowerQuantile=5, upperQuantile=95))
+    assert lower <= exact_quantile(values, 0.05) <= lower * (1 + 4 * SKETCH_ACCURACY)
+    assert upper >= exact_quantile(values, 0.95) >= upper * (1 - 4 * SKETCH_ACCURACY)
+
+
+def test_item_round_trip():
+    learned = Baseline()
+    learned.update([-2.5, 0, 1, 1000], [1, 2, 3, 4], 0.9)
+    item = learned.to_item("test", "e1")
+    loaded = Baseline.from_item(item)
+    assert loaded.version == 1
+    assert (loaded.runs, loaded.count, loaded.mean, loaded.m2, loaded.last) == (
+        learned.runs,
+        learned.count,
+        learned.mean,
+        learned.m2,
+        learned.last,
+    )
+    for q in (0, 0.5, 1):
+        assert loaded.sketch.quantile(q) == learned.sketch.quantile(q)
+
+
+class StubDynamoDB:
+    def __init__(self):
+        self.calls = []
+
+    def put_item(self, **kwargs):
+        self.calls.append(kwargs)
+
+
+def test_update_baselines_without_table(monkeypatch):
+    dynamodb = StubDynamoDB()
+    monkeypatch.setattr(baseline, "BASELINES_TABLE", None)
+    monkeypatch.setitem(clients.clients, "dynamodb", dynamodb)
+    results = {
+        "MetricDataResults": [
+            {"Id": "e1", "Values": [1.0, 1.0], "Timestamps": [60.0, 120.0]}
+        ],
+        "PrometheusDataResults": [],
+    }
+    definitions = {"e1": {"Id": "e1", "evaluation": {"baseline": {}}}}
+    baseline.update_baselines("test", results, definitions, {})
+    assert dynamodb.calls == []
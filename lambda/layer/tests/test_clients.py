@@ -0,0 +1,38 @@
+from datetime import datetime, timezone
+
+from chaos_machine import clients
+
+ROLE_ARN = "arn:aws:iam::111122223333:role/chaos-machine-read"
+
+
+class StubSTS:
+    def __init__(self):
+        self.calls = []
+
+    def assume_role(self, **kwargs):
+        self.calls.append(kwargs)
+        return {
+            "Credentials": {
+                "AccessKeyId": "ASIAEXAMPLE",
+                "SecretAccessKey": "secret",
+                "SessionToken": "token",
+                "Expiration": datetime(2099, 1, 1, tzinfo=timezone.utc),
+            }
+        }
+
+
+def test_role_is_assumed_on_first_use(monkeypatch):
+    sts = StubSTS()
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "AKIAEXAMPLE")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "secret")
+    monkeypatch.setitem(clients.clients, "sts", sts)
+    session = clients.create_session({"region": "us-west-2", "roleArn": ROLE_ARN})
+    credentials = session.get_credentials()
+
+    assert session.region_name == "us-west-2"
+    assert credentials.method == clients.AssumeRoleProvider.METHOD
+    assert sts.calls == []
+    assert credentials.get_frozen_credentials().access_key == "ASIAEXAMPLE"
+    assert sts.calls == [
+        {"RoleArn": ROLE_ARN, "RoleSessionName": clients.ROLE_SESSION_NAME}
+    ]
@@ -0,0 +1,234 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from chaos_machine import cache, clients, timing
+from chaos_machine.cloudwatch import (
+    CW_MAX_QUERIES,
+    cacheable,
+    chunk_cw_metrics,
+    fetch_cw_metrics,
+    get_cached_cw_metrics,
+    group_cw_metrics,
+)
+
+START = datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+
+def metric(id):
+    return {
+        "Id": id,
+        "MetricStat": {
+            "Metric": {"Namespace": "PetSite", "MetricName": id},
+            "Period": 60,
+            "Stat": "Sum",
+        },
+        "ReturnData": True,
+    }
+
+
+def expression(id, expression):
+    return {"Id": id, "Expression": expression, "ReturnData": True}
+
+
+@pytest.mark.parametrize(
+    "definition,expected",
+    [
+        ([metric("m1")], True),
+        ([metric("m1"), expression("e1", "IF(m1 > 0.5, 0, 1)")], True),
+        ([metric("m1"), expression("e1", "ABS(LOG10(m1))")], True),
+        ([metric("m1"), expression("e1", "RATE(m1)")], False),
+        ([metric("m1"), expression("e1", "IF(DIFF (m1) > 0, 0, 1)")], False),
+        ([metric("m1"), expression("e1", "RUNNING_SUM(m1)")], False),
+        ([metric("m1"), expression("e1", "fill(m1, REPEAT)")], False),
+    ],
+)
+def test_cacheable(definition, expected):
+    assert cacheable(definition) == expected
+
+
+class StubCloudWatch:
+    # Returns a datapoint per minute of the window, except at the missing times.
+    def __init__(self, missing=(), status_code="Complete"):
+        self.missing = set(missing)
+        self.status_code = status_code
+        self.requests = []
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, **kwargs):
+        self.requests.append(([query["Id"] for query in MetricDataQueries], StartTime))
+        timestamps = []
+        time = StartTime
+        while time < EndTime:
+            if time not in self.missing:
+                timestamps.insert(0, time)
+            time += timedelta(minutes=1)
+        return {
+            "MetricDataResults": [
+                {
+                    "Id": query["Id"],
+                    "Label": query["Id"],
+                    "Timestamps": timestamps,
+                    "Values": [1.0] * len(timestamps),
+                    "StatusCode": self.status_code,
+                }
+                for query in MetricDataQueries
+            ],
+            "Messages": [],
+        }
+
+
+class StubDynamoDB:
+    def __init__(self):
+        self.keys = []
+        self.items = []
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        for request in RequestItems.values():
+            self.keys.extend(request["Keys"])
+        return {"Responses": {}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        for requests in RequestItems.values():
+            self.items.extend(request["PutRequest"]["Item"] for request in requests)
+        return {"UnprocessedItems": {}}
+
+
+def test_window_dependent_expressions_are_not_cached(monkeypatch):
+    cloudwatch = StubCloudWatch()
+    dynamodb = StubDynamoDB()
+    monkeypatch.setattr(cache, "QUERY_CACHE_TABLE", "query-cache")
+    monkeypatch.setitem(clients.clients, "cloudwatch", cloudwatch)
+    monkeypatch.setitem(clients.clients, "dynamodb", dynamodb)
+    monkeypatch.setattr(timing, "clock", lambda: START + timedelta(hours=1))
+    metrics = [
+        metric("m1"),
+        expression("e1", "IF(m1 > 0.5, 0, 1)"),
+        metric("m2"),
+        expression("e2", "RATE(m2)"),
+    ]
+    results = get_cached_cw_metrics(metrics, START, START + timedelta(minutes=10))
+
+    # Only the buckets of the first group are looked up and written.
+    cached = cache.query_id(metrics[:2])
+    assert dynamodb.keys
+    assert {key["queryId"]["S"] for key in dynamodb.keys} == {cached}
+    assert {item["queryId"]["S"] for item in dynamodb.items} == {cached}
+    # The second group is fetched whole, in its own request.
+    assert (["m2", "e2"], START) in cloudwatch.requests
+    assert [result["Id"] for result in results["MetricDataResults"]] == [
+        "m1",
+        "e1",
+        "m2",
+        "e2",
+    ]
+
+
+def fetch(monkeypatch, cloudwatch):
+    dynamodb = StubDynamoDB()
+    monkeypatch.setattr(cache, "QUERY_CACHE_TABLE", "query-cache")
+    monkeypatch.setitem(clients.clients, "cloudwatch", cloudwatch)
+    monkeypatch.setitem(clients.clients, "dynamodb", dynamodb)
+    monkeypatch.setattr(timing, "clock", lambda: START + timedelta(hours=1))
+    metrics = [metric("m1"), expression("e1", "IF(m1 > 0.5, 0, 1)")]
+    results = get_cached_cw_metrics(metrics, START, START + timedelta(minutes=5))
+    return results, sorted(float(item["bucket"]["N"]) for item in dynamodb.items)
+
+
+def test_buckets_without_datapoints_are_not_cached(monkeypatch):
+    late = START + timedelta(minutes=3)
+    results, buckets = fetch(monkeypatch, StubCloudWatch(missing=[late]))
+    assert len(results["MetricDataResults"][0]["Values"]) == 4
+    assert buckets == [
+        (START + timedelta(minutes=minute)).timestamp() for minute in (0, 1, 2, 4)
+    ]
+
+
+def test_partial_results_are_not_cached(monkeypatch):
+    results, buckets = fetch(monkeypatch, StubCloudWatch(status_code="PartialData"))
+    assert results["MetricDataResults"][0]["StatusCode"] == "PartialData"
+    assert buckets == []
+
+
+def test_group_cw_metrics():
+    metrics = [
+        metric("m1"),
+        metric("m2"),
+        metric("m3"),
+        metric("m4"),
+        expression("e1", "m1 + m2"),
+        expression("e2", "IF(e1 > 1, m3, 0)"),
+        expression("e3", "m4"),
+    ]
+    assert group_cw_metrics(metrics) == [
+        {"m1", "m2", "m3", "e1", "e2"},
+        {"m4", "e3"},
+    ]
+    assert group_cw_metrics(metrics + [expression("e4", "SUM(METRICS())")]) == [
+        {"m1", "m2", "m3", "m4", "e1", "e2", "e3", "e4"}
+    ]
+
+
+def test_chunk_cw_metrics_keeps_groups_together():
+    metrics = []
+    for index in range(300):
+        metrics += [metric(f"m{index}"), expression(f"e{index}", f"m{index} * 2")]
+    chunks = chunk_cw_metrics(metrics)
+    assert [len(chunk) for chunk in chunks] == [CW_MAX_QUERIES, 100]
+    chunk_of = {
+        query["Id"]: number for number, chunk in enumerate(chunks) for query in chunk
+    }
+    assert all(chunk_of[f"m{index}"] == chunk_of[f"e{index}"] for index in range(300))
+    # Queries keep the order of the definition within a chunk.
+    assert chunks[0][:2] == metrics[:2]
+
+
+def test_chunk_cw_metrics_rejects_large_groups():
+    metrics = [metric(f"m{index}") for index in range(CW_MAX_QUERIES)]
+    metrics.append(expression("e1", "SUM(METRICS())"))
+    with pytest.raises(ValueError):
+        chunk_cw_metrics(metrics)
+
+
+class PaginatedCloudWatch:
+    # Returns the datapoints of each query one page at a time, newest first.
+    def __init__(self, pages):
+        self.pages = pages
+        self.tokens = []
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, NextToken=None):
+        self.tokens.append(NextToken)
+        page = int(NextToken or 0)
+        response = {
+            "MetricDataResults": [
+                {
+                    "Id": query["Id"],
+                    "Label": query["Id"],
+                    "Timestamps": [StartTime + timedelta(minutes=10 - page)],
+                    "Values": [float(page)],
+                    "StatusCode": (
+                        "Complete" if page == self.pages - 1 else "PartialData"
+                    ),
+                }
+                for query in MetricDataQueries
+            ],
+            "Messages": [{"Code": f"page{page}"}],
+        }
+        if page < self.pages - 1:
+            response["NextToken"] = str(page + 1)
+        return response
+
+
+def test_fetch_cw_metrics_merges_pages(monkeypatch):
+    cloudwatch = PaginatedCloudWatch(pages=3)
+    monkeypatch.setitem(clients.clients, "cloudwatch", cloudwatch)
+    metrics = [metric("m1"), expression("e1", "m1 * 2")]
+    results = fetch_cw_metrics(metrics, START, START + timedelta(minutes=10))
+
+    assert cloudwatch.tokens == [None, "1", "2"]
+    assert [result["Id"] for result in results["MetricDataResults"]] == ["m1", "e1"]
+    for result in results["MetricDataResults"]:
+        assert result["Values"] == [0.0, 1.0, 2.0]
+        assert result["Timestamps"] == [
+            START + timedelta(minutes=minutes) for minutes in (10, 9, 8)
+        ]
+        assert result["StatusCode"] == "Complete"
+    assert results["Messages"] == [{"Code": f"page{page}"} for page in range(3)]
@@ -0,0 +1,64 @@
+import logging
+
+from chaos_machine import dynamodb
+
+
+class StubDynamoDB:
+    # Leaves the last key or request of each call unprocessed, `unprocessed` times.
+    def __init__(self, unprocessed):
+        self.unprocessed = unprocessed
+        self.calls = []
+
+    def batch_get_item(self, RequestItems):
+        ((table, request),) = RequestItems.items()
+        self.calls.append(len(request["Keys"]))
+        keys = request["Keys"]
+        response = {"Responses": {table: []}}
+        if self.unprocessed:
+            self.unprocessed -= 1
+            response["UnprocessedKeys"] = {table: {"Keys": keys[-1:]}}
+            keys = keys[:-1]
+        response["Responses"][table] = [dict(key, data={"S": "x"}) for key in keys]
+        return response
+
+    def batch_write_item(self, RequestItems):
+        ((table, requests),) = RequestItems.items()
+        self.calls.append(len(requests))
+        if self.unprocessed:
+            self.unprocessed -= 1
+            return {"UnprocessedItems": {table: requests[-1:]}}
+        return {"UnprocessedItems": {}}
+
+
+def keys(count):
+    return [{"id": {"S": str(index)}} for index in range(count)]
+
+
+def test_batch_get_chunks_and_retries(monkeypatch):
+    monkeypatch.setattr(dynamodb.time, "sleep", lambda seconds: None)
+    client = StubDynamoDB(unprocessed=2)
+    items = dynamodb.batch_get(client, "table", keys(250))
+    assert sorted(int(item["id"]["S"]) for item in items) == list(range(250))
+    assert client.calls == [100, 1, 1, 100, 50]
+
+
+def test_batch_get_logs_leftovers(monkeypatch, caplog):
+    sleeps = []
+    monkeypatch.setattr(dynamodb.time, "sleep", sleeps.append)
+    client = StubDynamoDB(unprocessed=dynamodb.DDB_BATCH_ATTEMPTS)
+    with caplog.at_level(logging.WARNING):
+        items = dynamodb.batch_get(client, "table", keys(3))
+    assert len(items) == 2
+    assert len(sleeps) == dynamodb.DDB_BATCH_ATTEMPTS - 1
+    assert "1 of 3 keys of table were not read" in caplog.text
+
+
+def test_batch_write_returns_leftovers(monkeypatch, caplog):
+    monkeypatch.setattr(dynamodb.time, "sleep", lambda seconds: None)
+    client = StubDynamoDB(unprocessed=dynamodb.DDB_BATCH_ATTEMPTS)
+    requests = [{"DeleteRequest": {"Key": key}} for key in keys(30)]
+    with caplog.at_level(logging.WARNING):
+        unprocessed = dynamodb.batch_write(client, "table", requests)
+    assert unprocessed == [requests[24]]
+    assert client.calls == [25, 1, 1, 1, 1, 5]
+    assert "1 of 30 requests to table were not processed" in caplog.text
@@ -0,0 +1,140 @@
+import math
+
+import pytest
+from chaos_machine.evaluation import evaluate_series, gap_lengths
+
+NAN = math.nan
+
+
+def evaluate(values, evaluation=None, timestamps=None, period=None, bounds=None):
+    return evaluate_series("e1", values, timestamps, evaluation, period, bounds)
+
+
+def test_any_zero_fails_by_default():
+    assert evaluate([1, 1, 1])["Status"] == "Ok"
+    verdict = evaluate([1, 0, 1])
+    assert verdict["Status"] == "Breaching"
+    assert verdict["FailedPredicates"] == ["breachRatio"]
+
+
+@pytest.mark.parametrize(
+    "evaluation",
+    [{"missingData": "notBreaching"}, {"threshold": 0}, {"missingData": "ignore"}],
+)
+def test_evaluation_without_predicate_fails_on_any_breach(evaluation):
+    verdict = evaluate([1, 0, 1], evaluation)
+    assert verdict["Breaches"] == 1
+    assert verdict["FailedPredicates"] == ["breachRatio"]
+    assert verdict["Status"] == "Breaching"
+
+
+def test_threshold_and_comparison_operator():
+    evaluation = {
+        "comparisonOperator": "GreaterThanThreshold",
+        "threshold": 100,
+        "breachRatio": 0.25,
+    }
+    assert evaluate([50, 150, 50, 50], evaluation)["Status"] == "Ok"
+    verdict = evaluate([50, 150, 150, 50], evaluation)
+    assert verdict["BreachRatio"] == 0.5
+    assert verdict["Status"] == "Breaching"
+
+
+def test_consecutive_breaches():
+    evaluation = {"consecutiveBreaches": 3}
+    verdict = evaluate([0, 0, 1, 0, 0, 1], evaluation)
+    assert verdict["MaxConsecutiveBreaches"] == 2
+    assert verdict["Status"] == "Ok"
+    verdict = evaluate([1, 0, 0, 0, 1], evaluation)
+    assert verdict["MaxConsecutiveBreaches"] == 3
+    assert verdict["Status"] == "Breaching"
+
+
+@pytest.mark.parametrize(
+    "percentile,value",
+    [(0, 1), (10, 1), (50, 5), (90, 9), (99, 10), (100, 10)],
+)
+def test_percentile_rank(percentile, value):
+    evaluation = {
+        "percentile": {
+            "percentile": percentile,
+            "comparisonOperator": "GreaterThanThreshold",
+            "threshold": 100,
+        }
+    }
+    verdict = evaluate([10, 9, 8, 7, 6, 5, 4, 3, 2, 1], evaluation)
+    assert verdict["Percentile"]["value"] == value
+
+
+@pytest.mark.parametrize("missing_data", ["ignore", "breaching", "notBreaching"])
+def test_nan_is_left_out_of_percentile_min_and_max(missing_data):
+    evaluation = {
+        "missingData": missing_data,
+        "percentile": {
+            "percentile": 90,
+            "comparisonOperator": "GreaterThanThreshold",
+            "threshold": 2,
+        },
+    }
+    verdict = evaluate([1, NAN, 5], evaluation)
+    assert verdict["Percentile"]["value"] == 5
+    assert verdict["FailedPredicates"] == ["percentile"]
+    assert verdict["Min"] == 1
+    assert verdict["Max"] == 5
+    assert verdict["Missing"] == 1
+
+
+@pytest.mark.parametrize(
+    "missing_data,breaches,points",
+    [("ignore", 0, 2), ("breaching", 1, 3), ("notBreaching", 0, 3)],
+)
+def test_nan_policies(missing_data, breaches, points):
+    evaluation = {"missingData": missing_data, "breachRatio": 0.4}
+    verdict = evaluate([1, NAN, 1], evaluation)
+    assert verdict["Breaches"] == breaches
+    assert verdict["BreachRatio"] == breaches / points
+
+
+def test_gap_lengths():
+    assert gap_lengths([0, 60, 120], 60) == {}
+    assert gap_lengths([0, 60, 300, 360], 60) == {1: 3}
+    assert gap_lengths([0, 300], None) == {}
+
+
+@pytest.mark.parametrize(
+    "missing_data,breaches,consecutive",
+    [("ignore", 0, 0), ("breaching", 3, 3), ("notBreaching", 0, 0)],
+)
+def test_gap_policies(missing_data, breaches, consecutive):
+    evaluation = {"missingData": missing_data, "consecutiveBreaches": 3}
+    verdict = evaluate([1, 1, 1, 1], evaluation, [0, 60, 300, 360], 60)
+    assert verdict["Missing"] == 3
+    assert verdict["Breaches"] == breaches
+    assert verdict["MaxConsecutiveBreaches"] == consecutive
+
+
+def test_newest_first_timestamps_are_ordered():
+    # A gap after the newest datapoint in CloudWatch order is found once reversed.
+    evaluation = {"missingData": "breaching", "consecutiveBreaches": 2}
+    verdict = evaluate([1, 1, 1], evaluation, [360, 300, 0], 60)
+    assert verdict["Missing"] == 4
+    assert verdict["Status"] == "Breaching"
+
+
+@pytest.mark.parametrize(
+    "evaluation,status",
+    [(None, "NoData"), ({"missingData": "breaching"}, "NoData")],
+)
+def test_no_datapoints(evaluation, status):
+    assert evaluate([], evaluation)["Status"] == status
+
+
+def test_no_datapoints_not_breaching():
+    assert evaluate([], {"missingData": "notBreaching"})["Status"] == "Ok"
+
+
+def test_baseline_bounds():
+    verdict = evaluate([5, 20, 1, 5], {}, bounds=(2, 10))
+    assert verdict["Baseline"] == {"Lower": 2, "Upper": 10}
+    assert verdict["Breaches"] == 2
+    assert verdict["Status"] == "Breaching"
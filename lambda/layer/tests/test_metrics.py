@@ -0,0 +1,121 @@
+from datetime import datetime, timedelta, timezone
+
+from chaos_machine.metrics import refetch_time, slide_results
+
+
+def at(minutes):
+    return datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(minutes=minutes)
+
+
+def seconds(minutes):
+    return at(minutes).timestamp()
+
+
+def cw_result(id, points):
+    # points maps minutes to values, returned newest first like GetMetricData.
+    minutes = sorted(points, reverse=True)
+    return {
+        "Id": id,
+        "Label": id,
+        "Timestamps": [at(minute) for minute in minutes],
+        "Values": [points[minute] for minute in minutes],
+        "StatusCode": "Complete",
+    }
+
+
+def series(labels, points):
+    # Prometheus samples are oldest first, in seconds.
+    minutes = sorted(points)
+    return {
+        "Labels": labels,
+        "Timestamps": [seconds(minute) for minute in minutes],
+        "Values": [points[minute] for minute in minutes],
+    }
+
+
+def results(cw=(), prom=()):
+    return {
+        "MetricDataResults": list(cw),
+        "Messages": [],
+        "PrometheusDataResults": list(prom),
+    }
+
+
+def test_slide_cw_results():
+    previous = results([cw_result("e1", {0: 1.0, 1: 1.0, 2: 1.0, 3: 1.0})])
+    # The last minute is fetched again and replaces the previous datapoint.
+    fetched = results([cw_result("e1", {3: 2.0, 4: 2.0})])
+    slid = slide_results(previous, fetched, {"e1": (at(2), at(5))})
+    (result,) = slid["MetricDataResults"]
+    assert result["Timestamps"] == [at(4), at(3), at(2)]
+    assert result["Values"] == [2.0, 2.0, 1.0]
+    assert result["StatusCode"] == "Complete"
+
+
+def test_slide_cw_results_by_window():
+    # Each query is trimmed to its own aligned window.
+    previous = results(
+        [cw_result("e1", {0: 1.0, 1: 1.0}), cw_result("e2", {0: 1.0, 1: 1.0})]
+    )
+    fetched = results([cw_result("e1", {2: 1.0}), cw_result("e2", {})])
+    slid = slide_results(
+        previous, fetched, {"e1": (at(1), at(3)), "e2": (at(0), at(3))}
+    )
+    assert [result["Timestamps"] for result in slid["MetricDataResults"]] == [
+        [at(2), at(1)],
+        [at(1), at(0)],
+    ]
+
+
+def test_slide_prometheus_results():
+    a = {"pod": "a", "zone": "1"}
+    b = {"pod": "b"}
+    c = {"pod": "c"}
+    previous = results(
+        prom=[
+            {
+                "Id": "e1",
+                "Series": [
+                    series(a, {0: 1.0, 1: 1.0, 2: 1.0}),
+                    series(b, {0: 1.0, 1: 1.0}),
+                    series(c, {0: 1.0}),
+                ],
+            }
+        ]
+    )
+    fetched = results(
+        prom=[
+            {
+                "Id": "e1",
+                "Series": [
+                    # Labels match in any order. The sample at 2 is fetched again.
+                    series(dict(reversed(list(a.items()))), {2: 2.0, 3: 2.0}),
+                    # A series without new samples keeps the previous ones.
+                    series(b, {}),
+                    series({"pod": "d"}, {3: 2.0}),
+                ],
+            }
+        ]
+    )
+    slid = slide_results(previous, fetched, {"e1": (at(1), at(3))})
+    (result,) = slid["PrometheusDataResults"]
+    # The series of pod c has no sample left in the window and is dropped.
+    assert [(s["Labels"], s["Timestamps"], s["Values"]) for s in result["Series"]] == [
+        (a, [seconds(1), seconds(2), seconds(3)], [1.0, 2.0, 2.0]),
+        (b, [seconds(1)], [1.0]),
+        ({"pod": "d"}, [seconds(3)], [2.0]),
+    ]
+
+
+def test_refetch_time():
+    start = at(0)
+    fetched = results(
+        [cw_result("e1", {1: 1.0, 4: 1.0}), cw_result("e2", {1: 1.0, 2: 1.0})],
+        [{"Id": "e3", "Series": [series({}, {1: 1.0, 3: 1.0})]}],
+    )
+    # The oldest of the newest datapoints of each query and series.
+    assert refetch_time(fetched, start) == at(2)
+    # A query without datapoints is fetched again whole.
+    fetched["MetricDataResults"].append(cw_result("e4", {}))
+    assert refetch_time(fetched, start) == start
+    assert refetch_time(results(prom=[{"Id": "e3", "Series": []}]), start) == start
@@ -0,0 +1,60 @@
+import json
+
+from botocore.exceptions import ClientError
+from chaos_machine import payload
+
+
+class MessageError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f"{self.message}"
+
+
+def format_error(e):
+    return json.dumps(
+        {"errorType": type(e).__name__, "errorMessage": str(e), "stackTrace": []}
+    )
+
+
+def test_offload_error_is_a_truncated_copy(monkeypatch, tmp_path):
+    monkeypatch.setattr(payload, "PAYLOAD_URI", str(tmp_path))
+    monkeypatch.setattr(payload, "PAYLOAD_MAX_BYTES", 100)
+    e = MessageError("x" * 10000)
+    offloaded = payload.offload_error(e, format_error(e), "test")
+
+    assert offloaded is not e
+    assert type(offloaded) is MessageError
+    assert str(e) == "x" * 10000
+    uri = str(next(tmp_path.rglob("*.json.gz")))
+    assert str(offloaded).endswith(f"... (full error in {uri})")
+    assert len(str(offloaded)) < payload.ERROR_MESSAGE_MAX_CHARS + 200
+    assert offloaded.__traceback__ is None
+    assert payload.resolve({"payloadRef": uri})["errorMessage"] == str(e)
+
+
+def test_offload_error_copies_client_errors(monkeypatch, tmp_path):
+    monkeypatch.setattr(payload, "PAYLOAD_URI", str(tmp_path))
+    monkeypatch.setattr(payload, "PAYLOAD_MAX_BYTES", 100)
+    e = ClientError(
+        {"Error": {"Code": "ValidationException", "Message": "y" * 5000}},
+        "GetMetricData",
+    )
+    offloaded = payload.offload_error(e, format_error(e), "test")
+
+    assert type(offloaded) is ClientError
+    assert offloaded.response["Error"]["Code"] == "ValidationException"
+    assert "(full error in " in str(offloaded)
+
+
+def test_small_errors_are_raised_unchanged(monkeypatch, tmp_path):
+    monkeypatch.setattr(payload, "PAYLOAD_URI", str(tmp_path))
+    e = MessageError("small")
+    assert payload.offload_error(e, format_error(e), "test") is e
+
+
+def test_truncate():
+    assert payload.truncate("short") == "short"
+    assert payload.truncate("z" * 2000) == "z" * payload.ERROR_MESSAGE_MAX_CHARS + "..."
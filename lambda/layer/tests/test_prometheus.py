@@ -0,0 +1,84 @@
+import json
+
+import pytest
+from chaos_machine import prometheus
+from chaos_machine.prometheus import ResponseParser
+
+BODY = json.dumps(
+    {
+        "status": "success",
+        "data": {
+            "resultType": "matrix",
+            "result": [
+                {
+                    "metric": {"__name__": "up", "job": 'pet"site', "zone": "é"},
+                    "values": [
+                        [1704067200, "1"],
+                        [1704067260.5, "0.25"],
+                        [1704067320, "NaN"],
+                        [1704067380, "-1.5e-7"],
+                    ],
+                },
+                {"metric": {}, "values": []},
+                {"metric": {"job": "search"}, "values": [[1704067200, "+Inf"]]},
+            ],
+        },
+        "warnings": ["a [warning]"],
+    },
+    indent=1,
+    ensure_ascii=False,
+).encode("utf-8")
+
+
+def expected_response(body):
+    response = json.loads(body)
+    response["data"]["result"] = [
+        {
+            "Labels": series["metric"],
+            "Timestamps": [float(pair[0]) for pair in series["values"]],
+            "Values": [float(pair[1]) for pair in series["values"]],
+        }
+        for series in response["data"]["result"]
+    ]
+    return json.dumps(response)
+
+
+def parse(chunks):
+    response = ResponseParser(chunks).parse()
+    for series in response["data"]["result"]:
+        series["Timestamps"] = list(series["Timestamps"])
+        series["Values"] = list(series["Values"])
+    return json.dumps(response)
+
+
+@pytest.mark.parametrize("chunk_size", [4, 65536])
+def test_split_at_every_byte(monkeypatch, chunk_size):
+    # The buffer is trimmed once more than chunk_size characters are parsed.
+    monkeypatch.setattr(prometheus, "PROM_CHUNK_SIZE", chunk_size)
+    expected = expected_response(BODY)
+    for split in range(len(BODY) + 1):
+        assert parse([BODY[:split], BODY[split:]]) == expected, split
+
+
+def test_one_byte_chunks(monkeypatch):
+    monkeypatch.setattr(prometheus, "PROM_CHUNK_SIZE", 1)
+    chunks = [bytes([byte]) for byte in BODY]
+    assert parse(chunks) == expected_response(BODY)
+
+
+def test_truncated_body():
+    with pytest.raises(ValueError):
+        ResponseParser([BODY[: BODY.index(b'"0.25"')]]).parse()
+
+
+@pytest.mark.parametrize(
+    "duration,seconds", [(30, 30), ("15", 15), ("1m30s", 90), ("500ms", 0.5)]
+)
+def test_parse_prom_duration(duration, seconds):
+    assert prometheus.parse_prom_duration(duration) == seconds
+
+
+@pytest.mark.parametrize("duration", [0, "0", "0s", "0m0s", "-5", "1x", "nan"])
+def test_invalid_prom_durations(duration):
+    with pytest.raises(ValueError):
+        prometheus.parse_prom_duration(duration)
@@ -0,0 +1,88 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+from chaos_machine.metrics import plan_windows, query_resolutions
+from chaos_machine.timing import aligned_window, time_ceil, time_floor
+
+
+def at(minutes, seconds=0):
+    return datetime(2024, 1, 1, tzinfo=timezone.utc) + timedelta(
+        minutes=minutes, seconds=seconds
+    )
+
+
+def test_time_ceil_and_floor_align_to_the_epoch():
+    delta = timedelta(minutes=5)
+    assert time_floor(at(7, 30), delta) == at(5)
+    assert time_ceil(at(7, 30), delta) == at(10)
+    assert time_floor(at(10), delta) == at(10)
+    assert time_ceil(at(10), delta) == at(10)
+
+
+@pytest.mark.parametrize(
+    "start,end,resolution,trailing,expected",
+    [
+        # Partial periods at both edges are left out.
+        (at(0, 30), at(10, 30), 60, False, (at(1), at(10))),
+        # With trailing, the period that contains the end is kept.
+        (at(0, 30), at(10, 30), 60, True, (at(1), at(11))),
+        # Periods are aligned to the epoch, not to the start of the window.
+        (at(2), at(17), 300, False, (at(5), at(15))),
+        # A window shorter than a period is widened to the last period.
+        (at(6), at(9), 300, False, (at(0), at(5))),
+        (at(6), at(9), 300, True, (at(5), at(10))),
+        # Prometheus steps can be shorter than a second.
+        (at(0, 0.25), at(0, 2.25), 0.5, False, (at(0, 0.5), at(0, 2))),
+    ],
+)
+def test_aligned_window(start, end, resolution, trailing, expected):
+    assert aligned_window(start, end, resolution, trailing) == expected
+
+
+def metric(id, period):
+    return {
+        "Id": id,
+        "MetricStat": {
+            "Metric": {"Namespace": "PetSite", "MetricName": id},
+            "Period": period,
+            "Stat": "Sum",
+        },
+    }
+
+
+METRICS = [
+    metric("m1", 60),
+    metric("m2", 300),
+    {"Id": "e1", "Expression": "m1 / m2"},
+    metric("m3", 60),
+    {"Id": "e2", "Expression": "IF(m3 > 1, 0, 1)"},
+    {"Id": "q1", "metricFormat": "Prometheus", "query": "up", "step": "30s"},
+]
+
+
+def test_query_resolutions_widen_mixed_periods():
+    # An expression and the metrics it references share the longest period.
+    assert query_resolutions(METRICS) == {
+        "m1": 300,
+        "m2": 300,
+        "e1": 300,
+        "m3": 60,
+        "e2": 60,
+        "q1": 30,
+    }
+
+
+def test_plan_windows():
+    windows = plan_windows(METRICS, at(2, 30), at(17, 30))
+    assert windows["m1"] == windows["e1"] == (at(5), at(15))
+    assert windows["m3"] == windows["e2"] == (at(3), at(17))
+    assert windows["q1"] == (at(2, 30), at(17, 30))
+
+
+def test_plan_windows_trailing():
+    # Guardrails keep the CloudWatch period that is still filling. Prometheus
+    # samples are instants, so they end at the last step either way.
+    windows = plan_windows(METRICS, at(2, 30), at(17, 30), trailing=True)
+    assert windows["e1"] == (at(5), at(20))
+    assert windows["e2"] == (at(3), at(18))
+    assert windows["q1"] == (at(2, 30), at(17, 30))
@@ -0,0 +1,197 @@
+import json
+import logging
+import os
+import sys
+import traceback
+from datetime import datetime, timedelta
+
+from chaos_machine.clients import LazyClient
+from chaos_machine.cloudwatch import alarms_in_state, get_alarms
+from chaos_machine.evaluation import failed_verdicts
+from chaos_machine.instrumentation import instrumented
+from chaos_machine.log import Payload
+from chaos_machine.metrics import (
+    evaluate_metrics,
+    get_definitions,
+    get_metrics,
+    refetch_time,
+)
+from chaos_machine.payload import offload_error, resolve
+from chaos_machine.timing import now
+
+logger = logging.getLogger()
+logger.setLevel(os.getenv("LOG_LEVEL"))
+
+fis = LazyClient("fis")
+ddb = LazyClient("dynamodb")
+ssm = LazyClient("ssm")
+
+experiments_table = os.getenv("EXPERIMENTS_TABLE")
+
+FIS_RUNNING_STATUSES = ["pending", "initiating", "running"]
+SSM_RUNNING_STATUSES = ["Pending", "InProgress", "Waiting"]
+
+
+class GuardrailError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f"{self.message}"
+
+
+def get_guardrail(event):
+    guardrail = event["guardrail"]
+    if guardrail == "hypothesis":
+        guardrail = event["hypothesis"]
+    if guardrail == "steadyState":
+        guardrail = event["steadyState"]
+    return guardrail.get("metrics", []), guardrail.get("alarms", [])
+
+
+def get_experiment(test_id, execution_name):
+    response = ddb.query(
+        TableName=experiments_table,
+        KeyConditionExpression="testId = :testId",
+        FilterExpression="executionName = :executionName",
+        ExpressionAttributeValues={
+            ":testId": {"S": test_id},
+            ":executionName": {"S": execution_name},
+        },
+    )
+    if not response["Items"]:
+        return None
+    item = response["Items"][0]
+    return {
+        "experimentId": item["experimentId"]["S"],
+        "experimentType": item["experimentType"]["S"],
+    }
+
+
+def get_experiment_status(experiment):
+    if experiment["experimentType"] == "FIS":
+        response = fis.get_experiment(id=experiment["experimentId"])
+        status = response["experiment"]["state"]["status"]
+        return status in FIS_RUNNING_STATUSES, response["experiment"].get("startTime")
+
+    response = ssm.get_automation_execution(
+        AutomationExecutionId=experiment["experimentId"]
+    )
+    execution = response["AutomationExecution"]
+    return (
+        execution["AutomationExecutionStatus"] in SSM_RUNNING_STATUSES,
+        execution.get("ExecutionStartTime"),
+    )
+
+
+def stop_experiment(experiment, reason):
+    if experiment["experimentType"] == "FIS":
+        response = fis.stop_experiment(id=experiment["experimentId"])
+    else:
+        response = ssm.stop_automation_execution(
+            AutomationExecutionId=experiment["experimentId"], Type="Cancel"
+        )
+    logger.error(
+        "Stopping experiment %s: %s %s",
+        experiment["experimentId"],
+        reason,
+        Payload(response),
+    )
+
+
+def check_guardrail(event, start_time, end_time):
+    # Only the datapoints since the previous poll are fetched. The next poll
+    # starts from the oldest of the newest datapoints of the queries and series,
+    # so the buckets still filling, or published later by a query with a longer
+    # period, are fetched again. A poll without new datapoints does not breach.
+    metrics, alarms = get_guardrail(event)
+    breached = []
+    cursor = start_time
+
+    if metrics:
+        results = get_metrics(
+            metrics,
+            start_time,
+            end_time,
+            event.get("prometheusUrl"),
+            "guardrail",
+            trailing=True,
+        )
+        breached += failed_verdicts(
+            evaluate_metrics(results, get_definitions(metrics)), ["Breaching"]
+        )
+        cursor = refetch_time(results, start_time)
+
+    if alarms:
+        breached += alarms_in_state(get_alarms(alarms, "guardrail"), ["ALARM"])
+
+    return breached, cursor
+
+
+@instrumented("monitor-experiment")
+def lambda_handler(event, context):
+    logger.info("Event received: %s", Payload(event))
+
+    test_input = event["Input"]
+    state = test_input.get("guardrailState", {})
+    interval = test_input.get("guardrailInterval", 10)
+
+    try:
+        experiment = state.get("experiment") or get_experiment(
+            test_input["testId"], event["ExecutionName"]
+        )
+        if "Error" in event:
+            # The guardrail failed after its retries, so it can no longer stop the
+            # experiment when it breaches.
+            if experiment is not None and get_experiment_status(experiment)[0]:
+                stop_experiment(experiment, f"Guardrail check failed: {event['Error']}")
+            return {"status": "Stopped", "experiment": experiment}
+
+        if experiment is None:
+            logger.info("The experiment has not been started yet.")
+            return {"status": "Running", "interval": interval}
+
+        running, start_time = get_experiment_status(experiment)
+        if not running:
+            logger.info(
+                f"Experiment {experiment['experimentId']} is no longer running."
+            )
+            return {"status": "Completed", "experiment": experiment}
+
+        end_time = now()
+        if "cursor" in state:
+            start_time = datetime.fromisoformat(state["cursor"])
+        start_time = start_time or end_time - timedelta(seconds=interval)
+
+        breached, cursor = check_guardrail(resolve(test_input), start_time, end_time)
+        if breached:
+            reason = f"Guardrails breached during the experiment: {breached}"
+            stop_experiment(experiment, reason)
+            raise GuardrailError(reason)
+
+        return {
+            "status": "Running",
+            "interval": interval,
+            "experiment": experiment,
+            "cursor": cursor.isoformat(),
+        }
+
+    except Exception as e:
+        (
+            exception_type,
+            exception_value,
+            exception_traceback,
+        ) = sys.exc_info()
+        traceback_string = traceback.format_exception(
+            exception_type, exception_value, exception_traceback
+        )
+        err_msg = json.dumps(
+            {
+                "errorType": exception_type.__name__,
+                "errorMessage": str(exception_value),
+                "stackTrace": traceback_string,
+            }
+        )
+        logger.error(err_msg)
+        raise offload_error(e, err_msg, str(test_input.get("testId", "test")))
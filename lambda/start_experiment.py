@@ -4,27 +4,24 @@ import os
 import sys
 import traceback
 import uuid
-from datetime import datetime
 
 import boto3
+from chaos_machine.clients import LazyClient
+from chaos_machine.instrumentation import instrumented
+from chaos_machine.log import Payload
+from chaos_machine.payload import offload_error
 
 logger = logging.getLogger()
 logger.setLevel(os.getenv("LOG_LEVEL"))
 
-fis = boto3.client("fis")
-ddb = boto3.client("dynamodb")
-
-
-def datetime_handler(x):
-    if isinstance(x, datetime):
-        return x.isoformat()
-    raise TypeError("Unknown type")
+fis = LazyClient("fis")
+ddb = LazyClient("dynamodb")
+ssm = LazyClient("ssm")
 
 
+@instrumented("start-experiment")
 def lambda_handler(event, context):
-    logger.info(
-        f"Event received: {json.dumps(event, default=datetime_handler, indent=4)}"
-    )
+    logger.info("Event received: %s", Payload(event))
     logger.info(f"boto3 version: {boto3.__version__}")
 
     try:
@@ -34,19 +31,22 @@ def lambda_handler(event, context):
                 clientToken=client_token,
                 experimentTemplateId=event["Input"]["experimentTemplateId"],
             )
-            logger.info(
-                f"Experiment: {json.dumps(experiment, default=datetime_handler, indent=4)}"
-            )
+            logger.info("Experiment: %s", Payload(experiment))
             experiment_type = "FIS"
             experiment_id = experiment["experiment"]["id"]
+            # FIS completion events have no start time, so it is kept with the
+            # test, or the creation time if the experiment has not started yet.
+            start_time = experiment["experiment"].get(
+                "startTime", experiment["experiment"].get("creationTime")
+            )
 
         elif "automationDocumentName" in event["Input"]:
-            ssm = boto3.client("ssm")
             automation = ssm.start_automation_execution(
                 DocumentName=event["Input"]["automationDocumentName"]
             )
             experiment_type = "SSM"
             experiment_id = automation["AutomationExecutionId"]
+            start_time = None
 
         item = {
             "testId": {"S": event["Input"]["testId"]},
@@ -55,6 +55,8 @@ def lambda_handler(event, context):
             "taskToken": {"S": event["TaskToken"]},
             "executionName": {"S": event["ExecutionName"]},
         }
+        if start_time is not None:
+            item["startTime"] = {"S": start_time.isoformat()}
         if "testDescription" in event["Input"]:
             item["testDescription"] = {"S": event["Input"]["testDescription"]}
         ddb.put_item(TableName=event["TableName"], Item=item)
@@ -77,7 +79,5 @@ def lambda_handler(event, context):
         )
         logger.error(err_msg)
         response = fis.stop_experiment(id=experiment["experiment"]["id"])
-        logger.error(
-            f"Stopping experiment: {json.dumps(response, default=datetime_handler, indent=4)}"
-        )
-        raise e
+        logger.error("Stopping experiment: %s", Payload(response))
+        raise offload_error(e, err_msg, str(event["Input"].get("testId", "test")))
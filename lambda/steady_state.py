@@ -3,23 +3,52 @@ import logging
 import os
 import sys
 import traceback
-from datetime import datetime, timedelta, timezone
+import uuid
+from functools import lru_cache
 
 import boto3
-import urllib3
-from jsonschema import validate
+from chaos_machine.baseline import get_bounds, update_baselines
+from chaos_machine.cloudwatch import alarms_in_state, get_alarms
+from chaos_machine.evaluation import failed_verdicts
+from chaos_machine.instrumentation import instrumented, timer
+from chaos_machine.log import Payload
+from chaos_machine.metrics import (
+    evaluate_metrics,
+    get_definitions,
+    get_metrics,
+    missing_expressions,
+    plan_windows,
+    refetch_time,
+    slide_results,
+)
+from chaos_machine.payload import offload_error, offload_input, resolve, truncate
+from chaos_machine.snapshot import recorded, recording
+from chaos_machine.timing import lookback_window, now
+from jsonschema.exceptions import best_match
+from jsonschema.validators import validator_for
 
 logger = logging.getLogger()
 logger.setLevel(os.getenv("LOG_LEVEL"))
 
-fis = boto3.client("fis")
-cw = boto3.client("cloudwatch")
+SCHEMA_PATH = os.getenv("SCHEMA_PATH", "/opt/schemas/chaos-machine-input.json")
 
+# While waiting for steady state, the window of each check is kept for the life
+# of the container, by a token passed to the next check in the state, so the next
+# check only fetches the datapoints since. Up to this many windows are kept.
+STEADY_STATE_WINDOWS = 16
+STEADY_STATE_DEFAULT_INTERVAL = 60
 
-def datetime_handler(x):
-    if isinstance(x, datetime):
-        return x.isoformat()
-    raise TypeError("Unknown type")
+windows = {}
+
+
+@lru_cache(maxsize=None)
+def get_validator():
+    # The schema is loaded and checked once per container.
+    with open(SCHEMA_PATH, "r") as f:
+        schema = json.load(f)
+    validator = validator_for(schema)
+    validator.check_schema(schema)
+    return validator(schema)
 
 
 class SteadyStateError(Exception):
@@ -31,215 +60,151 @@ class SteadyStateError(Exception):
         return f"{self.message}"
 
 
-def get_cw_metrics(metrics, start_time, end_time, type):
-    logger.info(f"Retrieving metrics from {start_time} to {end_time}.")
-    response = cw.get_metric_data(
-        MetricDataQueries=metrics,
-        StartTime=start_time,
-        EndTime=end_time,
+def evaluate_steady_state_metrics(results, definitions, bounds=None):
+    expressions_not_steady_state = failed_verdicts(
+        evaluate_metrics(results, definitions, bounds)
     )
-    logger.info(
-        f"{type} CloudWatch metrics: {json.dumps(response, default=datetime_handler, indent=4)}"
-    )
-    for result in response["MetricDataResults"]:
-        if not result["Values"]:
-            raise SteadyStateError(
-                f"The {type} metric {result['Id']} does not return any values."
-            )
-
-    return response
-
-
-def get_prom_metrics(metrics, start_time, end_time, prometheus_url, type):
-    http = urllib3.PoolManager()
-    prometheus_data_results = {"PrometheusDataResults": []}
-    logger.info(f"Retrieving metrics from {start_time} to {end_time}.")
-    for metric in metrics:
-        response = http.request(
-            "GET",
-            f"{prometheus_url}/api/v1/query_range",
-            fields={
-                "query": str(metric.get("query")),
-                "start": start_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                "end": end_time.strftime("%Y-%m-%dT%H:%M:%SZ"),
-                "step": str(metric.get("step")),
-            },
-        )
-
-        response_decoded = json.loads(response.data.decode("utf-8"))
-        response_decoded["data"]["result"][0]["metric"] = str(metric.get("Id"))
-        prometheus_data_results["PrometheusDataResults"].append(response_decoded)
-    logger.info(
-        f"{type} Prometheus metrics: {json.dumps(prometheus_data_results, default=datetime_handler, indent=4)}"
-    )
-
-    return prometheus_data_results
-
-
-def evaluate_steady_state_cw_metrics(metrics):
-    found_expression = False
-    expressions_not_steady_state = []
-    for result in metrics["MetricDataResults"]:
-        id = result["Id"]
-        if id.startswith("e"):
-            found_expression = True
-            logger.info(
-                f"Evaluating expression: {json.dumps(result, default=datetime_handler, indent=4)}"
-            )
-            if any(value == 0 for value in result["Values"]):
-                expressions_not_steady_state.append(id)
-                logger.info(f"Expression {id} is not in steady state.")
-
     if expressions_not_steady_state:
         raise SteadyStateError(
             f"Expressions not in steady state: {expressions_not_steady_state}"
         )
 
-    if not found_expression:
+    if missing_expressions(results):
         logger.info("No steady state expression found.")
         raise SteadyStateError("No steady state expression found.")
 
     return
 
 
-def evaluate_steady_state_prom_metrics(metrics):
-    found_expression = False
-    expressions_not_steady_state = []
-    for result in metrics["PrometheusDataResults"]:
-        id = result["data"]["result"][0]["metric"]
-        if id.startswith("e"):
-            found_expression = True
-            logger.info(
-                f"Evaluating expression: {json.dumps(result, default=datetime_handler, indent=4)}"
-            )
-            if any(value[1] == "0" for value in result["data"]["result"][0]["values"]):
-                expressions_not_steady_state.append(id)
-                logger.info(f"Expression {id} is not in steady state.")
-
-    if expressions_not_steady_state:
-        raise SteadyStateError(
-            f"Expressions not in steady state: {expressions_not_steady_state}"
+def get_steady_state_metrics(event, start_time, end_time, window):
+    # Slides the window of the previous check forward when it is kept. Snapshots
+    # fetch the whole window, so they can be replayed on their own.
+    metrics = event["steadyState"]["metrics"]
+    previous = windows.pop(window, None) if window else None
+    if previous is None or recording() or not start_time < previous["end"] <= end_time:
+        return get_metrics(
+            metrics, start_time, end_time, event.get("prometheusUrl"), "steadyState"
         )
-
-    if not found_expression:
-        logger.info("No steady state expression found.")
-        raise SteadyStateError("No steady state expression found.")
-
-    return
-
-
-def get_alarms(alarms):
-    response = cw.describe_alarms(
-        AlarmNames=alarms,
-        AlarmTypes=["MetricAlarm", "CompositeAlarm"],
+    refetch_start = refetch_time(previous["results"], start_time)
+    logger.info(f"Sliding the steady state window, fetching from {refetch_start}.")
+    results = get_metrics(
+        metrics, refetch_start, end_time, event.get("prometheusUrl"), "steadyState"
     )
-    logger.info(
-        f"Steady state alarms: {json.dumps(response, default=datetime_handler, indent=4)}"
+    return slide_results(
+        previous["results"], results, plan_windows(metrics, start_time, end_time)
     )
-    return response
 
 
-def evaluate_steady_state_alarms(alarms):
-    alarms_not_steady_state = []
-    for composite_alarm in alarms["CompositeAlarms"]:
-        logger.info(
-            f"Evaluating composite alarm: {json.dumps(composite_alarm, default=datetime_handler, indent=4)}"
-        )
-        if composite_alarm["StateValue"] in ["ALARM", "INSUFFICIENT_DATA"]:
-            alarms_not_steady_state.append(composite_alarm["AlarmName"])
-            logger.info(
-                f"Composite alarm {composite_alarm['AlarmName']} is not in steady state."
+def keep_window(end_time, results):
+    if len(windows) >= STEADY_STATE_WINDOWS:
+        windows.clear()
+    window = str(uuid.uuid4())
+    windows[window] = {"end": end_time, "results": results}
+    return window
+
+
+def wait_for_steady_state(event, error):
+    # Returns the next check, or None once steadyStateTimeout is spent and the
+    # test fails.
+    previous = event.get("steadyStateResult", {})
+    if previous.get("nextState") != "NotSteadyState":
+        previous = {"attempt": 0, "waited": 0}
+    timeout = event.get("steadyStateTimeout", 0)
+    if previous["waited"] >= timeout:
+        if timeout:
+            logger.warning(
+                f"Not in steady state after waiting {previous['waited']} seconds."
             )
+        return None
 
-    for metric_alarm in alarms["MetricAlarms"]:
-        logger.info(
-            f"Evaluating metric alarm: {json.dumps(metric_alarm, default=datetime_handler, indent=4)}"
-        )
-        if metric_alarm["StateValue"] in ["ALARM", "INSUFFICIENT_DATA"]:
-            alarms_not_steady_state.append(metric_alarm["AlarmName"])
-            logger.info(
-                f"Metric alarm {metric_alarm['AlarmName']} is not in steady state."
-            )
+    wait = min(
+        event.get("steadyStateInterval", STEADY_STATE_DEFAULT_INTERVAL),
+        timeout - previous["waited"],
+    )
+    logger.info(f"{error} Checking again in {wait} seconds.")
+    return {
+        "nextState": "NotSteadyState",
+        "attempt": previous["attempt"] + 1,
+        "waited": previous["waited"] + wait,
+        "wait": wait,
+        # The reason is carried by every check, so a long one, e.g. with many
+        # series, is truncated.
+        "reason": truncate(str(error)),
+    }
 
+
+def evaluate_steady_state_alarms(alarms):
+    alarms_not_steady_state = alarms_in_state(alarms, ["ALARM", "INSUFFICIENT_DATA"])
     if alarms_not_steady_state:
         raise SteadyStateError(f"Alarms not in steady state: {alarms_not_steady_state}")
 
     return
 
 
-def filter_metrics(metrics, metric_format):
-    filtered_metrics = [
-        metric
-        for metric in metrics
-        if metric.get("metricFormat", "CloudWatch") == metric_format
-    ]
-    for metric in filtered_metrics:
-        metric.pop("metricFormat", None)
-        if metric_format == "CloudWatch":
-            metric["ReturnData"] = True
-    logger.info(
-        f"{metric_format} metrics specified in steadyState: {json.dumps(filtered_metrics, default=datetime_handler, indent=4)}"
-    )
-    return filtered_metrics
-
-
+@instrumented("steady-state")
+@recorded("steady-state")
 def lambda_handler(event, context):
-    logger.info(
-        f"Event received: {json.dumps(event, default=datetime_handler, indent=4)}"
-    )
+    logger.info("Event received: %s", Payload(event))
     logger.info(f"boto3 version: {boto3.__version__}")
 
-    metrics_end_time = datetime.now(timezone.utc)
-    delta = timedelta(seconds=event.get("lookback", 300))
-    metrics_start_time = metrics_end_time - delta
+    metrics_start_time, metrics_end_time = lookback_window(event, now())
 
     try:
-        with open("/opt/schemas/chaos-machine-input.json", "r") as f:
-            schema = json.load(f)
-        validate(instance=event, schema=schema)
-
-        # Metrics
-
-        if "metrics" in event["steadyState"]:
-            steady_state_cw_metrics = filter_metrics(
-                event["steadyState"]["metrics"], "CloudWatch"
-            )
-            steady_state_prom_metrics = filter_metrics(
-                event["steadyState"]["metrics"], "Prometheus"
-            )
-
-            # CloudWatch
-
-            if steady_state_cw_metrics:
-                steady_state_cw_metrics_results = get_cw_metrics(
-                    steady_state_cw_metrics,
-                    metrics_start_time,
-                    metrics_end_time,
-                    "steadyState",
+        # The state continues with the large test definitions replaced by
+        # references to the payload store, see PAYLOAD_URI.
+        state = offload_input(event)
+        event = resolve(event)
+
+        with timer("SchemaValidation"):
+            error = best_match(get_validator().iter_errors(event))
+        if error is not None:
+            raise error
+
+        window = event.get("steadyStateResult", {}).get("window")
+        steady_state_metrics_results = None
+        try:
+            # Metrics
+
+            if "metrics" in event["steadyState"]:
+                steady_state_metrics_results = get_steady_state_metrics(
+                    event, metrics_start_time, metrics_end_time, window
                 )
-
-                evaluate_steady_state_cw_metrics(steady_state_cw_metrics_results)
-
-            # Prometheus
-
-            if steady_state_prom_metrics:
-                prometheus_url = event.get("prometheusUrl")
-                steady_state_prom_metrics_results = get_prom_metrics(
-                    steady_state_prom_metrics,
-                    metrics_start_time,
-                    metrics_end_time,
-                    prometheus_url,
-                    "steadyState",
+                definitions = get_definitions(event["steadyState"]["metrics"])
+                baselines, bounds = get_bounds(
+                    event["testId"], steady_state_metrics_results, definitions
+                )
+                evaluate_steady_state_metrics(
+                    steady_state_metrics_results, definitions, bounds
                 )
 
-                evaluate_steady_state_prom_metrics(steady_state_prom_metrics_results)
+            # Alarms
 
-        # Alarms
+            if "alarms" in event["steadyState"]:
+                steady_state_alarms = get_alarms(
+                    event["steadyState"]["alarms"], "steadyState"
+                )
+                evaluate_steady_state_alarms(steady_state_alarms)
+
+        except SteadyStateError as e:
+            # With steadyStateTimeout, the state machine waits and checks again.
+            next_check = wait_for_steady_state(event, e)
+            if next_check is None:
+                raise
+            if steady_state_metrics_results is not None:
+                next_check["window"] = keep_window(
+                    metrics_end_time, steady_state_metrics_results
+                )
+            state["steadyStateResult"] = next_check
+            return state
 
-        if "alarms" in event["steadyState"]:
-            steady_state_alarms = get_alarms(event["steadyState"]["alarms"])
+        # Baselines learn from windows in steady state only.
+        if "metrics" in event["steadyState"]:
+            update_baselines(
+                event["testId"], steady_state_metrics_results, definitions, baselines
+            )
 
-            evaluate_steady_state_alarms(steady_state_alarms)
+        state["steadyStateResult"] = {"nextState": "SteadyState"}
+        return state
 
     except Exception as e:
         (
@@ -258,4 +223,4 @@ def lambda_handler(event, context):
             }
         )
         logger.error(err_msg)
-        raise e
+        raise offload_error(e, err_msg, str(event.get("testId", "test")))
@@ -0,0 +1,377 @@
+import copy
+import json
+import re
+import uuid
+
+from local.scheduler import Join, Sleep, Token
+
+# A subset of the Amazon States Language that covers the chaos machine
+# definition: Task (including .waitForTaskToken), Parallel, Choice, Wait, Pass,
+# Succeed and Fail states, Retry and Catch, paths, and the intrinsic functions it
+# uses.
+
+# Step Functions fails an execution whose state is larger than 256 KiB.
+STATE_MAX_BYTES = 262144
+
+PATH_TOKEN = re.compile(r"\.([A-Za-z_][\w-]*)|\[(\d+)\]")
+
+
+class StatesError(Exception):
+    def __init__(self, error, cause=None, state=None):
+        self.error = error
+        self.cause = cause
+        self.state = state
+        super().__init__(f"{error}: {cause}")
+
+
+def parse_path(path):
+    if path == "$":
+        return []
+    if not path.startswith("$"):
+        raise StatesError("States.Runtime", f"Invalid path: {path}")
+    tokens = []
+    position = 1
+    for match in PATH_TOKEN.finditer(path, 1):
+        if match.start() != position:
+            raise StatesError("States.Runtime", f"Invalid path: {path}")
+        tokens.append(match.group(1) if match.group(1) else int(match.group(2)))
+        position = match.end()
+    if position != len(path):
+        raise StatesError("States.Runtime", f"Invalid path: {path}")
+    return tokens
+
+
+def get_path(data, path, context=None):
+    if path.startswith("$$"):
+        data, path = context, path[1:]
+    for token in parse_path(path):
+        try:
+            data = data[token]
+        except (KeyError, IndexError, TypeError):
+            raise StatesError(
+                "States.Runtime", f"The path {path} does not exist in the input."
+            )
+    return data
+
+
+def has_path(data, path, context=None):
+    try:
+        get_path(data, path, context)
+    except StatesError:
+        return False
+    return True
+
+
+def set_path(data, path, value):
+    if path is None:
+        return data
+    tokens = parse_path(path)
+    if not tokens:
+        return value
+    data = copy.copy(data) if isinstance(data, dict) else {}
+    target = data
+    for token in tokens[:-1]:
+        child = target.get(token)
+        target[token] = copy.copy(child) if isinstance(child, dict) else {}
+        target = target[token]
+    target[tokens[-1]] = value
+    return data
+
+
+def split_arguments(arguments):
+    parts = []
+    depth = 0
+    quoted = False
+    current = ""
+    for character in arguments:
+        if character == "'" and not current.endswith("\\"):
+            quoted = not quoted
+        if not quoted and character == "(":
+            depth += 1
+        if not quoted and character == ")":
+            depth -= 1
+        if not quoted and depth == 0 and character == ",":
+            parts.append(current.strip())
+            current = ""
+            continue
+        current += character
+    if current.strip():
+        parts.append(current.strip())
+    return parts
+
+
+def intrinsic(expression, data, context):
+    match = re.fullmatch(r"(States\.\w+)\((.*)\)", expression.strip(), re.DOTALL)
+    if not match:
+        raise StatesError("States.Runtime", f"Invalid intrinsic: {expression}")
+    name, arguments = match.groups()
+    values = []
+    for argument in split_arguments(arguments):
+        if argument.startswith("$"):
+            values.append(get_path(data, argument, context))
+        elif argument.startswith("States."):
+            values.append(intrinsic(argument, data, context))
+        elif argument.startswith("'"):
+            values.append(argument[1:-1].replace("\\'", "'"))
+        else:
+            values.append(json.loads(argument))
+
+    if name == "States.MathAdd":
+        return values[0] + values[1]
+    if name == "States.StringToJson":
+        return json.loads(values[0])
+    if name == "States.JsonToString":
+        return json.dumps(values[0], separators=(",", ":"))
+    if name == "States.Format":
+        template, arguments = values[0], iter(values[1:])
+        return re.sub(r"\{\}", lambda _: str(next(arguments)), template)
+    if name == "States.Array":
+        return values
+    if name == "States.UUID":
+        return str(uuid.uuid4())
+    raise StatesError("States.Runtime", f"Unsupported intrinsic: {name}")
+
+
+def resolve(template, data, context):
+    if isinstance(template, dict):
+        resolved = {}
+        for key, value in template.items():
+            if key.endswith(".$"):
+                if value.startswith("States."):
+                    resolved[key[:-2]] = intrinsic(value, data, context)
+                else:
+                    resolved[key[:-2]] = copy.deepcopy(get_path(data, value, context))
+            else:
+                resolved[key] = resolve(value, data, context)
+        return resolved
+    if isinstance(template, list):
+        return [resolve(value, data, context) for value in template]
+    return template
+
+
+COMPARISONS = {
+    "StringEquals": lambda a, b: isinstance(a, str) and a == b,
+    "StringLessThan": lambda a, b: isinstance(a, str) and a < b,
+    "StringGreaterThan": lambda a, b: isinstance(a, str) and a > b,
+    "NumericEquals": lambda a, b: is_number(a) and a == b,
+    "NumericLessThan": lambda a, b: is_number(a) and a < b,
+    "NumericLessThanEquals": lambda a, b: is_number(a) and a <= b,
+    "NumericGreaterThan": lambda a, b: is_number(a) and a > b,
+    "NumericGreaterThanEquals": lambda a, b: is_number(a) and a >= b,
+    "BooleanEquals": lambda a, b: isinstance(a, bool) and a == b,
+}
+
+
+def is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def matches(rule, data, context):
+    if "And" in rule:
+        return all(matches(child, data, context) for child in rule["And"])
+    if "Or" in rule:
+        return any(matches(child, data, context) for child in rule["Or"])
+    if "Not" in rule:
+        return not matches(rule["Not"], data, context)
+
+    variable = rule["Variable"]
+    if "IsPresent" in rule:
+        return has_path(data, variable, context) == rule["IsPresent"]
+    value = get_path(data, variable, context)
+    if "IsNull" in rule:
+        return (value is None) == rule["IsNull"]
+    if "IsString" in rule:
+        return isinstance(value, str) == rule["IsString"]
+    if "IsNumeric" in rule:
+        return is_number(value) == rule["IsNumeric"]
+    if "IsBoolean" in rule:
+        return isinstance(value, bool) == rule["IsBoolean"]
+    for name, comparison in COMPARISONS.items():
+        if name in rule:
+            return comparison(value, rule[name])
+        if f"{name}Path" in rule:
+            return comparison(value, get_path(data, rule[f"{name}Path"], context))
+    raise StatesError("States.Runtime", f"Unsupported choice rule: {rule}")
+
+
+# Errors that States.ALL does not catch.
+TERMINAL_ERRORS = ["States.DataLimitExceeded"]
+
+
+def error_matches(error_equals, error):
+    if "States.ALL" in error_equals:
+        return error not in TERMINAL_ERRORS
+    if "States.TaskFailed" in error_equals and error != "States.Timeout":
+        return True
+    return error in error_equals
+
+
+class Interpreter:
+    def __init__(self, invoke, history=None):
+        # invoke(function_name, payload) runs a Lambda function in-process.
+        self.invoke = invoke
+        self.history = history if history is not None else []
+        self.max_state_bytes = 0
+
+    def check_size(self, name, data):
+        size = len(json.dumps(data, separators=(",", ":")).encode("utf-8"))
+        self.max_state_bytes = max(self.max_state_bytes, size)
+        if size > STATE_MAX_BYTES:
+            raise StatesError(
+                "States.DataLimitExceeded",
+                f"The state of {name} is {size} bytes, more than {STATE_MAX_BYTES}.",
+                name,
+            )
+        return size
+
+    def run(self, definition, data, context):
+        states = definition["States"]
+        name = definition["StartAt"]
+        while True:
+            state = states[name]
+            self.history.append(
+                {
+                    "state": name,
+                    "type": state["Type"],
+                    "bytes": self.check_size(name, data),
+                }
+            )
+            if "InputPath" in state and state["InputPath"] is not None:
+                effective = get_path(data, state["InputPath"], context)
+            else:
+                effective = data
+
+            try:
+                output = yield from self.run_state(
+                    name, state, data, effective, context
+                )
+            except StatesError as e:
+                catcher = next(
+                    (
+                        catcher
+                        for catcher in state.get("Catch", [])
+                        if error_matches(catcher["ErrorEquals"], e.error)
+                    ),
+                    None,
+                )
+                if catcher is None:
+                    raise
+                self.history.append(
+                    {"state": name, "caught": e.error, "cause": e.cause}
+                )
+                data = set_path(
+                    data,
+                    catcher.get("ResultPath", "$"),
+                    {"Error": e.error, "Cause": e.cause},
+                )
+                name = catcher["Next"]
+                continue
+
+            if state["Type"] == "Choice":
+                name = output
+                continue
+            if state.get("OutputPath") is not None:
+                output = get_path(output, state.get("OutputPath", "$"), context)
+            if state["Type"] == "Succeed" or state.get("End"):
+                return output
+            data = output
+            name = state["Next"]
+
+    def apply_result(self, state, data, result, context):
+        if "ResultSelector" in state:
+            result = resolve(state["ResultSelector"], result, context)
+        if "ResultPath" in state and state["ResultPath"] is None:
+            return data
+        return set_path(data, state.get("ResultPath", "$"), result)
+
+    def run_state(self, name, state, data, effective, context):
+        type = state["Type"]
+        if type == "Pass":
+            result = state.get("Result", effective)
+            if "Parameters" in state:
+                result = resolve(state["Parameters"], effective, context)
+            return self.apply_result(state, data, result, context)
+
+        if type == "Choice":
+            for rule in state.get("Choices", []):
+                if matches(rule, effective, context):
+                    return rule["Next"]
+            if "Default" in state:
+                return state["Default"]
+            raise StatesError(
+                "States.NoChoiceMatched", f"No choice matched in {name}.", name
+            )
+
+        if type == "Wait":
+            if "Seconds" in state:
+                seconds = state["Seconds"]
+            elif "SecondsPath" in state:
+                seconds = get_path(effective, state["SecondsPath"], context)
+            else:
+                raise StatesError("States.Runtime", f"Unsupported wait in {name}.")
+            yield Sleep(seconds)
+            return data
+
+        if type == "Succeed":
+            return effective
+
+        if type == "Fail":
+            error = state.get("Error")
+            if "ErrorPath" in state:
+                error = get_path(effective, state["ErrorPath"], context)
+            cause = state.get("Cause")
+            if "CausePath" in state:
+                cause = get_path(effective, state["CausePath"], context)
+            raise StatesError(error, cause, name)
+
+        if type == "Parallel":
+            branches = [
+                self.run(branch, copy.deepcopy(effective), context)
+                for branch in state["Branches"]
+            ]
+            result = yield Join(branches)
+            return self.apply_result(state, data, result, context)
+
+        if type == "Task":
+            result = yield from self.run_task(name, state, effective, context)
+            return self.apply_result(state, data, result, context)
+
+        raise StatesError("States.Runtime", f"Unsupported state type {type}.")
+
+    def run_task(self, name, state, effective, context):
+        attempts = {}
+        while True:
+            try:
+                return (yield from self.invoke_task(state, effective, context))
+            except StatesError as e:
+                retrier = next(
+                    (
+                        retrier
+                        for retrier in state.get("Retry", [])
+                        if error_matches(retrier["ErrorEquals"], e.error)
+                    ),
+                    None,
+                )
+                if retrier is None:
+                    raise
+                attempt = attempts.get(id(retrier), 0)
+                if attempt >= retrier.get("MaxAttempts", 3):
+                    raise
+                attempts[id(retrier)] = attempt + 1
+                self.history.append({"state": name, "retry": e.error})
+                backoff = retrier.get("BackoffRate", 2.0) ** attempt
+                yield Sleep(retrier.get("IntervalSeconds", 1) * backoff)
+
+    def invoke_task(self, state, effective, context):
+        resource = state["Resource"]
+        if resource.endswith(".waitForTaskToken"):
+            token = str(uuid.uuid4())
+            task_context = dict(context, Task={"Token": token})
+            parameters = resolve(state["Parameters"], effective, task_context)
+            self.invoke(parameters["FunctionName"], parameters.get("Payload", {}))
+            return (yield Token(token))
+        if "Parameters" in state:
+            payload = resolve(state["Parameters"], effective, context)
+        else:
+            payload = effective
+        return self.invoke(resource, payload)
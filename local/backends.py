@@ -0,0 +1,622 @@
+import copy
+import itertools
+import json
+import random
+import re
+import uuid
+from datetime import datetime, timedelta
+
+from botocore.exceptions import ClientError
+from chaos_machine.prometheus import parse_prom_duration
+from chaos_machine.timing import time_ceil
+
+# Stand-ins for the AWS APIs and the Prometheus HTTP API used by the handlers.
+# Metric values, alarm states, and experiment outcomes come from a scenario, e.g.
+#
+# {
+#     "experiment": {"duration": 300, "status": "completed"},
+#     "metrics": {"e1": {"value": 1, "segments": [
+#         {"phase": "experiment", "offset": 60, "duration": 120, "value": 0}
+#     ]}},
+#     "alarms": {"PetSiteOkRate": {"segments": [
+#         {"phase": "experiment", "offset": 30, "state": "ALARM"}
+#     ]}}
+# }
+#
+# Segments are anchored to the start of the execution ("start"), or the start
+# ("experiment") or end ("end") of the experiment, and override the value or
+# state of a metric or alarm for their duration. A segment with "missing" drops
+# the datapoints. Segments in "errors" fail the CloudWatch calls, e.g.
+#
+#     "errors": {"cloudwatch": [
+#         {"phase": "experiment", "offset": 60, "code": "ThrottlingException"}
+#     ]}
+
+FIS_TERMINAL_STATUSES = ["completed", "stopped", "failed"]
+SSM_STATUSES = {
+    "pending": "Pending",
+    "running": "InProgress",
+    "completed": "Success",
+    "stopping": "Cancelling",
+    "stopped": "Cancelled",
+    "failed": "Failed",
+    "timedOut": "TimedOut",
+}
+
+
+def client_error(code, message, operation):
+    return ClientError({"Error": {"Code": code, "Message": message}}, operation)
+
+
+def ssm_event_time(time):
+    # Like "Nov 29, 2016 2:06:48 AM".
+    if time is None:
+        return None
+    hour = (time.hour - 1) % 12 + 1
+    return f"{time:%b} {time.day}, {time.year} {hour}:{time:%M:%S %p}"
+
+
+def to_datetime(value):
+    if isinstance(value, datetime):
+        return value
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+class Timeline:
+    def __init__(self, clock):
+        self.clock = clock
+        self.anchors = {"start": clock()}
+
+    def anchor(self, phase):
+        return self.anchors.get(phase)
+
+    def active(self, segments, time):
+        for segment in segments:
+            anchor = self.anchor(segment.get("phase", "experiment"))
+            if anchor is None:
+                continue
+            begin = anchor + timedelta(seconds=segment.get("offset", 0))
+            if time < begin:
+                continue
+            if "duration" in segment and time >= begin + timedelta(
+                seconds=segment["duration"]
+            ):
+                continue
+            yield segment
+
+    def boundaries(self, segments):
+        for segment in segments:
+            anchor = self.anchor(segment.get("phase", "experiment"))
+            if anchor is None:
+                continue
+            begin = anchor + timedelta(seconds=segment.get("offset", 0))
+            yield begin
+            if "duration" in segment:
+                yield begin + timedelta(seconds=segment["duration"])
+
+
+class Signals:
+    def __init__(self, profiles, timeline, seed=0):
+        self.profiles = profiles
+        self.timeline = timeline
+        self.seed = seed
+
+    def profile(self, id):
+        return self.profiles.get(id, self.profiles.get("*", {}))
+
+    def value(self, id, profile, time):
+        value = profile.get("value", 1)
+        for segment in self.timeline.active(profile.get("segments", []), time):
+            if segment.get("missing"):
+                return None
+            value = segment.get("value", value)
+        jitter = profile.get("jitter")
+        if jitter:
+            value += random.Random(f"{self.seed}{id}{time.timestamp()}").uniform(
+                -jitter, jitter
+            )
+        return value
+
+    def state(self, profile, time):
+        state = profile.get("state", "OK")
+        for segment in self.timeline.active(profile.get("segments", []), time):
+            state = segment.get("state", state)
+        return state
+
+
+class CloudWatch:
+    # Datapoints are published publishDelay seconds after their period ends.
+    def __init__(self, clock, signals, alarms, publish_delay=0, errors=None):
+        self.clock = clock
+        self.signals = signals
+        self.alarms = alarms
+        self.publish_delay = timedelta(seconds=publish_delay)
+        self.errors = errors or []
+        self.calls = 0
+
+    def fail(self, operation):
+        for segment in self.signals.timeline.active(self.errors, self.clock()):
+            if segment.get("operation", operation) == operation:
+                raise client_error(
+                    segment.get("code", "ThrottlingException"),
+                    segment.get("message", "Rate exceeded"),
+                    operation,
+                )
+
+    def get_metric_data(self, MetricDataQueries, StartTime, EndTime, **kwargs):
+        self.calls += 1
+        self.fail("GetMetricData")
+        now = self.clock()
+        results = []
+        for query in MetricDataQueries:
+            if not query.get("ReturnData", True):
+                continue
+            period = query.get("MetricStat", {}).get("Period") or query.get(
+                "Period", 60
+            )
+            delta = timedelta(seconds=period)
+            profile = self.signals.profile(query["Id"])
+            timestamps = []
+            values = []
+            time = time_ceil(to_datetime(StartTime), delta)
+            while (
+                time < to_datetime(EndTime) and time + delta + self.publish_delay <= now
+            ):
+                value = self.signals.value(query["Id"], profile, time)
+                if value is not None:
+                    timestamps.append(time)
+                    values.append(value)
+                time += delta
+            results.append(
+                {
+                    "Id": query["Id"],
+                    "Label": query["Id"],
+                    "Timestamps": timestamps[::-1],
+                    "Values": values[::-1],
+                    "StatusCode": "Complete",
+                }
+            )
+        return {"MetricDataResults": results, "Messages": []}
+
+    def alarm(self, name):
+        profile = self.alarms.get(name, {})
+        return {
+            "AlarmName": name,
+            "StateValue": self.signals.state(profile, self.clock()),
+            "StateUpdatedTimestamp": self.clock(),
+        }, profile.get("type", "MetricAlarm")
+
+    def describe_alarms(
+        self, AlarmNames=None, MaxRecords=100, NextToken=None, **kwargs
+    ):
+        self.calls += 1
+        self.fail("DescribeAlarms")
+        names = AlarmNames if AlarmNames else sorted(self.alarms)
+        start = int(NextToken or 0)
+        end = start + MaxRecords
+        page = names[start:end]
+        response = {"MetricAlarms": [], "CompositeAlarms": []}
+        for name in page:
+            alarm, type = self.alarm(name)
+            key = "CompositeAlarms" if type == "CompositeAlarm" else "MetricAlarms"
+            response[key].append(alarm)
+        if end < len(names):
+            response["NextToken"] = str(end)
+        return response
+
+    def describe_alarm_history(
+        self, StartDate, EndDate, AlarmName=None, NextToken=None, **kwargs
+    ):
+        self.calls += 1
+        self.fail("DescribeAlarmHistory")
+        names = [AlarmName] if AlarmName else sorted(self.alarms)
+        items = []
+        for name in names:
+            profile = self.alarms.get(name, {})
+            segments = profile.get("segments", [])
+            for time in sorted(set(self.signals.timeline.boundaries(segments))):
+                if not to_datetime(StartDate) <= time <= to_datetime(EndDate):
+                    continue
+                if time > self.clock():
+                    continue
+                old_state = self.signals.state(profile, time - timedelta(seconds=1))
+                new_state = self.signals.state(profile, time)
+                if old_state == new_state:
+                    continue
+                items.append(
+                    {
+                        "AlarmName": name,
+                        "AlarmType": profile.get("type", "MetricAlarm"),
+                        "Timestamp": time,
+                        "HistoryItemType": "StateUpdate",
+                        "HistorySummary": f"Alarm updated from {old_state} to {new_state}",
+                        "HistoryData": json.dumps(
+                            {
+                                "version": "1.0",
+                                "oldState": {"stateValue": old_state},
+                                "newState": {"stateValue": new_state},
+                            }
+                        ),
+                    }
+                )
+        items.sort(key=lambda item: item["Timestamp"], reverse=True)
+        start = int(NextToken or 0)
+        end = start + 100
+        response = {"AlarmHistoryItems": items[start:end]}
+        if end < len(items):
+            response["NextToken"] = str(end)
+        return response
+
+
+class PrometheusResponse:
+    def __init__(self, body):
+        self.data = json.dumps(body).encode("utf-8")
+
+    def stream(self, amt):
+        for start in range(0, len(self.data), amt):
+            end = start + amt
+            yield self.data[start:end]
+
+    def release_conn(self):
+        pass
+
+
+class Prometheus:
+    # Replaces the urllib3 pool manager. Queries are matched to the metric Ids of
+    # the scenario input by their PromQL.
+    def __init__(self, clock, signals, queries, publish_delay=0):
+        self.clock = clock
+        self.signals = signals
+        self.queries = queries
+        self.publish_delay = timedelta(seconds=publish_delay)
+        self.calls = 0
+
+    def request(self, method, url, fields=None, timeout=None, **kwargs):
+        self.calls += 1
+        id = self.queries.get(fields["query"], fields["query"])
+        profile = self.signals.profile(id)
+        start = to_datetime(fields["start"])
+        end = to_datetime(fields["end"])
+        step = timedelta(seconds=parse_prom_duration(fields["step"]))
+        latest = self.clock() - self.publish_delay
+        result = []
+        for series in profile.get("series", [{}]):
+            series_profile = dict(profile, **series)
+            values = []
+            time = start
+            while time <= end and time <= latest:
+                value = self.signals.value(id, series_profile, time)
+                if value is not None:
+                    values.append([time.timestamp(), str(value)])
+                time += step
+            if values:
+                result.append({"metric": series.get("labels", {}), "values": values})
+        return PrometheusResponse(
+            {"status": "success", "data": {"resultType": "matrix", "result": result}}
+        )
+
+
+class EventBus:
+    # Delivers experiment state changes that match the continue-execution rules.
+    def __init__(self, scheduler, deliver, delay=1):
+        self.scheduler = scheduler
+        self.deliver = deliver
+        self.delay = timedelta(seconds=delay)
+
+    def put(self, event):
+        self.scheduler.at(
+            self.scheduler.clock() + self.delay, lambda: self.deliver(event)
+        )
+
+
+class Queue:
+    # Buffers events like the optional continue-execution SQS queue, and delivers
+    # them in batches of SQS records once a batch is full or its window is over.
+    def __init__(self, scheduler, deliver, batch_size=10, window=0):
+        self.scheduler = scheduler
+        self.deliver = deliver
+        self.batch_size = batch_size
+        self.window = timedelta(seconds=window)
+        self.records = []
+        self.ids = itertools.count(1)
+        self.failures = []
+
+    def put(self, event):
+        self.records.append(
+            {"messageId": f"message-{next(self.ids)}", "body": json.dumps(event)}
+        )
+        if len(self.records) >= self.batch_size:
+            self.flush()
+        elif len(self.records) == 1:
+            self.scheduler.at(self.scheduler.clock() + self.window, self.flush)
+
+    def flush(self):
+        records, self.records = self.records, []
+        if records:
+            response = self.deliver({"Records": records}) or {}
+            self.failures += response.get("batchItemFailures", [])
+
+
+class Experiments:
+    # The FIS and SSM stand-ins share the experiment lifecycle of the scenario.
+    def __init__(self, scheduler, timeline, bus, settings):
+        self.scheduler = scheduler
+        self.timeline = timeline
+        self.bus = bus
+        self.settings = settings
+        self.experiments = {}
+        self.ids = itertools.count(1)
+
+    def start(self, type, reference):
+        if self.settings.get("startError"):
+            raise client_error(
+                "ValidationException", self.settings["startError"], "StartExperiment"
+            )
+        now = self.scheduler.clock()
+        if type == "FIS":
+            id = f"EXP{next(self.ids):013d}"
+        else:
+            id = str(uuid.uuid4())
+        experiment = {
+            "id": id,
+            "type": type,
+            "reference": reference,
+            "status": "pending",
+            "creationTime": now,
+        }
+        self.experiments[id] = experiment
+        start = now + timedelta(seconds=self.settings.get("startDelay", 5))
+        end = start + timedelta(seconds=self.settings.get("duration", 300))
+        self.scheduler.at(start, lambda: self.transition(id, "running"))
+        self.scheduler.at(
+            end, lambda: self.transition(id, self.settings.get("status", "completed"))
+        )
+        return experiment
+
+    def get(self, id, operation):
+        if id not in self.experiments:
+            raise client_error(
+                "ResourceNotFoundException", f"Experiment {id} not found.", operation
+            )
+        return self.experiments[id]
+
+    def stop(self, id, operation):
+        experiment = self.get(id, operation)
+        if experiment["status"] in FIS_TERMINAL_STATUSES:
+            return experiment
+        self.transition(id, "stopping")
+        stop_delay = timedelta(seconds=self.settings.get("stopDelay", 5))
+        self.scheduler.at(
+            self.scheduler.clock() + stop_delay, lambda: self.transition(id, "stopped")
+        )
+        return experiment
+
+    def transition(self, id, status):
+        experiment = self.experiments[id]
+        if experiment["status"] in FIS_TERMINAL_STATUSES:
+            return
+        now = self.scheduler.clock()
+        experiment["status"] = status
+        if status == "running":
+            experiment["startTime"] = now
+            self.timeline.anchors["experiment"] = now
+        if status in FIS_TERMINAL_STATUSES:
+            experiment["endTime"] = now
+            self.timeline.anchors["end"] = now
+            self.bus.put(self.event(experiment))
+
+    def event(self, experiment):
+        if experiment["type"] == "FIS":
+            return {
+                "source": "aws.fis",
+                "detail-type": "FIS Experiment State Change",
+                "time": experiment["endTime"].strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "detail": {
+                    "experiment-id": experiment["id"],
+                    "experiment-template-id": experiment["reference"],
+                    "new-state": {"status": experiment["status"]},
+                },
+            }
+        return {
+            "source": "aws.ssm",
+            "detail-type": "EC2 Automation Execution Status-change Notification",
+            "detail": {
+                "ExecutionId": experiment["id"],
+                "Definition": experiment["reference"],
+                "Status": SSM_STATUSES[experiment["status"]],
+                "StartTime": ssm_event_time(experiment.get("startTime")),
+                "EndTime": ssm_event_time(experiment["endTime"]),
+            },
+        }
+
+
+class FIS:
+    def __init__(self, experiments):
+        self.experiments = experiments
+
+    def describe(self, experiment):
+        description = {
+            "id": experiment["id"],
+            "experimentTemplateId": experiment["reference"],
+            "state": {"status": experiment["status"]},
+            "creationTime": experiment["creationTime"],
+        }
+        for key in ("startTime", "endTime"):
+            if key in experiment:
+                description[key] = experiment[key]
+        return {"experiment": description}
+
+    def start_experiment(self, experimentTemplateId, **kwargs):
+        return self.describe(self.experiments.start("FIS", experimentTemplateId))
+
+    def get_experiment(self, id):
+        return self.describe(self.experiments.get(id, "GetExperiment"))
+
+    def stop_experiment(self, id):
+        return self.describe(self.experiments.stop(id, "StopExperiment"))
+
+
+class SSM:
+    def __init__(self, experiments):
+        self.experiments = experiments
+
+    def describe(self, experiment):
+        description = {
+            "AutomationExecutionId": experiment["id"],
+            "DocumentName": experiment["reference"],
+            "AutomationExecutionStatus": SSM_STATUSES[experiment["status"]],
+        }
+        if "startTime" in experiment:
+            description["ExecutionStartTime"] = experiment["startTime"]
+        if "endTime" in experiment:
+            description["ExecutionEndTime"] = experiment["endTime"]
+        return description
+
+    def start_automation_execution(self, DocumentName, **kwargs):
+        experiment = self.experiments.start("SSM", DocumentName)
+        return {"AutomationExecutionId": experiment["id"]}
+
+    def get_automation_execution(self, AutomationExecutionId):
+        experiment = self.experiments.get(
+            AutomationExecutionId, "GetAutomationExecution"
+        )
+        return {"AutomationExecution": self.describe(experiment)}
+
+    def describe_automation_executions(self, Filters=None, **kwargs):
+        ids = [
+            value
+            for filter in Filters or []
+            if filter["Key"] == "ExecutionId"
+            for value in filter["Values"]
+        ]
+        return {
+            "AutomationExecutionMetadataList": [
+                self.describe(self.experiments.experiments[id])
+                for id in ids
+                if id in self.experiments.experiments
+            ]
+        }
+
+    def stop_automation_execution(self, AutomationExecutionId, Type="Cancel"):
+        self.experiments.stop(AutomationExecutionId, "StopAutomationExecution")
+        return {}
+
+
+class DynamoDB:
+    # Tables are lists of items in the attribute value format. Key conditions and
+    # filters support equality comparisons joined with AND.
+    def __init__(self, tables):
+        # tables maps a table name to its key names and its indexes, e.g.
+        # {"tests": {"keys": ["testId", "experimentId"], "indexes": {...}}}
+        self.tables = tables
+        self.items = {name: [] for name in tables}
+
+    def table(self, name, operation):
+        if name not in self.items:
+            raise client_error(
+                "ResourceNotFoundException", f"Table {name} not found.", operation
+            )
+        return self.items[name]
+
+    def key(self, table, item):
+        return tuple(
+            json.dumps(item.get(name), sort_keys=True)
+            for name in self.tables[table]["keys"]
+        )
+
+    def conditions(self, expression, values, names):
+        conditions = []
+        for condition in re.split(r"\s+AND\s+", expression or "", flags=re.I):
+            if not condition.strip():
+                continue
+            name, value = (part.strip() for part in condition.split("="))
+            conditions.append((names.get(name, name), values[value]))
+        return conditions
+
+    def put_item(self, TableName, Item, **kwargs):
+        items = self.table(TableName, "PutItem")
+        key = self.key(TableName, Item)
+        items[:] = [item for item in items if self.key(TableName, item) != key]
+        items.append(copy.deepcopy(Item))
+        return {}
+
+    def get_item(self, TableName, Key, **kwargs):
+        for item in self.table(TableName, "GetItem"):
+            if all(item.get(name) == value for name, value in Key.items()):
+                return {"Item": copy.deepcopy(item)}
+        return {}
+
+    def delete_item(self, TableName, Key, ReturnValues="NONE", **kwargs):
+        items = self.table(TableName, "DeleteItem")
+        for item in list(items):
+            if all(item.get(name) == value for name, value in Key.items()):
+                items.remove(item)
+                return {"Attributes": item} if ReturnValues == "ALL_OLD" else {}
+        return {}
+
+    def batch_get_item(self, RequestItems, **kwargs):
+        responses = {}
+        for table, request in RequestItems.items():
+            responses[table] = []
+            for key in request["Keys"]:
+                item = self.get_item(table, key).get("Item")
+                if item is not None:
+                    responses[table].append(item)
+        return {"Responses": responses, "UnprocessedKeys": {}}
+
+    def batch_write_item(self, RequestItems, **kwargs):
+        for table, requests in RequestItems.items():
+            for request in requests:
+                if "PutRequest" in request:
+                    self.put_item(table, request["PutRequest"]["Item"])
+                if "DeleteRequest" in request:
+                    self.delete_item(table, request["DeleteRequest"]["Key"])
+        return {"UnprocessedItems": {}}
+
+    def query(
+        self,
+        TableName,
+        KeyConditionExpression,
+        ExpressionAttributeValues,
+        IndexName=None,
+        FilterExpression=None,
+        ExpressionAttributeNames=None,
+        **kwargs,
+    ):
+        names = ExpressionAttributeNames or {}
+        conditions = self.conditions(
+            KeyConditionExpression, ExpressionAttributeValues, names
+        ) + self.conditions(FilterExpression, ExpressionAttributeValues, names)
+        projection = None
+        if IndexName is not None:
+            projection = self.tables[TableName]["indexes"][IndexName]
+        items = []
+        for item in self.table(TableName, "Query"):
+            if all(item.get(name) == value for name, value in conditions):
+                if projection is not None:
+                    item = {
+                        name: value
+                        for name, value in item.items()
+                        if name in projection
+                    }
+                items.append(copy.deepcopy(item))
+        return {"Items": items, "Count": len(items)}
+
+
+class StepFunctions:
+    def __init__(self, scheduler, failure):
+        self.scheduler = scheduler
+        # failure(error, cause) builds the error that fails the waiting task.
+        self.failure = failure
+
+    def send_task_success(self, taskToken, output):
+        if not self.scheduler.complete_token(taskToken, json.loads(output)):
+            raise client_error("TaskTimedOut", "Task Timed Out", "SendTaskSuccess")
+        return {}
+
+    def send_task_failure(self, taskToken, error=None, cause=None):
+        if not self.scheduler.complete_token(
+            taskToken, error=self.failure(error, cause)
+        ):
+            raise client_error("TaskTimedOut", "Task Timed Out", "SendTaskFailure")
+        return {}
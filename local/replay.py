@@ -0,0 +1,196 @@
+import argparse
+import json
+import os
+import sys
+import time
+
+from local.runner import load_handlers
+
+# Re-runs the steady state or hypothesis evaluation recorded in a snapshot. The
+# handler runs unchanged at the recorded time, and every CloudWatch, Prometheus,
+# FIS and SSM request is answered from the snapshot, so no AWS calls are made.
+# Changes to the evaluation settings of the input can be replayed. Expressions
+# and queries are computed by CloudWatch and Prometheus, so a changed expression
+# or query needs a new recording. The query cache is read with the settings it
+# was recorded with, so the same buckets are requested from the snapshot.
+
+# Responses for the write operations a handler makes when it fails.
+WRITE_RESPONSES = {
+    "batch_write_item": {"UnprocessedItems": {}},
+    "delete_item": {"Attributes": {}},
+    "put_item": {},
+}
+
+
+class NotRecordedError(Exception):
+    def __init__(self, message):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return f"{self.message}"
+
+
+def request_key(*parts):
+    from chaos_machine.snapshot import dumps
+
+    return dumps(parts)
+
+
+def call_key(service_name, operation, request, target=None):
+    # Calls to other regions and accounts are recorded with their target.
+    if target:
+        return request_key(service_name, operation, request, target)
+    return request_key(service_name, operation, request)
+
+
+class ReplayClient:
+    def __init__(self, service_name, responses, target=None):
+        self.service_name = service_name
+        self.responses = responses
+        self.target = target
+
+    def for_target(self, target):
+        return ReplayClient(self.service_name, self.responses, target)
+
+    def __getattr__(self, operation):
+        def replay(**kwargs):
+            key = call_key(self.service_name, operation, kwargs, self.target)
+            if key in self.responses:
+                return self.responses[key]
+            if operation in WRITE_RESPONSES:
+                return WRITE_RESPONSES[operation]
+            raise NotRecordedError(
+                f"{self.service_name}.{operation} was not recorded with this request."
+            )
+
+        return replay
+
+
+class ReplayResponse:
+    def __init__(self, data):
+        self.data = data.encode("utf-8")
+
+    def stream(self, amt):
+        for start in range(0, len(self.data), amt):
+            end = start + amt
+            yield self.data[start:end]
+
+    def release_conn(self):
+        pass
+
+
+class ReplayHttp:
+    def __init__(self, responses):
+        self.responses = responses
+
+    def request(self, method, url, fields=None, timeout=None, **kwargs):
+        key = request_key("prometheus", fields)
+        if key not in self.responses:
+            raise NotRecordedError(
+                f"Prometheus query {fields['query']} was not recorded from {fields['start']} to {fields['end']}."
+            )
+        return ReplayResponse(self.responses[key])
+
+
+def merge_input(event, overrides):
+    # The test definition is replaced, the state added by the state machine, e.g.
+    # the experiment Id, is kept.
+    return dict(event, **overrides)
+
+
+def replay(records, overrides=None):
+    from chaos_machine import cache, clients, payload, prometheus, timing
+
+    invocation = records[0]
+    responses = {}
+    prometheus_responses = {}
+    for record in records[1:]:
+        if record["type"] == "call":
+            responses.setdefault(record["service"], {})[
+                call_key(
+                    record["service"],
+                    record["operation"],
+                    record["request"],
+                    record.get("target"),
+                )
+            ] = record["response"]
+        if record["type"] == "payload":
+            payload.loaded[record["uri"]] = record["body"]
+        if record["type"] == "prometheus":
+            prometheus_responses[request_key("prometheus", record["request"])] = record[
+                "response"
+            ]
+    recorded = next((record for record in records if record["type"] == "result"), {})
+
+    modules = load_handlers()
+    for service_name in ("cloudwatch", "fis", "ssm", "dynamodb", "s3"):
+        clients.set_client(
+            service_name, ReplayClient(service_name, responses.get(service_name, {}))
+        )
+    prometheus.http = ReplayHttp(prometheus_responses)
+    timing.set_clock(lambda: invocation["time"])
+    settings = cache.settings()
+    cache.configure(invocation.get("cache", {}))
+
+    event = merge_input(invocation["event"], overrides or {})
+    started = time.perf_counter()
+    try:
+        result = {
+            "result": modules[invocation["handler"]].lambda_handler(
+                json.loads(json.dumps(event)), None
+            )
+        }
+    except Exception as e:
+        result = {"errorType": type(e).__name__, "errorMessage": str(e)}
+    finally:
+        timing.set_clock(None)
+        cache.configure(settings)
+        clients.clients.clear()
+    result["elapsed"] = time.perf_counter() - started
+    return invocation, recorded, result
+
+
+def format_outcome(outcome):
+    if "result" in outcome:
+        return json.dumps(outcome["result"])
+    return f"{outcome.get('errorType')}: {outcome.get('errorMessage')}"
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Replay a steady state or hypothesis evaluation from a snapshot."
+    )
+    parser.add_argument("snapshot", help="Path, file:// or s3:// URI of a snapshot.")
+    parser.add_argument(
+        "--input",
+        help="Execution input whose keys replace the recorded input, e.g. with changed evaluation settings.",
+    )
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--repeat", type=int, default=1)
+    args = parser.parse_args()
+
+    # Replays are not recorded again.
+    os.environ.pop("SNAPSHOT_URI", None)
+    os.environ["LOG_LEVEL"] = args.log_level
+    load_handlers()
+    from chaos_machine.snapshot import read_snapshot
+
+    records = read_snapshot(args.snapshot)
+    overrides = None
+    if args.input:
+        with open(args.input, "r") as f:
+            overrides = json.load(f)
+
+    for _ in range(args.repeat):
+        invocation, recorded, result = replay(records, overrides)
+    print(f"handler:  {invocation['handler']} at {invocation['time'].isoformat()}")
+    print(f"recorded: {format_outcome(recorded)}")
+    print(f"replayed: {format_outcome(result)}")
+    print(f"elapsed:  {result['elapsed'] * 1000:.1f} ms")
+    if result.get("errorType") == "NotRecordedError":
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
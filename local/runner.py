@@ -0,0 +1,420 @@
+import argparse
+import importlib
+import json
+import os
+import re
+import sys
+import tempfile
+import time
+import traceback
+from datetime import datetime, timedelta
+from pathlib import Path
+
+from local.asl import Interpreter, StatesError
+from local.scheduler import Scheduler, SimulatedClock
+
+# Runs the chaos machine state machine in-process against stand-in backends and a
+# simulated clock. The definition is read from main.tf and the Lambda functions
+# are the handlers in lambda/, so a scenario exercises the same code that is
+# deployed, without AWS credentials or network access.
+
+root = Path(__file__).resolve().parents[1]
+handlers = {
+    "steady-state": "steady_state",
+    "start-experiment": "start_experiment",
+    "monitor-experiment": "monitor_experiment",
+    "continue-execution": "continue_execution",
+    "evaluate-hypothesis": "evaluate_hypothesis",
+}
+
+TABLE_NAME = "chaos-machine-local-tests"
+BASELINES_TABLE_NAME = "chaos-machine-local-baselines"
+QUERY_CACHE_TABLE_NAME = "chaos-machine-local-query-cache"
+TABLES = {
+    TABLE_NAME: {
+        "keys": ["testId", "experimentId"],
+        "indexes": {
+            f"{TABLE_NAME}-experimentId": [
+                "testId",
+                "experimentId",
+                "taskToken",
+                "experimentType",
+                "startTime",
+            ]
+        },
+    },
+    BASELINES_TABLE_NAME: {"keys": ["testId", "metricId"], "indexes": {}},
+    QUERY_CACHE_TABLE_NAME: {"keys": ["queryId", "bucket"], "indexes": {}},
+}
+STATE_MACHINE_NAME = "chaos-machine-local"
+# A run that is still going after this many simulated seconds is timed out.
+DEFAULT_MAX_DURATION = 86400
+
+
+def load_definition(path=root / "main.tf"):
+    with open(path, "r") as f:
+        source = f.read()
+    match = re.search(r"definition = <<EOF\n(.*?)\nEOF", source, re.DOTALL)
+    definition = match.group(1)
+    definition = re.sub(
+        r'\$\{aws_lambda_function\.this\["([\w-]+)"\]\.(?:arn|function_name)\}',
+        r"\1",
+        definition,
+    )
+    definition = definition.replace("${data.aws_partition.current.partition}", "aws")
+    definition = definition.replace("${aws_dynamodb_table.this[0].name}", TABLE_NAME)
+    return json.loads(definition)
+
+
+def load_handlers():
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+    os.environ.setdefault(
+        "SCHEMA_PATH", str(root / "_docs" / "schemas" / "chaos-machine-input.json")
+    )
+    os.environ["EXPERIMENTS_TABLE"] = TABLE_NAME
+    os.environ["BASELINES_TABLE"] = BASELINES_TABLE_NAME
+    for path in (root / "lambda" / "layer", root / "lambda"):
+        if str(path) not in sys.path:
+            sys.path.insert(0, str(path))
+    return {name: importlib.import_module(module) for name, module in handlers.items()}
+
+
+def prometheus_queries(event):
+    queries = {}
+    for phase in ("steadyState", "hypothesis", "guardrail"):
+        if isinstance(event.get(phase), dict):
+            for metric in event[phase].get("metrics", []):
+                if "query" in metric:
+                    queries[str(metric["query"])] = metric["Id"]
+    return queries
+
+
+def resolve_path(path, base=root):
+    # Relative paths are resolved from the file that references them, or the root.
+    path = Path(path)
+    if not path.is_absolute():
+        path = base / path if (base / path).exists() else root / path
+    return path
+
+
+def load_input(scenario, base=root):
+    event = scenario.get("input")
+    if isinstance(event, str):
+        with open(resolve_path(event, base), "r") as f:
+            event = json.load(f)
+    event = dict(event, **scenario.get("inputOverrides", {}))
+    return event
+
+
+def error_cause(e):
+    return json.dumps(
+        {
+            "errorMessage": str(e),
+            "errorType": type(e).__name__,
+            "stackTrace": traceback.format_exception(type(e), e, e.__traceback__),
+        }
+    )
+
+
+class LocalChaosMachine:
+    def __init__(self, definition=None, start_time=None):
+        self.definition = definition or load_definition()
+        self.start_time = start_time
+        self.modules = load_handlers()
+        # Baselines are kept across the runs of a machine, like a deployed table.
+        self.baselines = []
+        self.query_cache = []
+        # Payload store of the claim check mode, created on first use.
+        self.payloads = None
+        # Snapshots of the run being recorded, when the scenario replays them.
+        self.snapshots = None
+
+    def install(self, clock, scheduler, scenario, event, invoke):
+        from chaos_machine import (
+            cache,
+            clients,
+            instrumentation,
+            payload,
+            prometheus,
+            snapshot,
+            timing,
+        )
+
+        from local import backends
+
+        timeline = backends.Timeline(clock)
+        signals = backends.Signals(
+            scenario.get("metrics", {}), timeline, scenario.get("seed", 0)
+        )
+        bus = backends.EventBus(
+            scheduler,
+            lambda event: invoke("continue-execution", event, asynchronous=True),
+            scenario.get("eventDelay", 1),
+        )
+        if "queue" in scenario:
+            # Events are delivered through the queue, in batches.
+            queue = backends.Queue(
+                scheduler,
+                bus.deliver,
+                scenario["queue"].get("batchSize", 10),
+                scenario["queue"].get("window", 0),
+            )
+            bus.deliver = queue.put
+        experiments = backends.Experiments(
+            scheduler, timeline, bus, scenario.get("experiment", {})
+        )
+        publish_delay = scenario.get("publishDelay", 0)
+        dynamodb = backends.DynamoDB(TABLES)
+        dynamodb.items[BASELINES_TABLE_NAME] = self.baselines
+        dynamodb.items[QUERY_CACHE_TABLE_NAME] = self.query_cache
+        cache.QUERY_CACHE_TABLE = (
+            QUERY_CACHE_TABLE_NAME if scenario.get("queryCache") else None
+        )
+        payload.PAYLOAD_URI = None
+        if "claimCheck" in scenario:
+            if self.payloads is None:
+                self.payloads = tempfile.TemporaryDirectory(
+                    prefix="chaos-machine-payloads-"
+                )
+            payload.PAYLOAD_URI = scenario["claimCheck"].get("uri", self.payloads.name)
+            payload.PAYLOAD_MAX_BYTES = scenario["claimCheck"].get("maxBytes", 8192)
+        snapshot.SNAPSHOT_URI = self.snapshots.name if self.snapshots else None
+        fakes = {
+            "cloudwatch": backends.CloudWatch(
+                clock,
+                signals,
+                scenario.get("alarms", {}),
+                publish_delay,
+                scenario.get("errors", {}).get("cloudwatch"),
+            ),
+            "fis": backends.FIS(experiments),
+            "ssm": backends.SSM(experiments),
+            "dynamodb": dynamodb,
+            "stepfunctions": backends.StepFunctions(
+                scheduler, lambda error, cause: StatesError(error, cause)
+            ),
+        }
+        for service_name, client in fakes.items():
+            clients.set_client(service_name, client)
+        if "queue" in scenario:
+            fakes["sqs"] = queue
+        fakes["prometheus"] = backends.Prometheus(
+            clock, signals, prometheus_queries(event), publish_delay
+        )
+        prometheus.http = fakes["prometheus"]
+        timing.set_clock(clock)
+        # Measurements are kept in memory and returned with the result.
+        fakes["instrumentation"] = instrumentation.MemorySink()
+        instrumentation.set_sink(fakes["instrumentation"])
+        return fakes
+
+    def uninstall(self):
+        from chaos_machine import clients, instrumentation, timing
+
+        instrumentation.set_sink(None)
+        timing.set_clock(None)
+        clients.clients.clear()
+
+    def run(self, scenario, base=root):
+        event = load_input(scenario, base)
+        name = scenario.get("name", "local")
+        start_time = self.start_time or SimulatedClock().time
+        if "startTime" in scenario:
+            start_time = datetime.fromisoformat(scenario["startTime"])
+        clock = SimulatedClock(start_time)
+        scheduler = Scheduler(clock)
+        history = []
+        invocations = {}
+        async_errors = []
+
+        def invoke(function_name, payload, asynchronous=False):
+            invocations[function_name] = invocations.get(function_name, 0) + 1
+            history.append({"time": clock().isoformat(), "invoke": function_name})
+            payload = json.loads(json.dumps(payload))
+            try:
+                result = self.modules[function_name].lambda_handler(payload, None)
+            except Exception as e:
+                if asynchronous:
+                    async_errors.append(
+                        {"function": function_name, "error": type(e).__name__}
+                    )
+                    return None
+                raise StatesError(type(e).__name__, error_cause(e))
+            try:
+                return json.loads(json.dumps(result))
+            except TypeError as e:
+                raise StatesError("Runtime.MarshalError", error_cause(e))
+
+        context = {
+            "Execution": {
+                "Id": f"arn:aws:states:local:000000000000:execution:{STATE_MACHINE_NAME}:{name}",
+                "Name": name,
+                "Input": event,
+                "StartTime": start_time.isoformat(),
+            },
+            "StateMachine": {"Name": STATE_MACHINE_NAME},
+        }
+        outcome = {}
+
+        def done(output, error):
+            outcome["time"] = clock()
+            outcome["output"] = output
+            outcome["error"] = error
+
+        if scenario.get("snapshots"):
+            self.snapshots = tempfile.TemporaryDirectory(
+                prefix="chaos-machine-snapshots-"
+            )
+        fakes = self.install(clock, scheduler, scenario, event, invoke)
+        started = time.perf_counter()
+        try:
+            interpreter = Interpreter(invoke, history)
+            scheduler.spawn(interpreter.run(self.definition, event, context), done)
+            max_duration = scenario.get("maxDuration", DEFAULT_MAX_DURATION)
+            scheduler.run(until=start_time + timedelta(seconds=max_duration))
+        finally:
+            self.uninstall()
+        replays = None
+        if self.snapshots:
+            try:
+                replays = self.replay_snapshots()
+            finally:
+                self.snapshots.cleanup()
+                self.snapshots = None
+
+        result = {
+            "name": name,
+            "duration": (outcome.get("time", clock()) - start_time).total_seconds(),
+            "elapsed": time.perf_counter() - started,
+            "transitions": sum(1 for entry in history if "type" in entry),
+            "invocations": invocations,
+            "apiCalls": {
+                service: fake.calls
+                for service, fake in fakes.items()
+                if hasattr(fake, "calls")
+            },
+            "asyncErrors": async_errors,
+            "maxStateBytes": interpreter.max_state_bytes,
+            "instrumentation": [
+                {key: value for key, value in document.items() if key != "_aws"}
+                for document in fakes["instrumentation"].documents
+            ],
+        }
+        if "sqs" in fakes:
+            result["batchItemFailures"] = fakes["sqs"].failures
+        if "error" not in outcome:
+            result.update(status="TIMED_OUT", state=None)
+        elif outcome["error"] is None:
+            result.update(status="SUCCEEDED", state=final_state(history))
+            result["output"] = outcome["output"]
+        else:
+            error = outcome["error"]
+            if not isinstance(error, StatesError):
+                raise error
+            # A Fail state without an error reports the error that was caught.
+            caught = [entry for entry in history if "caught" in entry]
+            if error.error is None and caught:
+                error = StatesError(
+                    caught[-1]["caught"], caught[-1]["cause"], error.state
+                )
+            result.update(
+                status="FAILED",
+                state=error.state or final_state(history),
+                error=error.error,
+                cause=error.cause,
+            )
+        if replays is not None:
+            result["replays"] = replays
+        if "expect" in scenario:
+            result["expected"] = scenario["expect"]
+            result["passed"] = result["state"] == scenario["expect"] and all(
+                replay["matched"] for replay in replays or []
+            )
+        result["history"] = history
+        return result
+
+    def replay_snapshots(self):
+        # Each snapshot written during the run is replayed, and must have the
+        # recorded outcome.
+        from chaos_machine import snapshot
+        from chaos_machine.snapshot import dumps, read_snapshot
+
+        from local.replay import replay
+
+        snapshot.SNAPSHOT_URI = None
+        replays = []
+        for path in sorted(Path(self.snapshots.name).rglob("*.jsonl.gz")):
+            invocation, recorded, replayed = replay(read_snapshot(str(path)))
+            outcome = {
+                key: value for key, value in replayed.items() if key != "elapsed"
+            }
+            recorded = {key: value for key, value in recorded.items() if key != "type"}
+            replays.append(
+                {
+                    "handler": invocation["handler"],
+                    "time": invocation["time"].isoformat(),
+                    "matched": dumps(outcome) == dumps(recorded),
+                }
+            )
+        return replays
+
+
+def final_state(history):
+    states = [entry["state"] for entry in history if "type" in entry]
+    return states[-1] if states else None
+
+
+def load_scenarios(paths):
+    for path in paths:
+        path = Path(path)
+        with open(path, "r") as f:
+            scenarios = json.load(f)
+        for scenario in scenarios if isinstance(scenarios, list) else [scenarios]:
+            yield scenario, path.parent
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run chaos machine scenarios offline with a simulated clock."
+    )
+    parser.add_argument("scenarios", nargs="+", help="Scenario JSON files.")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--log-level", default="CRITICAL")
+    parser.add_argument(
+        "--output", help="Write the results, with their history, as JSON lines."
+    )
+    args = parser.parse_args()
+
+    os.environ["LOG_LEVEL"] = args.log_level
+    machine = LocalChaosMachine()
+    results = []
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        for scenario, base in load_scenarios(args.scenarios):
+            results.append(machine.run(scenario, base))
+    elapsed = time.perf_counter() - started
+
+    print(
+        f"{'scenario':<32}{'expected':<16}{'state':<16}{'status':<11}"
+        f"{'simulated s':>12}{'wall ms':>9}"
+    )
+    for result in results[: len(results) // args.repeat]:
+        print(
+            f"{result['name']:<32}{str(result.get('expected')):<16}"
+            f"{str(result['state']):<16}{result['status']:<11}"
+            f"{result['duration']:>12.0f}{result['elapsed'] * 1000:>9.1f}"
+        )
+    print(f"\n{len(results)} runs in {elapsed:.2f}s ({len(results) / elapsed:.0f}/s)")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            for result in results:
+                f.write(json.dumps(result, default=str) + "\n")
+
+    if any(result.get("passed") is False for result in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import heapq
+import itertools
+from collections import deque
+from datetime import datetime, timedelta, timezone
+
+# The state machine runs as generators that yield one of the requests below. The
+# scheduler resumes them in simulated time, so waits cost nothing and runs are
+# deterministic.
+
+
+class SimulatedClock:
+    def __init__(self, start=None):
+        self.time = start or datetime(2024, 1, 1, tzinfo=timezone.utc)
+
+    def __call__(self):
+        return self.time
+
+    def advance_to(self, time):
+        self.time = max(self.time, time)
+
+
+class Sleep:
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def schedule(self, scheduler, task):
+        scheduler.at(
+            scheduler.clock() + timedelta(seconds=self.seconds),
+            lambda: scheduler.resume(task),
+        )
+
+
+class Token:
+    def __init__(self, token):
+        self.token = token
+
+    def schedule(self, scheduler, task):
+        scheduler.tokens[self.token] = task
+
+
+class Join:
+    def __init__(self, generators):
+        self.generators = generators
+
+    def schedule(self, scheduler, task):
+        results = [None] * len(self.generators)
+        pending = set(range(len(self.generators)))
+        children = []
+
+        def done(index, result, error):
+            if task.finished or task.waiting is not self:
+                return
+            if error is not None:
+                # The first failing branch cancels the others.
+                for child in children:
+                    scheduler.cancel(child)
+                scheduler.resume(task, error=error)
+                return
+            results[index] = result
+            pending.discard(index)
+            if not pending:
+                scheduler.resume(task, results)
+
+        if not self.generators:
+            scheduler.resume(task, results)
+            return
+        task.children = children
+        for index, generator in enumerate(self.generators):
+            children.append(
+                scheduler.spawn(
+                    generator,
+                    lambda result, error, index=index: done(index, result, error),
+                )
+            )
+
+
+class Task:
+    def __init__(self, generator, on_done):
+        self.generator = generator
+        self.on_done = on_done
+        self.waiting = None
+        self.finished = False
+        self.children = []
+
+
+class Scheduler:
+    def __init__(self, clock):
+        self.clock = clock
+        self.ready = deque()
+        self.timers = []
+        self.tokens = {}
+        self.sequence = itertools.count()
+
+    def at(self, time, callback):
+        heapq.heappush(self.timers, (time, next(self.sequence), callback))
+
+    def spawn(self, generator, on_done=None):
+        task = Task(generator, on_done)
+        self.ready.append((task, None, None))
+        return task
+
+    def resume(self, task, value=None, error=None):
+        self.ready.append((task, value, error))
+
+    def cancel(self, task):
+        if task.finished:
+            return
+        task.finished = True
+        for child in task.children:
+            self.cancel(child)
+        for token, waiting in list(self.tokens.items()):
+            if waiting is task:
+                del self.tokens[token]
+        task.generator.close()
+
+    def complete_token(self, token, value=None, error=None):
+        task = self.tokens.pop(token, None)
+        if task is None:
+            return False
+        self.resume(task, value, error)
+        return True
+
+    def step(self, task, value, error):
+        if task.finished:
+            return
+        task.waiting = None
+        try:
+            if error is not None:
+                request = task.generator.throw(error)
+            else:
+                request = task.generator.send(value)
+        except StopIteration as stop:
+            task.finished = True
+            if task.on_done:
+                task.on_done(stop.value, None)
+            return
+        except Exception as e:
+            task.finished = True
+            if task.on_done:
+                task.on_done(None, e)
+            else:
+                raise
+            return
+        task.waiting = request
+        request.schedule(self, task)
+
+    def run(self, until=None):
+        while True:
+            while self.ready:
+                self.step(*self.ready.popleft())
+            if not self.timers:
+                return
+            time, _, callback = heapq.heappop(self.timers)
+            if until is not None and time > until:
+                return
+            self.clock.advance_to(time)
+            callback()
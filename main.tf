@@ -13,6 +13,24 @@ locals {
     ProjectEnv  = var.project_env
   }
 
+  # Snapshots of the steady state and hypothesis evaluations, see snapshot_uri.
+  snapshot_environment_variables = { for key, value in { SNAPSHOT_URI = var.snapshot_uri } : key => value if value != "" }
+  snapshot_bucket_path           = substr(var.snapshot_uri, 0, 5) == "s3://" ? trimsuffix(substr(var.snapshot_uri, 5, -1), "/") : ""
+
+  # Measurements of each invocation as EMF log lines, see instrumentation.
+  instrumentation_environment_variables = { for key, value in { INSTRUMENTATION = "emf" } : key => value if var.instrumentation }
+
+  # Large test definitions, results and errors are kept out of the state, see payload_uri.
+  payload_environment_variables = { for key, value in { PAYLOAD_URI = var.payload_uri } : key => value if value != "" }
+  payload_bucket_path           = substr(var.payload_uri, 0, 5) == "s3://" ? trimsuffix(substr(var.payload_uri, 5, -1), "/") : ""
+
+  # Query results cached by aligned time bucket across phases, see query_cache.
+  query_cache_environment_variables = { for table in aws_dynamodb_table.query_cache : "QUERY_CACHE_TABLE" => table.name }
+
+  # Completion events are buffered in an SQS queue and processed in batches, see continue_execution_queue.
+  continue_execution_queue  = var.create_chaos_machine && var.continue_execution_queue
+  continue_execution_target = local.continue_execution_queue ? aws_sqs_queue.continue_execution[0].arn : aws_lambda_function.this["continue-execution"].arn
+
   lambda = {
     functions = [
       {
@@ -20,36 +38,50 @@ locals {
         role_arn              = var.create_iam_roles ? null : var.lambda_steady_state_role_arn
         permission_principal  = "states.amazonaws.com"
         permission_source_arn = "arn:${data.aws_partition.current.partition}:states:${data.aws_region.current.name}:${data.aws_caller_identity.current.id}:stateMachine:chaos-machine-${var.project_env}"
-        environment_variables = var.lambda_environment_variables
-        layers                = [aws_lambda_layer_version.layer.arn]
+        environment_variables = merge(var.lambda_environment_variables, local.instrumentation_environment_variables, local.snapshot_environment_variables, local.payload_environment_variables, local.query_cache_environment_variables, {
+          BASELINES_TABLE = aws_dynamodb_table.baselines[0].name
+        })
+        layers = [aws_lambda_layer_version.layer.arn]
       },
       {
         name                  = "start-experiment"
         role_arn              = var.create_iam_roles ? null : var.lambda_start_experiment_role_arn
         permission_principal  = "states.amazonaws.com"
         permission_source_arn = "arn:${data.aws_partition.current.partition}:states:${data.aws_region.current.name}:${data.aws_caller_identity.current.id}:stateMachine:chaos-machine-${var.project_env}"
-        environment_variables = var.lambda_environment_variables
-        layers                = []
+        environment_variables = merge(var.lambda_environment_variables, local.instrumentation_environment_variables, local.payload_environment_variables)
+        layers                = [aws_lambda_layer_version.layer.arn]
       },
       {
         name                  = "continue-execution"
         role_arn              = var.create_iam_roles ? null : var.lambda_continue_execution_role_arn
         permission_principal  = "events.amazonaws.com"
         permission_source_arn = "arn:${data.aws_partition.current.partition}:events:${data.aws_region.current.name}:${data.aws_caller_identity.current.id}:rule/chaos-machine-${var.project_env}-continue-execution-*"
-        environment_variables = merge(var.lambda_environment_variables, {
+        environment_variables = merge(var.lambda_environment_variables, local.instrumentation_environment_variables, {
+          EXPERIMENTS_TABLE              = aws_dynamodb_table.this[0].name
+          CONTINUE_EXECUTION_MAX_WORKERS = tostring(var.continue_execution_max_workers)
+        })
+        layers = [aws_lambda_layer_version.layer.arn]
+      },
+      {
+        name                  = "monitor-experiment"
+        role_arn              = var.create_iam_roles ? null : var.lambda_monitor_experiment_role_arn
+        permission_principal  = "states.amazonaws.com"
+        permission_source_arn = "arn:${data.aws_partition.current.partition}:states:${data.aws_region.current.name}:${data.aws_caller_identity.current.id}:stateMachine:chaos-machine-${var.project_env}"
+        environment_variables = merge(var.lambda_environment_variables, local.instrumentation_environment_variables, local.payload_environment_variables, local.query_cache_environment_variables, {
           EXPERIMENTS_TABLE = aws_dynamodb_table.this[0].name
         })
-        layers = []
+        layers = [aws_lambda_layer_version.layer.arn]
       },
       {
         name                  = "evaluate-hypothesis"
         role_arn              = var.create_iam_roles ? null : var.lambda_evaluate_hypothesis_role_arn
         permission_principal  = "states.amazonaws.com"
         permission_source_arn = "arn:${data.aws_partition.current.partition}:states:${data.aws_region.current.name}:${data.aws_caller_identity.current.id}:stateMachine:chaos-machine-${var.project_env}"
-        environment_variables = merge(var.lambda_environment_variables, {
+        environment_variables = merge(var.lambda_environment_variables, local.instrumentation_environment_variables, local.snapshot_environment_variables, local.payload_environment_variables, local.query_cache_environment_variables, {
           EXPERIMENTS_TABLE = aws_dynamodb_table.this[0].name
+          BASELINES_TABLE   = aws_dynamodb_table.baselines[0].name
         })
-        layers = []
+        layers = [aws_lambda_layer_version.layer.arn]
       },
     ]
   }
@@ -134,7 +166,7 @@ resource "aws_cloudwatch_event_target" "continue_execution_fis" {
   count     = var.create_chaos_machine ? 1 : 0
   target_id = "chaos-machine-${var.project_env}-continue-execution"
   rule      = aws_cloudwatch_event_rule.continue_execution_fis[0].name
-  arn       = aws_lambda_function.this["continue-execution"].arn
+  arn       = local.continue_execution_target
 }
 
 resource "aws_cloudwatch_event_rule" "continue_execution_ssm" {
@@ -155,7 +187,68 @@ resource "aws_cloudwatch_event_target" "continue_execution_ssm" {
   count     = var.create_chaos_machine ? 1 : 0
   target_id = "chaos-machine-${var.project_env}-continue-execution"
   rule      = aws_cloudwatch_event_rule.continue_execution_ssm[0].name
-  arn       = aws_lambda_function.this["continue-execution"].arn
+  arn       = local.continue_execution_target
+}
+
+resource "aws_sqs_queue" "continue_execution_dlq" {
+  count                     = local.continue_execution_queue ? 1 : 0
+  name                      = "chaos-machine-${var.project_env}-continue-execution-dlq"
+  message_retention_seconds = 1209600
+  sqs_managed_sse_enabled   = true
+  tags                      = local.tags
+}
+
+resource "aws_sqs_queue" "continue_execution" {
+  count = local.continue_execution_queue ? 1 : 0
+  name  = "chaos-machine-${var.project_env}-continue-execution"
+  # At least six times the function timeout, so batches retried by Lambda are not received twice.
+  visibility_timeout_seconds = 180
+  sqs_managed_sse_enabled    = true
+  redrive_policy = jsonencode({
+    deadLetterTargetArn = aws_sqs_queue.continue_execution_dlq[0].arn
+    maxReceiveCount     = 5
+  })
+  tags = local.tags
+}
+
+resource "aws_sqs_queue_policy" "continue_execution" {
+  count     = local.continue_execution_queue ? 1 : 0
+  queue_url = aws_sqs_queue.continue_execution[0].id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect    = "Allow"
+        Principal = { Service = "events.amazonaws.com" }
+        Action    = "sqs:SendMessage"
+        Resource  = aws_sqs_queue.continue_execution[0].arn
+        Condition = {
+          ArnEquals = {
+            "aws:SourceArn" = [
+              aws_cloudwatch_event_rule.continue_execution_fis[0].arn,
+              aws_cloudwatch_event_rule.continue_execution_ssm[0].arn,
+            ]
+          }
+        }
+      }
+    ]
+  })
+}
+
+resource "aws_lambda_event_source_mapping" "continue_execution" {
+  count                              = local.continue_execution_queue ? 1 : 0
+  event_source_arn                   = aws_sqs_queue.continue_execution[0].arn
+  function_name                      = aws_lambda_function.this["continue-execution"].arn
+  batch_size                         = var.continue_execution_batch_size
+  maximum_batching_window_in_seconds = var.continue_execution_batching_window
+  function_response_types            = ["ReportBatchItemFailures"]
+
+  dynamic "scaling_config" {
+    for_each = var.continue_execution_maximum_concurrency > 0 ? [var.continue_execution_maximum_concurrency] : []
+    content {
+      maximum_concurrency = scaling_config.value
+    }
+  }
 }
 
 resource "aws_dynamodb_table" "this" {
@@ -179,7 +272,31 @@ resource "aws_dynamodb_table" "this" {
     name               = "chaos-machine-${var.project_env}-tests-experimentId"
     hash_key           = "experimentId"
     projection_type    = "INCLUDE"
-    non_key_attributes = ["taskToken", "experimentType"]
+    non_key_attributes = ["taskToken", "experimentType", "startTime"]
+  }
+
+  point_in_time_recovery {
+    enabled = true
+  }
+
+  tags = local.tags
+}
+
+resource "aws_dynamodb_table" "baselines" {
+  count        = var.create_chaos_machine ? 1 : 0
+  name         = "chaos-machine-${var.project_env}-baselines"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "testId"
+  range_key    = "metricId"
+
+  attribute {
+    name = "testId"
+    type = "S"
+  }
+
+  attribute {
+    name = "metricId"
+    type = "S"
   }
 
   point_in_time_recovery {
@@ -189,6 +306,31 @@ resource "aws_dynamodb_table" "this" {
   tags = local.tags
 }
 
+resource "aws_dynamodb_table" "query_cache" {
+  count        = var.create_chaos_machine && var.query_cache ? 1 : 0
+  name         = "chaos-machine-${var.project_env}-query-cache"
+  billing_mode = "PAY_PER_REQUEST"
+  hash_key     = "queryId"
+  range_key    = "bucket"
+
+  attribute {
+    name = "queryId"
+    type = "S"
+  }
+
+  attribute {
+    name = "bucket"
+    type = "N"
+  }
+
+  ttl {
+    attribute_name = "expiresAt"
+    enabled        = true
+  }
+
+  tags = local.tags
+}
+
 resource "aws_cloudwatch_log_group" "sfn" {
   count             = var.create_chaos_machine ? 1 : 0
   name              = "/aws/vendedlogs/states/chaos-machine-${var.project_env}"
@@ -220,20 +362,168 @@ resource "aws_sfn_state_machine" "this" {
             "SteadyState": {
               "Type": "Task",
               "Resource":"${aws_lambda_function.this["steady-state"].arn}",
-              "ResultPath": null,
-              "Next": "Experiment"
+              "ResultPath": "$",
+              "Next": "SteadyStateReached"
+            },
+            "SteadyStateReached": {
+              "Type": "Choice",
+              "Choices": [
+                {
+                  "Variable": "$.steadyStateResult.nextState",
+                  "StringEquals": "NotSteadyState",
+                  "Next": "PauseForSteadyState"
+                }
+              ],
+              "Default": "Experiment"
+            },
+            "PauseForSteadyState": {
+              "Type": "Wait",
+              "SecondsPath": "$.steadyStateResult.wait",
+              "Next": "SteadyState"
             },
             "Experiment": {
-              "Type": "Task",
-              "Resource":"arn:${data.aws_partition.current.partition}:states:::lambda:invoke.waitForTaskToken",
-              "Parameters": {
-                "FunctionName": "${aws_lambda_function.this["start-experiment"].function_name}",
-                "Payload": {
-                  "Input.$": "$",
-                  "TaskToken.$": "$$.Task.Token",
-                  "TableName": "${aws_dynamodb_table.this[0].name}",
-                  "ExecutionName.$": "$$.Execution.Name"
+              "Type": "Parallel",
+              "Branches": [
+                {
+                  "StartAt": "StartExperiment",
+                  "States": {
+                    "StartExperiment": {
+                      "Type": "Task",
+                      "Resource":"arn:${data.aws_partition.current.partition}:states:::lambda:invoke.waitForTaskToken",
+                      "Parameters": {
+                        "FunctionName": "${aws_lambda_function.this["start-experiment"].function_name}",
+                        "Payload": {
+                          "Input.$": "$",
+                          "TaskToken.$": "$$.Task.Token",
+                          "TableName": "${aws_dynamodb_table.this[0].name}",
+                          "ExecutionName.$": "$$.Execution.Name"
+                        }
+                      },
+                      "End": true
+                    }
+                  }
+                },
+                {
+                  "StartAt": "GuardrailChoice",
+                  "States": {
+                    "GuardrailChoice": {
+                      "Type": "Choice",
+                      "Choices": [
+                        {
+                          "Variable": "$.guardrail",
+                          "IsPresent": true,
+                          "Next": "Guardrail"
+                        }
+                      ],
+                      "Default": "GuardrailDone"
+                    },
+                    "Guardrail": {
+                      "Type": "Task",
+                      "Resource":"${aws_lambda_function.this["monitor-experiment"].arn}",
+                      "Parameters": {
+                        "Input.$": "$",
+                        "ExecutionName.$": "$$.Execution.Name"
+                      },
+                      "ResultPath": "$.guardrailState",
+                      "Retry": [
+                        {
+                          "ErrorEquals": [
+                            "Lambda.ServiceException",
+                            "Lambda.AWSLambdaException",
+                            "Lambda.SdkClientException",
+                            "Lambda.TooManyRequestsException"
+                          ],
+                          "IntervalSeconds": 1,
+                          "MaxAttempts": 3,
+                          "BackoffRate": 2
+                        },
+                        {
+                          "ErrorEquals": [
+                            "GuardrailError"
+                          ],
+                          "MaxAttempts": 0
+                        },
+                        {
+                          "ErrorEquals": [
+                            "States.TaskFailed"
+                          ],
+                          "IntervalSeconds": 2,
+                          "MaxAttempts": 4,
+                          "BackoffRate": 2
+                        }
+                      ],
+                      "Catch": [
+                        {
+                          "ErrorEquals": [
+                            "GuardrailError"
+                          ],
+                          "ResultPath": "$.guardrailError",
+                          "Next": "GuardrailFailed"
+                        },
+                        {
+                          "ErrorEquals": [
+                            "States.ALL"
+                          ],
+                          "ResultPath": "$.guardrailError",
+                          "Next": "GuardrailStop"
+                        }
+                      ],
+                      "Next": "GuardrailRunning"
+                    },
+                    "GuardrailStop": {
+                      "Type": "Task",
+                      "Resource":"${aws_lambda_function.this["monitor-experiment"].arn}",
+                      "Parameters": {
+                        "Input.$": "$",
+                        "ExecutionName.$": "$$.Execution.Name",
+                        "Error.$": "$.guardrailError.Error"
+                      },
+                      "ResultPath": null,
+                      "Retry": [
+                        {
+                          "ErrorEquals": [
+                            "States.TaskFailed"
+                          ],
+                          "IntervalSeconds": 2,
+                          "MaxAttempts": 4,
+                          "BackoffRate": 2
+                        }
+                      ],
+                      "Next": "GuardrailFailed"
+                    },
+                    "GuardrailFailed": {
+                      "Type": "Fail",
+                      "ErrorPath": "$.guardrailError.Error",
+                      "CausePath": "$.guardrailError.Cause"
+                    },
+                    "GuardrailRunning": {
+                      "Type": "Choice",
+                      "Choices": [
+                        {
+                          "Variable": "$.guardrailState.status",
+                          "StringEquals": "Running",
+                          "Next": "GuardrailWait"
+                        }
+                      ],
+                      "Default": "GuardrailDone"
+                    },
+                    "GuardrailWait": {
+                      "Type": "Wait",
+                      "SecondsPath": "$.guardrailState.interval",
+                      "Next": "Guardrail"
+                    },
+                    "GuardrailDone": {
+                      "Type": "Succeed"
+                    }
+                  }
                 }
+              ],
+              "ResultSelector": {
+                "experimentId.$": "$[0].experimentId",
+                "experimentType.$": "$[0].experimentType",
+                "status.$": "$[0].status",
+                "startTime.$": "$[0].startTime",
+                "endTime.$": "$[0].endTime"
               },
               "ResultPath": "$.continueExecutionOutput",
               "Next": "EvaluateOrRecover"
@@ -247,7 +537,7 @@ resource "aws_sfn_state_machine" "this" {
                   "Next": "RecoveryCalc"
                 }
               ],
-              "Default": "PauseForMetrics"
+              "Default": "EvaluateHypothesis"
             },
             "RecoveryCalc": {
               "Type": "Pass",
@@ -260,18 +550,32 @@ resource "aws_sfn_state_machine" "this" {
             "Recovery": {
               "Type": "Wait",
               "SecondsPath": "$.math.recoveryTotal",
-              "Next": "PauseForMetrics"
-            },
-            "PauseForMetrics": {
-              "Type": "Wait",
-              "Seconds": 60,
               "Next": "EvaluateHypothesis"
             },
             "EvaluateHypothesis": {
               "Type": "Task",
               "Resource":"${aws_lambda_function.this["evaluate-hypothesis"].arn}",
               "ResultPath": "$.evaluateHypothesisResult",
-              "End": true
+              "Next": "MetricsReady"
+            },
+            "MetricsReady": {
+              "Type": "Choice",
+              "Choices": [
+                {
+                  "Variable": "$.evaluateHypothesisResult.nextState",
+                  "StringEquals": "MetricsNotReady",
+                  "Next": "PauseForMetrics"
+                }
+              ],
+              "Default": "HypothesisEvaluated"
+            },
+            "PauseForMetrics": {
+              "Type": "Wait",
+              "SecondsPath": "$.evaluateHypothesisResult.readiness.wait",
+              "Next": "EvaluateHypothesis"
+            },
+            "HypothesisEvaluated": {
+              "Type": "Succeed"
             }
           }
         }
@@ -327,6 +631,56 @@ EOF
   tags = local.tags
 }
 
+resource "aws_sqs_queue" "execution_status" {
+  count                     = var.create_chaos_machine && var.create_execution_status_queue ? 1 : 0
+  name                      = "chaos-machine-${var.project_env}-execution-status"
+  message_retention_seconds = 86400
+  sqs_managed_sse_enabled   = true
+  tags                      = local.tags
+}
+
+resource "aws_cloudwatch_event_rule" "execution_status" {
+  count       = var.create_chaos_machine && var.create_execution_status_queue ? 1 : 0
+  name        = "chaos-machine-${var.project_env}-execution-status"
+  description = "Chaos machine execution completed"
+  event_pattern = jsonencode({
+    source      = ["aws.states"],
+    detail-type = ["Step Functions Execution Status Change"],
+    detail = {
+      stateMachineArn = [aws_sfn_state_machine.this[0].arn],
+      status          = ["SUCCEEDED", "FAILED", "TIMED_OUT", "ABORTED"]
+    }
+  })
+}
+
+resource "aws_cloudwatch_event_target" "execution_status" {
+  count     = var.create_chaos_machine && var.create_execution_status_queue ? 1 : 0
+  target_id = "chaos-machine-${var.project_env}-execution-status"
+  rule      = aws_cloudwatch_event_rule.execution_status[0].name
+  arn       = aws_sqs_queue.execution_status[0].arn
+}
+
+resource "aws_sqs_queue_policy" "execution_status" {
+  count     = var.create_chaos_machine && var.create_execution_status_queue ? 1 : 0
+  queue_url = aws_sqs_queue.execution_status[0].id
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect    = "Allow"
+        Principal = { Service = "events.amazonaws.com" }
+        Action    = "sqs:SendMessage"
+        Resource  = aws_sqs_queue.execution_status[0].arn
+        Condition = {
+          ArnEquals = {
+            "aws:SourceArn" = aws_cloudwatch_event_rule.execution_status[0].arn
+          }
+        }
+      }
+    ]
+  })
+}
+
 ################################################################################
 # IAM resources
 ################################################################################
@@ -337,6 +691,7 @@ locals {
     steady-state        = "lambda"
     start-experiment    = "lambda"
     continue-execution  = "lambda"
+    monitor-experiment  = "lambda"
     evaluate-hypothesis = "lambda"
   }
   policy_vars = {
@@ -355,9 +710,10 @@ locals {
 # start-experiment - logs:*
 # continue-execution - logs:*, states:Send*
 # evaluate-hypothesis - logs:*, cloudwatch:GetMetricData
+# monitor-experiment - logs:*, cloudwatch:GetMetricData
 
 # Reason: FIS experiment template and experiment IDs are unknown at invocation
-# Applies to: steady-state, start-experiment, evaluate-hypothesis
+# Applies to: steady-state, start-experiment, monitor-experiment, evaluate-hypothesis
 
 
 resource "aws_iam_role" "this" {
@@ -381,3 +737,51 @@ resource "aws_iam_role_policy_attachment" "this" {
   role       = aws_iam_role.this[each.key].name
   policy_arn = aws_iam_policy.this[each.key].arn
 }
+
+resource "aws_iam_role_policy" "snapshot" {
+  for_each = var.create_iam_roles && local.snapshot_bucket_path != "" ? toset(["steady-state", "evaluate-hypothesis"]) : toset([])
+  name     = "snapshot"
+  role     = aws_iam_role.this[each.key].name
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect   = "Allow"
+        Action   = ["s3:PutObject"]
+        Resource = "arn:${data.aws_partition.current.partition}:s3:::${local.snapshot_bucket_path}/*"
+      }
+    ]
+  })
+}
+
+resource "aws_iam_role_policy" "payload" {
+  for_each = var.create_iam_roles && local.payload_bucket_path != "" ? toset(["steady-state", "start-experiment", "monitor-experiment", "evaluate-hypothesis"]) : toset([])
+  name     = "payload"
+  role     = aws_iam_role.this[each.key].name
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect   = "Allow"
+        Action   = ["s3:GetObject", "s3:PutObject"]
+        Resource = "arn:${data.aws_partition.current.partition}:s3:::${local.payload_bucket_path}/*"
+      }
+    ]
+  })
+}
+
+resource "aws_iam_role_policy" "targets" {
+  for_each = var.create_iam_roles && length(var.target_role_arns) > 0 ? toset(["steady-state", "monitor-experiment", "evaluate-hypothesis"]) : toset([])
+  name     = "targets"
+  role     = aws_iam_role.this[each.key].name
+  policy = jsonencode({
+    Version = "2012-10-17"
+    Statement = [
+      {
+        Effect   = "Allow"
+        Action   = ["sts:AssumeRole"]
+        Resource = var.target_role_arns
+      }
+    ]
+  })
+}
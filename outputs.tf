@@ -1,3 +1,7 @@
 output "role_arns" {
   value = var.create_iam_roles ? { for k, v in local.roles_and_trusts : k => aws_iam_role.this[k].arn } : null
 }
+
+output "execution_status_queue_url" {
+  value = var.create_chaos_machine && var.create_execution_status_queue ? aws_sqs_queue.execution_status[0].id : null
+}
@@ -0,0 +1,455 @@
+import argparse
+import heapq
+import itertools
+import json
+import os
+import re
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from local.runner import load_input, resolve_path
+
+# Runs a suite of chaos machine tests, each as an execution of the state machine,
+# with at most `concurrency` executions at a time. A test whose blast radius, the
+# target tags and resources of its experiment, overlaps with a running test waits
+# until that test has finished, and later tests that do not overlap start first.
+# Completions are received from the execution status queue, so one request covers
+# every running execution instead of polling each of them.
+
+TERMINAL_STATUSES = ["SUCCEEDED", "FAILED", "TIMED_OUT", "ABORTED"]
+DEFAULT_CONCURRENCY = 5
+# Maximum length of a Step Functions execution name.
+MAX_EXECUTION_NAME = 80
+# Messages for the executions of other suites on the same queue are hidden from
+# this suite for this many seconds, and can be received by their suite meanwhile.
+FOREIGN_VISIBILITY_TIMEOUT = 60
+# While waiting on the queue, the running executions are also described this
+# often, in case their message was lost or received by another consumer.
+FALLBACK_POLL_INTERVAL = 300
+
+
+def load_suite(path):
+    path = Path(path)
+    with open(path, "r") as f:
+        suite = json.load(f)
+    if isinstance(suite, list):
+        suite = {"tests": suite}
+    suite.setdefault("name", path.stem)
+    tests = []
+    for index, entry in enumerate(suite["tests"]):
+        # A test is a path to a test file, an object with a `scenario` path whose
+        # keys it overrides, or a test object, e.g. a local scenario.
+        if isinstance(entry, str):
+            entry = {"scenario": entry}
+        test = dict(entry)
+        base = path.parent
+        if "scenario" in test:
+            scenario_path = resolve_path(test.pop("scenario"), path.parent)
+            with open(scenario_path, "r") as f:
+                test = dict(json.load(f), **test)
+            base = scenario_path.parent
+        test["input"] = load_input(test, base)
+        test.pop("inputOverrides", None)
+        test.setdefault("name", f"{test['input']['testId']}-{index}")
+        tests.append(test)
+    suite["tests"] = tests
+    return suite
+
+
+def blast_radius(test, templates=None):
+    # The resources a test may impair: its experiment template or automation
+    # document, the resource tags and ARNs of the template targets, and the
+    # `blastRadius` entries of the test. Two tests whose blast radii intersect do
+    # not run at the same time.
+    event = test["input"]
+    radius = set(test.get("blastRadius", []))
+    if "experimentTemplateId" in event:
+        radius.add(f"template:{event['experimentTemplateId']}")
+        template = templates(event["experimentTemplateId"]) if templates else {}
+        for target in template.get("targets", {}).values():
+            for key, value in target.get("resourceTags", {}).items():
+                radius.add(f"tag:{key}={value}")
+            radius.update(target.get("resourceArns", []))
+    else:
+        radius.add(f"document:{event['automationDocumentName']}")
+    return radius
+
+
+def execution_name(suite_name, index, test):
+    name = re.sub(r"[^\w-]", "-", f"{suite_name}-{index:03d}-{test['name']}")
+    suffix = uuid.uuid4().hex[:8]
+    end = MAX_EXECUTION_NAME - len(suffix) - 1
+    return f"{name[:end]}-{suffix}"
+
+
+class StepFunctionsExecutor:
+    def __init__(self, state_machine_arn, queue_url=None, poll_interval=10):
+        import boto3
+
+        self.state_machine_arn = state_machine_arn
+        self.queue_url = queue_url
+        self.poll_interval = poll_interval
+        self.sfn = boto3.client("stepfunctions")
+        self.sqs = boto3.client("sqs")
+        self.fis = boto3.client("fis")
+        self.templates = {}
+        # Every execution started by this suite, including the completed ones.
+        self.executions = set()
+        self.described = self.now()
+
+    def now(self):
+        return datetime.now(timezone.utc)
+
+    def template(self, template_id):
+        if template_id not in self.templates:
+            response = self.fis.get_experiment_template(id=template_id)
+            self.templates[template_id] = response["experimentTemplate"]
+        return self.templates[template_id]
+
+    def start(self, name, test):
+        response = self.sfn.start_execution(
+            stateMachineArn=self.state_machine_arn,
+            name=name,
+            input=json.dumps(test["input"]),
+        )
+        self.executions.add(response["executionArn"])
+        return response["executionArn"]
+
+    def wait(self, running):
+        if self.queue_url:
+            return self.receive(running)
+        return self.poll(running)
+
+    def receive(self, running):
+        completions = []
+        deleted = []
+        hidden = []
+        response = self.sqs.receive_message(
+            QueueUrl=self.queue_url, MaxNumberOfMessages=10, WaitTimeSeconds=20
+        )
+        for message in response.get("Messages", []):
+            event = json.loads(message["Body"])
+            detail = event["detail"]
+            entry = {
+                "Id": message["MessageId"],
+                "ReceiptHandle": message["ReceiptHandle"],
+            }
+            if detail["executionArn"] in running:
+                completions.append(
+                    {
+                        "executionArn": detail["executionArn"],
+                        "status": detail["status"],
+                        "output": detail.get("output"),
+                        "error": detail.get("error"),
+                        "cause": detail.get("cause"),
+                    }
+                )
+                deleted.append(entry)
+            elif detail["executionArn"] in self.executions:
+                # Duplicate events of this suite.
+                deleted.append(entry)
+            else:
+                # The execution belongs to another suite using the same queue, or
+                # was started manually, and is left on the queue for it.
+                hidden.append(dict(entry, VisibilityTimeout=FOREIGN_VISIBILITY_TIMEOUT))
+        if deleted:
+            self.sqs.delete_message_batch(QueueUrl=self.queue_url, Entries=deleted)
+        if hidden:
+            self.sqs.change_message_visibility_batch(
+                QueueUrl=self.queue_url, Entries=hidden
+            )
+        if self.now() - self.described >= timedelta(seconds=FALLBACK_POLL_INTERVAL):
+            received = {completion["executionArn"] for completion in completions}
+            completions += self.describe(
+                [
+                    execution_arn
+                    for execution_arn in running
+                    if execution_arn not in received
+                ]
+            )
+        return completions
+
+    def describe(self, execution_arns):
+        self.described = self.now()
+        completions = []
+        for execution_arn in execution_arns:
+            response = self.sfn.describe_execution(executionArn=execution_arn)
+            if response["status"] in TERMINAL_STATUSES:
+                completions.append(
+                    {
+                        "executionArn": execution_arn,
+                        "status": response["status"],
+                        "output": response.get("output"),
+                        "error": response.get("error"),
+                        "cause": response.get("cause"),
+                    }
+                )
+        return completions
+
+    def poll(self, running):
+        # Without the execution status queue, the running executions of the state
+        # machine are listed once per interval.
+        time.sleep(self.poll_interval)
+        listed = set()
+        paginator = self.sfn.get_paginator("list_executions")
+        for page in paginator.paginate(
+            stateMachineArn=self.state_machine_arn, statusFilter="RUNNING"
+        ):
+            listed.update(execution["executionArn"] for execution in page["executions"])
+        return self.describe(
+            [execution_arn for execution_arn in running if execution_arn not in listed]
+        )
+
+
+class LocalExecutor:
+    # Runs each test as a local scenario when it starts, and completes it after
+    # its simulated duration, so a suite plan can be tried offline.
+    def __init__(self, start_time=None):
+        from local.runner import LocalChaosMachine
+
+        self.machine = LocalChaosMachine()
+        self.clock = start_time or datetime(2024, 1, 1, tzinfo=timezone.utc)
+        self.completions = []
+        self.ids = itertools.count()
+        self.template = None
+
+    def now(self):
+        return self.clock
+
+    def start(self, name, test):
+        scenario = dict(test, name=name, startTime=self.clock.isoformat())
+        scenario.pop("expect", None)
+        result = self.machine.run(scenario)
+        execution_arn = (
+            f"arn:aws:states:local:000000000000:execution:chaos-machine-local:{name}"
+        )
+        completion = {
+            "executionArn": execution_arn,
+            "status": result["status"],
+            "state": result["state"],
+            "output": json.dumps(result.get("output")) if "output" in result else None,
+            "error": result.get("error"),
+            "cause": result.get("cause"),
+        }
+        end = self.clock + timedelta(seconds=result["duration"])
+        heapq.heappush(self.completions, (end, next(self.ids), completion))
+        return execution_arn
+
+    def wait(self, running):
+        end, _, completion = heapq.heappop(self.completions)
+        self.clock = end
+        completions = [completion]
+        while self.completions and self.completions[0][0] == end:
+            completions.append(heapq.heappop(self.completions)[2])
+        return completions
+
+
+def run_suite(
+    suite, executor, concurrency=DEFAULT_CONCURRENCY, log=print, timeout=None
+):
+    # After timeout seconds, the suite stops waiting. The tests still running are
+    # reported as timed out, and left running, and the pending ones as not started.
+    pending = []
+    for test in suite["tests"]:
+        pending.append(dict(test, blastRadius=blast_radius(test, executor.template)))
+    running = {}
+    results = []
+    started = executor.now()
+    max_running = 0
+    indexes = itertools.count(1)
+    while pending or running:
+        if timeout is not None and executor.now() - started >= timedelta(
+            seconds=timeout
+        ):
+            break
+        for test in list(pending):
+            if len(running) >= concurrency:
+                break
+            if any(
+                test["blastRadius"] & other["blastRadius"] for other in running.values()
+            ):
+                continue
+            name = execution_name(suite["name"], next(indexes), test)
+            execution_arn = executor.start(name, test)
+            running[execution_arn] = dict(test, startTime=executor.now())
+            pending.remove(test)
+            log(
+                f"{executor.now():%H:%M:%S} started  {test['name']} ({len(running)} running)"
+            )
+        max_running = max(max_running, len(running))
+        for completion in executor.wait(running):
+            test = running.pop(completion["executionArn"], None)
+            if test is None:
+                continue
+            result = report_test(test, completion, started, executor.now())
+            results.append(result)
+            log(
+                f"{executor.now():%H:%M:%S} finished {test['name']}: {result['status']} {result.get('state') or ''}"
+            )
+    for execution_arn, test in running.items():
+        completion = {
+            "executionArn": execution_arn,
+            "status": "TIMED_OUT",
+            "error": "SuiteTimeout",
+            "cause": f"The execution was still running after the suite timeout of {timeout} seconds.",
+        }
+        results.append(report_test(test, completion, started, executor.now()))
+        log(f"{executor.now():%H:%M:%S} timed out {test['name']}")
+    for test in pending:
+        completion = {"executionArn": None, "status": "NOT_STARTED"}
+        test = dict(test, startTime=executor.now())
+        results.append(report_test(test, completion, started, executor.now()))
+    return report(suite, results, started, executor.now(), concurrency, max_running)
+
+
+def report_test(test, completion, started, end_time):
+    result = {
+        "name": test["name"],
+        "testId": test["input"]["testId"],
+        "executionArn": completion["executionArn"],
+        "status": completion["status"],
+        "startTime": test["startTime"].isoformat(),
+        "endTime": end_time.isoformat(),
+        "duration": (end_time - test["startTime"]).total_seconds(),
+        "queued": (test["startTime"] - started).total_seconds(),
+        "blastRadius": sorted(test["blastRadius"]),
+    }
+    for key in ("state", "error", "cause"):
+        if completion.get(key) is not None:
+            result[key] = completion[key]
+    if completion.get("output"):
+        result["output"] = json.loads(completion["output"])
+    # The state is only known locally; on AWS a test passes when it succeeds.
+    if "expect" in test and "state" in result:
+        result["expected"] = test["expect"]
+        result["passed"] = result["state"] == test["expect"]
+    else:
+        result["passed"] = result["status"] == "SUCCEEDED"
+    return result
+
+
+def report(suite, results, started, end_time, concurrency, max_running):
+    duration = (end_time - started).total_seconds()
+    sequential = sum(result["duration"] for result in results)
+    statuses = {}
+    for result in results:
+        statuses[result["status"]] = statuses.get(result["status"], 0) + 1
+    return {
+        "suite": suite["name"],
+        "concurrency": concurrency,
+        "maxRunning": max_running,
+        "startTime": started.isoformat(),
+        "endTime": end_time.isoformat(),
+        "duration": duration,
+        "sequentialDuration": sequential,
+        "statuses": statuses,
+        "passed": sum(1 for result in results if result["passed"]),
+        "failed": sum(1 for result in results if not result["passed"]),
+        "tests": sorted(results, key=lambda result: result["startTime"]),
+    }
+
+
+def state_machine_arn(environment):
+    import boto3
+
+    identity = boto3.client("sts").get_caller_identity()
+    partition = identity["Arn"].split(":")[1]
+    region = boto3.session.Session().region_name
+    return f"arn:{partition}:states:{region}:{identity['Account']}:stateMachine:chaos-machine-{environment}"
+
+
+def execution_status_queue(environment):
+    import boto3
+
+    sqs = boto3.client("sqs")
+    try:
+        return sqs.get_queue_url(
+            QueueName=f"chaos-machine-{environment}-execution-status"
+        )["QueueUrl"]
+    except sqs.exceptions.QueueDoesNotExist:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Run a suite of chaos machine tests with bounded concurrency."
+    )
+    parser.add_argument("suite", help="Suite JSON file.")
+    parser.add_argument("--concurrency", type=int)
+    parser.add_argument(
+        "--timeout",
+        type=int,
+        help="Seconds after which the suite stops waiting for its tests.",
+    )
+    parser.add_argument(
+        "--environment",
+        default=os.getenv("ENVIRONMENT"),
+        help="Project environment of the chaos machine, defaults to ENVIRONMENT.",
+    )
+    parser.add_argument("--state-machine-arn")
+    parser.add_argument(
+        "--queue-url",
+        help="Execution status queue URL, defaults to the queue of the environment.",
+    )
+    parser.add_argument(
+        "--poll-interval",
+        type=int,
+        default=10,
+        help="Seconds between polls when there is no execution status queue.",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Run the tests as local scenarios with a simulated clock.",
+    )
+    parser.add_argument("--log-level", default="CRITICAL")
+    parser.add_argument("--output", help="Write the report as JSON.")
+    args = parser.parse_args()
+
+    suite = load_suite(args.suite)
+    concurrency = args.concurrency or suite.get("concurrency", DEFAULT_CONCURRENCY)
+    if args.local:
+        os.environ["LOG_LEVEL"] = args.log_level
+        executor = LocalExecutor()
+    else:
+        queue_url = args.queue_url or execution_status_queue(args.environment)
+        if queue_url is None:
+            print("No execution status queue, polling the running executions.")
+        executor = StepFunctionsExecutor(
+            args.state_machine_arn or state_machine_arn(args.environment),
+            queue_url,
+            args.poll_interval,
+        )
+
+    result = run_suite(
+        suite, executor, concurrency, timeout=args.timeout or suite.get("timeout")
+    )
+
+    print(
+        f"\n{'test':<40}{'status':<13}{'state':<16}{'queued s':>10}{'duration s':>12}"
+    )
+    for test in result["tests"]:
+        print(
+            f"{test['name']:<40}{test['status']:<13}{str(test.get('state')):<16}"
+            f"{test['queued']:>10.0f}{test['duration']:>12.0f}"
+        )
+    print(
+        f"\n{len(result['tests'])} tests, {result['passed']} passed, {result['failed']} failed "
+        f"in {result['duration']:.0f}s ({result['sequentialDuration']:.0f}s one after another), "
+        f"up to {result['maxRunning']} at a time"
+    )
+
+    if args.output:
+        Path(args.output).parent.mkdir(parents=True, exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2, default=str)
+
+    if result["failed"]:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,57 @@
+variable "continue_execution_batch_size" {
+  description = "Maximum number of completion events the continue-execution Lambda function receives from the queue in a batch. Used if `continue_execution_queue = true`."
+  type        = number
+  default     = 10
+}
+
+variable "continue_execution_batching_window" {
+  description = "Maximum time in seconds to gather completion events in the queue before the continue-execution Lambda function is invoked. Used if `continue_execution_queue = true`."
+  type        = number
+  default     = 0
+}
+
+variable "continue_execution_max_workers" {
+  description = "Number of experiments of a batch the continue-execution Lambda function processes concurrently."
+  type        = number
+  default     = 10
+}
+
+variable "continue_execution_maximum_concurrency" {
+  description = "Optional maximum number of concurrent continue-execution Lambda functions invoked by the queue, between 2 and 1000. Used if `continue_execution_queue = true`."
+  type        = number
+  default     = 0
+}
+
+variable "continue_execution_queue" {
+  description = "Set to true to buffer the FIS and SSM completion events in an SQS queue and process them in batches, e.g. when many tests run at the same time."
+  type        = bool
+  default     = false
+}
+
 variable "create_chaos_machine" {
   description = "Set to true to create the chaos machine. You might set this to false if your organization requires you to pre-provision IAM resources, which can be created by setting `create_iam_resources = true`."
   type        = bool
   default     = true
 }
 
+variable "create_execution_status_queue" {
+  description = "Set to true to send the status changes of completed executions to an SQS queue, which the suite runner uses to track its executions."
+  type        = bool
+  default     = false
+}
+
 variable "create_iam_roles" {
   description = "Set to true to create IAM resources. If false, you must provide ARNs for the Lambda and state machine roles."
   type        = bool
   default     = true
 }
 
+variable "instrumentation" {
+  description = "Set to true to emit the duration, peak memory, time spent in AWS and Prometheus calls, evaluation and schema validation, and number of datapoints and series processed of each Lambda invocation as CloudWatch Embedded Metric Format log lines, in the `ChaosMachine` namespace."
+  type        = bool
+  default     = false
+}
+
 variable "lambda_environment_variables" {
   description = "Additional environment variables for all Lambda functions. Can be used to set the HTTPS_PROXY and NO_PROXY envs for Lambda functions."
   type        = map(string)
@@ -28,6 +70,12 @@ variable "lambda_evaluate_hypothesis_role_arn" {
   default     = ""
 }
 
+variable "lambda_monitor_experiment_role_arn" {
+  description = "The ARN of the execution role for the monitor-experiment Lambda function. Required if `create_iam_roles = false`."
+  type        = string
+  default     = ""
+}
+
 variable "lambda_cloudwatch_log_group_retention_in_days" {
   description = "Retention period for the CloudWatch log groups associated with each Lambda function."
   type        = number
@@ -73,11 +121,29 @@ variable "lambda_subnet_ids" {
   default     = []
 }
 
+variable "payload_uri" {
+  description = "Optional local directory, file:// URI or s3://bucket/prefix URI to which the Lambda functions write test definitions, results and errors larger than `PAYLOAD_MAX_BYTES`, keeping only references to them in the state of the execution."
+  type        = string
+  default     = ""
+}
+
 variable "project_env" {
   description = "Name of the project environment, e.g. dev."
   type        = string
 }
 
+variable "query_cache" {
+  description = "Set to true to cache the CloudWatch and Prometheus query results by aligned time bucket in a DynamoDB table, so the steady state, guardrail and hypothesis evaluations only fetch the buckets that are not cached."
+  type        = bool
+  default     = false
+}
+
+variable "snapshot_uri" {
+  description = "Optional local directory, file:// URI or s3://bucket/prefix URI to which the steady-state and evaluate-hypothesis Lambda functions write snapshots of the responses they fetch, which can be replayed locally."
+  type        = string
+  default     = ""
+}
+
 variable "state_machine_cloudwatch_log_group_retention_in_days" {
   description = "Retention period for the CloudWatch log group associated with the state machine."
   type        = number
@@ -99,3 +165,9 @@ variable "state_machine_role_arn" {
   type        = string
   default     = ""
 }
+
+variable "target_role_arns" {
+  description = "ARNs of the roles in other accounts that the steady-state, monitor-experiment and evaluate-hypothesis Lambda functions can assume to read the CloudWatch metrics and alarms of a `target`."
+  type        = list(string)
+  default     = []
+}